@@ -1,11 +1,19 @@
 import frappe
+from health_core.utils.email_jobs import enqueue_email_job, get_job_status
+from health_core.utils.metrics import timed_endpoint
+from health_core.utils.rate_limit import Limit, rate_limit
+from health_core.utils.templates import render_template
 
 @frappe.whitelist(allow_guest=True)
+@timed_endpoint
 def get_smtp_status():
 	"""Get SMTP configuration status"""
 	try:
-		from health_core.setup.install import validate_smtp_configuration
-		result = validate_smtp_configuration()
+		from health_core.utils.cache import get_cached_smtp_status
+		from health_core.utils.smtp_health import add_health
+		
+		# Live health comes from the scheduled prober's cached result, not a new connection
+		result = add_health(get_cached_smtp_status())
 		return result
 	except Exception as e:
 		return {
@@ -15,25 +23,19 @@ def get_smtp_status():
 		}
 
 @frappe.whitelist(allow_guest=True)
+@timed_endpoint
 def get_email_accounts():
 	"""Get email account settings"""
 	try:
-		# Get all email accounts without permission check for guest access
-		accounts = frappe.get_all(
-			"Email Account",
-			fields=[
-				"name", "email_account_name", "email_id", "smtp_server", 
-				"smtp_port", "use_tls", "use_ssl", "enable_outgoing", 
-				"default_outgoing", "service"
-			],
-			order_by="default_outgoing desc, creation desc"
-		)
+		from health_core.utils.cache import get_conditional_response, get_email_account_listing
 		
-		return {
+		# Get all email accounts without permission check for guest access.
+		# Served with a version-based ETag, so unchanged listings get a 304.
+		return get_conditional_response("guest", lambda version: {
 			"status": "success",
-			"accounts": accounts,
+			"accounts": get_email_account_listing(version),
 			"has_permission_to_modify": False  # Guest can't modify
-		}
+		})
 		
 	except Exception as e:
 		return {
@@ -42,6 +44,8 @@ def get_email_accounts():
 		}
 
 @frappe.whitelist(allow_guest=True, methods=["POST"])
+@rate_limit(Limit("ip", 5, 60), Limit("recipient_email", 3, 3600), Limit("global", 60, 60))
+@timed_endpoint
 def send_test_email(recipient_email=None):
 	"""Send test email"""
 	try:
@@ -72,37 +76,25 @@ def send_test_email(recipient_email=None):
 		
 		# Prepare test email content
 		subject = "Health Core SMTP Test Email"
-		message = f"""
-		<p>Hello,</p>
-		
-		<p>This is a test email sent from your 4Geeks Health system to verify that email sending is working correctly.</p>
-		
-		<p><strong>Configuration Details:</strong></p>
-		<ul>
-			<li>Email Account: {default_account.email_account_name}</li>
-			<li>Sent at: {frappe.utils.now()}</li>
-			<li>Test Mode: Guest Access</li>
-		</ul>
-		
-		<p>If you received this email, your SMTP configuration is working properly.</p>
-		
-		<p>Best regards,<br>
-		4Geeks Health System</p>
-		"""
+		message = render_template("smtp_test_email", {
+			"email_account_name": default_account.email_account_name,
+			"sent_at": frappe.utils.now()
+		})
 		
-		# Send the test email
-		frappe.sendmail(
-			recipients=[recipient_email],
+		# Queue the test email; a background worker sends it over the pooled SMTP session
+		job_id = enqueue_email_job(
+			recipient_email=recipient_email,
 			subject=subject,
 			message=message,
-			reference_doctype="Email Account",
-			reference_name=default_account.name,
-			now=True
+			email_account=default_account.name,
+			# The body embeds the send time; repeated calls are still the same test email
+			dedup_content="smtp_test_email"
 		)
 		
 		return {
-			"status": "success",
-			"message": f"Test email sent successfully to {recipient_email}"
+			"status": "queued",
+			"message": f"Test email to {recipient_email} has been queued",
+			"job_id": job_id
 		}
 		
 	except Exception as e:
@@ -111,7 +103,21 @@ def send_test_email(recipient_email=None):
 			"message": f"Error: {str(e)}"
 		}
 
+@frappe.whitelist(allow_guest=True)
+@rate_limit(Limit("ip", 120, 60))
+@timed_endpoint
+def get_test_email_status(job_id=None):
+	"""Get status, SMTP phase timings and error of a queued test email"""
+	try:
+		return get_job_status(job_id, public=True)
+	except Exception as e:
+		return {
+			"status": "error",
+			"message": f"Error: {str(e)}"
+		}
+
 @frappe.whitelist(allow_guest=True, methods=["POST"])
+@timed_endpoint
 def reset_smtp():
 	"""Reset SMTP to default"""
 	try:
@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+"""
+Concurrent load test of the whitelisted health_core endpoints.
+
+Replays a weighted mix of endpoint calls over HTTP against a running bench,
+at each of a rising list of concurrency levels, for a fixed time per level.
+Every load thread keeps one keep-alive session and picks its next endpoint
+at random by weight, so the mix holds at every level. Each level reports,
+per endpoint and for all calls together, throughput, p50/p95/p99 latency,
+errors and the error rate. The saturation point is the first level where
+adding threads no longer buys throughput, or where calls start failing.
+
+Endpoints:
+	get_smtp_status        GET  health_core.api.get_smtp_status (guest)
+	get_email_accounts     GET  health_core.api.get_email_accounts (guest)
+	send_test_email        POST health_core.api.send_test_email (guest)
+	reset_to_default_smtp  POST health_core.utils.smtp_manager.reset_to_default_smtp
+	                       (needs an API key and secret with Email Account write access)
+
+During the run a stub-backed Email Account is the site's default, so test
+emails go to the local stub SMTP server. `reset_to_default_smtp` rebuilds
+that account from `smtp_server`/`smtp_port` in site config, so it is only
+allowed when those already point at a local port the stub can listen on.
+Like the site benchmarks, only run this on a dedicated site with
+`allow_tests` set.
+
+Rate-limited calls (HTTP 429) are counted as `throttled`, apart from errors
+and latencies; override `rate_limits` in site config to measure raw capacity.
+"""
+from __future__ import unicode_literals
+import random
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from health_core.benchmarks.report import make_report, summarize
+from health_core.benchmarks.send_path import RECIPIENT, benchmark_account
+from health_core.benchmarks.stub_smtp import StubSMTPServer, make_self_signed_cert
+
+
+ENDPOINTS = {
+	"get_smtp_status": ("GET", "health_core.api.get_smtp_status", None),
+	"get_email_accounts": ("GET", "health_core.api.get_email_accounts", None),
+	"send_test_email": ("POST", "health_core.api.send_test_email", {"recipient_email": RECIPIENT}),
+	"reset_to_default_smtp": ("POST", "health_core.utils.smtp_manager.reset_to_default_smtp", None),
+}
+AUTH_ENDPOINTS = ("reset_to_default_smtp",)
+DEFAULT_MIX = "get_smtp_status=4,get_email_accounts=4,send_test_email=1"
+
+# Row name for all calls of a level together
+ALL = "all"
+
+OK = "ok"
+ERROR = "error"
+THROTTLED = "throttled"
+
+DEFAULT_TIMEOUT = 30
+# Throughput must grow by at least this fraction per level...
+DEFAULT_MIN_GAIN = 0.1
+# ...with at most this fraction of calls failing
+DEFAULT_MAX_ERROR_RATE = 0.01
+
+LOCAL_HOSTS = ("localhost", "127.0.0.1")
+
+
+def parse_mix(value):
+	"""
+	Parses `endpoint=weight,...` (a bare endpoint weighs 1).
+
+	Returns:
+		dict: Weight per endpoint, in the given order
+	"""
+	mix = {}
+	for item in value.split(","):
+		if not item.strip():
+			continue
+		endpoint, _, weight = item.partition("=")
+		endpoint = endpoint.strip()
+		if endpoint not in ENDPOINTS:
+			raise ValueError("Unknown endpoint: {0}".format(endpoint))
+		mix[endpoint] = float(weight) if weight.strip() else 1.0
+
+	if not mix or not any(mix.values()):
+		raise ValueError("The mix needs at least one endpoint with a positive weight")
+	return mix
+
+
+def classify(status_code, body):
+	"""
+	Outcome of one call. The endpoints catch their own exceptions and answer
+	200 with `{"status": "error"}`, so the body counts as much as the status code.
+	"""
+	if status_code == 429:
+		return THROTTLED
+	if status_code >= 400:
+		return ERROR
+
+	message = body.get("message") if isinstance(body, dict) else None
+	if isinstance(message, dict) and message.get("status") == "error":
+		return ERROR
+	return OK
+
+
+class EndpointClient(object):
+	"""
+	Calls endpoints over one keep-alive HTTP session.
+
+	Args:
+		base_url (str): Site URL, e.g. `http://benchmark.local:8000`
+		api_token (str): `api_key:api_secret` for endpoints that need a login
+		timeout (float): Seconds before a call counts as failed
+	"""
+
+	def __init__(self, base_url, api_token=None, timeout=DEFAULT_TIMEOUT):
+		import requests
+
+		self.base_url = base_url.rstrip("/")
+		self.timeout = timeout
+		self.session = requests.Session()
+		self.session.headers["Accept"] = "application/json"
+		if api_token:
+			self.session.headers["Authorization"] = "token {0}".format(api_token)
+
+	def call(self, endpoint):
+		import requests
+
+		method, path, data = ENDPOINTS[endpoint]
+		try:
+			response = self.session.request(
+				method, "{0}/api/method/{1}".format(self.base_url, path), data=data, timeout=self.timeout
+			)
+		except requests.RequestException:
+			return ERROR
+
+		try:
+			body = response.json()
+		except ValueError:
+			body = None
+		return classify(response.status_code, body)
+
+	def close(self):
+		self.session.close()
+
+
+def run_level(make_client, mix, concurrency, duration, seed=1):
+	"""
+	Replays the mix on `concurrency` threads for `duration` seconds.
+
+	Args:
+		make_client: Returns a client with `call(endpoint)` -> outcome, one per thread
+		mix (dict): Weight per endpoint
+
+	Returns:
+		tuple: ({endpoint: {"latencies", "errors", "throttled"}}, wall-clock duration)
+	"""
+	endpoints = list(mix)
+	weights = [mix[endpoint] for endpoint in endpoints]
+	samples = {endpoint: {"latencies": [], "errors": 0, "throttled": 0} for endpoint in endpoints}
+	lock = threading.Lock()
+	deadline = [None]
+
+	def worker(index, client):
+		rng = random.Random(seed * 1000 + index)
+		while time.perf_counter() < deadline[0]:
+			endpoint = rng.choices(endpoints, weights)[0]
+			start = time.perf_counter()
+			try:
+				outcome = client.call(endpoint)
+			except Exception:
+				outcome = ERROR
+			elapsed = time.perf_counter() - start
+
+			with lock:
+				if outcome == OK:
+					samples[endpoint]["latencies"].append(elapsed)
+				elif outcome == THROTTLED:
+					samples[endpoint]["throttled"] += 1
+				else:
+					samples[endpoint]["errors"] += 1
+
+	# Clients are set up before the clock starts
+	clients = [make_client() for i in range(concurrency)]
+	threads = [threading.Thread(target=worker, args=(i, client), daemon=True) for i, client in enumerate(clients)]
+
+	start = time.perf_counter()
+	deadline[0] = start + duration
+	try:
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+	finally:
+		for client in clients:
+			if hasattr(client, "close"):
+				client.close()
+
+	return samples, time.perf_counter() - start
+
+
+def summarize_level(samples, duration, concurrency):
+	"""One result row per endpoint plus an `all` row, with `throttled` and `error_rate` added."""
+	combined = {"latencies": [], "errors": 0, "throttled": 0}
+	rows = []
+
+	for name, sample in list(samples.items()) + [(ALL, combined)]:
+		if name != ALL:
+			combined["latencies"].extend(sample["latencies"])
+			combined["errors"] += sample["errors"]
+			combined["throttled"] += sample["throttled"]
+
+		row = summarize(name, sample["latencies"], duration, sample["errors"], concurrency=concurrency)
+		row["throttled"] = sample["throttled"]
+		row["error_rate"] = round(row["errors"] / float(row["operations"]), 4) if row["operations"] else None
+		rows.append(row)
+
+	return rows
+
+
+def find_saturation(results, min_gain=DEFAULT_MIN_GAIN, max_error_rate=DEFAULT_MAX_ERROR_RATE):
+	"""
+	Per endpoint, the first concurrency level where more load stopped paying:
+	throughput grew by less than `min_gain` (a fraction) over the previous
+	level, or more than `max_error_rate` of calls failed.
+
+	Returns:
+		list: One dict per endpoint with the best level before saturation
+			(`peak_concurrency`, `peak_ops_per_sec`, `peak_p95_ms`), the level
+			that saturated (`saturated_at`, None if none did) and the `reason`
+	"""
+	by_endpoint = {}
+	for row in results:
+		by_endpoint.setdefault(row["scenario"], []).append(row)
+
+	saturation = []
+	for endpoint, rows in by_endpoint.items():
+		peak = None
+		saturated_at = reason = None
+
+		for row in sorted(rows, key=lambda row: row["concurrency"]):
+			if (row.get("error_rate") or 0) > max_error_rate:
+				saturated_at, reason = row["concurrency"], "errors"
+				break
+
+			if peak and peak.get("ops_per_sec") and (row.get("ops_per_sec") or 0) < peak["ops_per_sec"] * (1 + min_gain):
+				saturated_at, reason = row["concurrency"], "throughput"
+				break
+
+			peak = row
+
+		saturation.append({
+			"endpoint": endpoint,
+			"peak_concurrency": peak["concurrency"] if peak else None,
+			"peak_ops_per_sec": peak.get("ops_per_sec") if peak else None,
+			"peak_p95_ms": peak.get("p95_ms") if peak else None,
+			"saturated_at": saturated_at,
+			"reason": reason
+		})
+
+	return saturation
+
+
+@contextmanager
+def load_test_stub(mix, tls, latency):
+	"""
+	The stub SMTP server for the run. With `reset_to_default_smtp` in the mix
+	it listens on the site config's `smtp_port` with STARTTLS, since that
+	endpoint points the default account there.
+	"""
+	import frappe
+	from frappe.utils import cint
+
+	port = 0
+	if "reset_to_default_smtp" in mix:
+		if frappe.conf.get("smtp_server") not in LOCAL_HOSTS or not cint(frappe.conf.get("smtp_port")):
+			frappe.throw("reset_to_default_smtp reconfigures the default Email Account from smtp_server and "
+				"smtp_port in site config; point them at a free local port (e.g. 127.0.0.1:2525) first")
+		port = cint(frappe.conf.get("smtp_port"))
+		tls = True
+
+	certfile = keyfile = None
+	if tls:
+		certfile, keyfile = make_self_signed_cert(tempfile.gettempdir())
+
+	with StubSMTPServer(port=port, latency=latency, certfile=certfile, keyfile=keyfile) as stub:
+		yield stub, tls
+
+
+def run_load_test(url, mix, concurrencies, duration, api_token=None, tls=False, latency=0.0, seed=1,
+		timeout=DEFAULT_TIMEOUT, min_gain=DEFAULT_MIN_GAIN, max_error_rate=DEFAULT_MAX_ERROR_RATE, make_client=None):
+	"""
+	Runs the mix at every concurrency level against the site the caller is
+	connected to, with a stub-backed default Email Account.
+
+	Returns:
+		dict: Report with one result row per (endpoint, concurrency), including
+			`all`, and the saturation point per endpoint in `meta.saturation`
+	"""
+	make_client = make_client or (lambda: EndpointClient(url, api_token, timeout))
+	results = []
+
+	with load_test_stub(mix, tls, latency) as (stub, tls):
+		with benchmark_account(stub, tls):
+			for concurrency in concurrencies:
+				samples, elapsed = run_level(make_client, mix, concurrency, duration, seed)
+				results.extend(summarize_level(samples, elapsed, concurrency))
+
+		stub_stats = dict(stub.stats)
+
+	return make_report(
+		results,
+		url=url,
+		mix=mix,
+		duration=duration,
+		latency=latency,
+		tls=tls,
+		saturation=find_saturation(results, min_gain, max_error_rate),
+		stub=stub_stats
+	)
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+Result summaries and regression comparison for health_core benchmarks.
+"""
+from __future__ import unicode_literals
+import json
+import math
+import platform
+import time
+
+
+def percentile(sorted_values, pct):
+	"""Nearest-rank percentile of an already sorted list."""
+	if not sorted_values:
+		return None
+	rank = max(1, int(math.ceil(pct / 100.0 * len(sorted_values))))
+	return sorted_values[rank - 1]
+
+
+def summarize(name, latencies, duration, errors=0, **params):
+	"""
+	Builds one result row.
+
+	Args:
+		name (str): Scenario name
+		latencies (list): Per-operation latencies in seconds
+		duration (float): Wall-clock seconds for the whole run
+		errors (int): Failed operations
+		params: Run parameters (concurrency, message size...) recorded with the row
+
+	Returns:
+		dict: Throughput, error count and latency percentiles in milliseconds
+	"""
+	values = sorted(latencies)
+	completed = len(values)
+
+	def ms(value):
+		return round(value * 1000, 3) if value is not None else None
+
+	row = {"scenario": name}
+	row.update(params)
+	row.update({
+		"operations": completed + errors,
+		"errors": errors,
+		"duration": round(duration, 4),
+		"ops_per_sec": round(completed / duration, 2) if duration else None,
+		"mean_ms": ms(sum(values) / completed) if completed else None,
+		"p50_ms": ms(percentile(values, 50)),
+		"p95_ms": ms(percentile(values, 95)),
+		"p99_ms": ms(percentile(values, 99)),
+		"max_ms": ms(values[-1]) if values else None
+	})
+
+	return row
+
+
+def make_report(results, **meta):
+	meta.update({
+		"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+		"python": platform.python_version(),
+		"machine": platform.machine(),
+		"node": platform.node()
+	})
+	return {"meta": meta, "results": results}
+
+
+def save_report(report, path):
+	with open(path, "w") as f:
+		json.dump(report, f, indent=1, sort_keys=True)
+
+
+def load_report(path):
+	with open(path) as f:
+		return json.load(f)
+
+
+def result_key(row, params):
+	return (row["scenario"],) + tuple(row.get(param) for param in params)
+
+
+def compare_reports(baseline, current, threshold=0.1, params=("concurrency", "size")):
+	"""
+	Compares two reports row by row.
+
+	A row regresses when its throughput drops, or its p95 latency rises, by
+	more than `threshold` (a fraction) relative to the baseline.
+
+	Args:
+		baseline (dict): Report to compare against
+		current (dict): New report
+		threshold (float): Allowed relative change
+		params (tuple): Result fields that identify matching rows besides the scenario
+
+	Returns:
+		list: One dict per matching row with the relative changes and a `regression` flag
+	"""
+	baseline_rows = {result_key(row, params): row for row in baseline.get("results", [])}
+	comparison = []
+
+	for row in current.get("results", []):
+		before = baseline_rows.get(result_key(row, params))
+		if not before:
+			continue
+
+		throughput = relative_change(before.get("ops_per_sec"), row.get("ops_per_sec"))
+		p95 = relative_change(before.get("p95_ms"), row.get("p95_ms"))
+
+		entry = {key: row.get(key) for key in ("scenario",) + tuple(params)}
+		entry.update({
+			"ops_per_sec": [before.get("ops_per_sec"), row.get("ops_per_sec")],
+			"p95_ms": [before.get("p95_ms"), row.get("p95_ms")],
+			"throughput_change": throughput,
+			"p95_change": p95,
+			"regression": bool(
+				(throughput is not None and throughput < -threshold)
+				or (p95 is not None and p95 > threshold)
+			)
+		})
+		comparison.append(entry)
+
+	return comparison
+
+
+def relative_change(before, after):
+	if not before or after is None:
+		return None
+	return round((after - before) / float(before), 4)
+
+
+def format_table(rows, columns):
+	"""Renders rows as a plain-text table for terminal output."""
+	widths = [max([len(str(column))] + [len(str(row.get(column, ""))) for row in rows]) for column in columns]
+	lines = ["  ".join(str(column).ljust(width) for column, width in zip(columns, widths))]
+	lines.append("  ".join("-" * width for width in widths))
+	for row in rows:
+		lines.append("  ".join(str(row.get(column, "")).ljust(width) for column, width in zip(columns, widths)))
+	return "\n".join(lines)
@@ -0,0 +1,329 @@
+# -*- coding: utf-8 -*-
+"""
+Send-path benchmarks against a local stub SMTP server.
+
+Scenarios:
+	pool                 Pooled sends (health_core.utils.smtp_pool), no site needed
+	no_pool              A fresh connection and AUTH per message, resuming the TLS session, no site needed
+	no_resume            Like no_pool, but with a full TLS handshake per message
+	setup                setup_default_email_account including its verification email
+	                     (serial; needs TLS since the account is configured with STARTTLS)
+	test_email           The background test email job, end to end
+	test_email_endpoint  The web-worker cost of the send_test_email endpoint
+	queue_flush          Draining pre-filled Email Queue rows with the sharded flush
+
+Site scenarios create a temporary default Email Account pointing at the stub
+and restore the previous default afterwards. Only run them on a dedicated
+benchmark site (`allow_tests` must be set) with the scheduler disabled.
+"""
+from __future__ import unicode_literals
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from health_core.benchmarks.report import make_report, summarize
+from health_core.benchmarks.stub_smtp import StubSMTPServer, make_self_signed_cert
+
+
+SITE_SCENARIOS = ("setup", "test_email", "test_email_endpoint", "queue_flush")
+SCENARIOS = ("pool", "no_pool", "no_resume") + SITE_SCENARIOS
+
+BENCHMARK_ACCOUNT = "Health Core Benchmark"
+SENDER = "benchmark@example.com"
+RECIPIENT = "recipient@example.com"
+# The stub accepts any credentials
+STUB_SECRET = "benchmark"
+
+
+def make_body(size):
+	"""Returns an HTML body of roughly `size` bytes."""
+	line = "<p>Health Core benchmark message body padding text.</p>\n"
+	return (line * (size // len(line) + 1))[:size]
+
+
+def run_concurrent(operation, count, concurrency, thread_init=None, thread_teardown=None):
+	"""
+	Runs `operation(i)` for i in range(count) on `concurrency` threads.
+
+	Returns:
+		tuple: (latencies in seconds of successful operations, error count, wall-clock duration)
+	"""
+	latencies = []
+	errors = [0]
+	lock = threading.Lock()
+	counter = iter(range(count))
+
+	def worker():
+		if thread_init:
+			thread_init()
+		try:
+			while True:
+				with lock:
+					i = next(counter, None)
+				if i is None:
+					return
+
+				start = time.perf_counter()
+				try:
+					ok = operation(i) is not False
+				except Exception:
+					ok = False
+				elapsed = time.perf_counter() - start
+
+				with lock:
+					if ok:
+						latencies.append(elapsed)
+					else:
+						errors[0] += 1
+		finally:
+			if thread_teardown:
+				thread_teardown()
+
+	start = time.perf_counter()
+	with ThreadPoolExecutor(max_workers=concurrency) as executor:
+		for future in [executor.submit(worker) for _ in range(concurrency)]:
+			future.result()
+
+	return latencies, errors[0], time.perf_counter() - start
+
+
+def stub_settings(stub, tls):
+	from health_core.utils.smtp_pool import SMTPSettings
+
+	return SMTPSettings(
+		host="localhost", port=stub.port, use_tls=1 if tls else 0, use_ssl=0,
+		login=SENDER, password=STUB_SECRET, email_id=SENDER, sender_name=BENCHMARK_ACCOUNT,
+		timeout=30, modified="benchmark"
+	)
+
+
+def run_pool(stub, tls, site, concurrency, count, size):
+	from health_core.utils.smtp_pool import SMTPConnectionPool, build_message
+
+	settings = stub_settings(stub, tls)
+	msg = build_message(settings, [RECIPIENT], "Benchmark", make_body(size)).as_bytes()
+	pool = SMTPConnectionPool(max_idle=concurrency)
+
+	def operation(i):
+		pool.send(("benchmark", BENCHMARK_ACCOUNT), settings, SENDER, [RECIPIENT], msg)
+
+	try:
+		return run_concurrent(operation, count, concurrency)
+	finally:
+		pool.close_all()
+
+
+def run_no_pool(stub, tls, site, concurrency, count, size, resume=True):
+	from health_core.utils.smtp_pool import build_message, make_ssl_context, open_session
+
+	settings = stub_settings(stub, tls)
+	msg = build_message(settings, [RECIPIENT], "Benchmark", make_body(size)).as_bytes()
+	context = make_ssl_context()
+
+	def operation(i):
+		# A new context has no session to offer, forcing a full handshake
+		session = open_session(settings, context=context if resume else make_ssl_context())
+		try:
+			session.sendmail(SENDER, [RECIPIENT], msg)
+		finally:
+			session.quit()
+
+	return run_concurrent(operation, count, concurrency)
+
+
+def run_no_resume(stub, tls, site, concurrency, count, size):
+	return run_no_pool(stub, tls, site, concurrency, count, size, resume=False)
+
+
+def site_thread(site):
+	import frappe
+
+	def init():
+		frappe.init(site=site)
+		frappe.connect()
+
+	return init, frappe.destroy
+
+
+def run_test_email(stub, tls, site, concurrency, count, size):
+	import frappe
+	from health_core.utils.email_jobs import get_job, run_email_job
+
+	body = make_body(size)
+
+	def operation(i):
+		job_id = frappe.generate_hash(length=16)
+		run_email_job(job_id, RECIPIENT, "Benchmark", body, BENCHMARK_ACCOUNT)
+		return get_job(job_id)["status"] == "sent"
+
+	init, teardown = site_thread(site)
+	return run_concurrent(operation, count, concurrency, init, teardown)
+
+
+def run_test_email_endpoint(stub, tls, site, concurrency, count, size):
+	from health_core.api import send_test_email
+
+	def operation(i):
+		return send_test_email(RECIPIENT).get("status") == "queued"
+
+	init, teardown = site_thread(site)
+	return run_concurrent(operation, count, concurrency, init, teardown)
+
+
+def run_setup(stub, tls, site, concurrency, count, size):
+	import frappe
+	from health_core.setup.install import setup_default_email_account
+
+	def operation(i):
+		# Force the update path, which saves the account and sends the verification email
+		frappe.db.set_value("Email Account", BENCHMARK_ACCOUNT, "email_account_name", BENCHMARK_ACCOUNT)
+		setup_default_email_account()
+		frappe.db.commit()
+
+	# The setup path is serial by design; concurrency is ignored
+	return run_concurrent(operation, count, 1)
+
+
+def run_queue_flush(stub, tls, site, concurrency, count, size):
+	import frappe
+	from frappe.utils import get_datetime, now_datetime
+	from health_core.utils.queue_flush import flush_queue
+
+	reference_name = "benchmark-" + frappe.generate_hash(length=8)
+	body = make_body(size)
+
+	for i in range(count):
+		frappe.sendmail(
+			recipients=[RECIPIENT],
+			subject="Benchmark",
+			message=body,
+			reference_doctype="Email Account",
+			reference_name=reference_name
+		)
+	frappe.db.commit()
+
+	started_at = now_datetime()
+	start = time.perf_counter()
+	while flush_queue(workers=concurrency)["claimed"]:
+		pass
+	duration = time.perf_counter() - start
+
+	rows = frappe.get_all(
+		"Email Queue",
+		filters={"reference_name": reference_name},
+		fields=["status", "modified"]
+	)
+	latencies = [
+		max((get_datetime(row.modified) - started_at).total_seconds(), 0)
+		for row in rows if row.status == "Sent"
+	]
+
+	return latencies, len(rows) - len(latencies), duration
+
+
+RUNNERS = {
+	"pool": run_pool,
+	"no_pool": run_no_pool,
+	"no_resume": run_no_resume,
+	"setup": run_setup,
+	"test_email": run_test_email,
+	"test_email_endpoint": run_test_email_endpoint,
+	"queue_flush": run_queue_flush
+}
+
+
+@contextmanager
+def benchmark_account(stub, tls):
+	"""
+	Makes a stub-backed Email Account the site's default outgoing account and
+	points the site's SMTP config at the stub, restoring both afterwards.
+	"""
+	import frappe
+
+	if not frappe.conf.get("allow_tests"):
+		frappe.throw("Site benchmarks modify email settings; set allow_tests on a dedicated benchmark site first")
+
+	previous_default = frappe.db.get_value("Email Account", {"default_outgoing": 1}, "name")
+	previous_conf = {key: frappe.conf.get(key) for key in ("smtp_server", "smtp_port", "smtp_user", "smtp_password")}
+
+	if previous_default:
+		frappe.db.set_value("Email Account", previous_default, "default_outgoing", 0)
+
+	account = frappe.get_doc({
+		"doctype": "Email Account",
+		"email_account_name": BENCHMARK_ACCOUNT,
+		"email_id": SENDER,
+		"smtp_server": "localhost",
+		"smtp_port": stub.port,
+		"use_tls": 1 if tls else 0,
+		"enable_outgoing": 1,
+		"default_outgoing": 1,
+		"enable_incoming": 0,
+		"password": STUB_SECRET
+	})
+	account.insert(ignore_permissions=True)
+	frappe.conf.update({"smtp_server": "localhost", "smtp_port": stub.port, "smtp_user": SENDER, "smtp_password": STUB_SECRET})
+	frappe.db.commit()
+
+	try:
+		yield account.name
+	finally:
+		frappe.conf.update(previous_conf)
+		frappe.delete_doc("Email Account", account.name, ignore_permissions=True, force=True)
+		if previous_default:
+			frappe.db.set_value("Email Account", previous_default, "default_outgoing", 1)
+		frappe.db.commit()
+
+
+def run_benchmarks(scenarios, concurrencies, sizes, messages, site=None, latency=0.0, tls=False,
+		fail_rate=0.0, seed=1, pipelining=False, chunking=False):
+	"""
+	Runs every scenario at every concurrency and message size against a fresh stub server,
+	optionally advertising PIPELINING and CHUNKING.
+
+	Returns:
+		dict: Report with one result row per (scenario, concurrency, size)
+	"""
+	certfile = keyfile = None
+	if tls:
+		certfile, keyfile = make_self_signed_cert(tempfile.gettempdir())
+
+	results = []
+
+	with StubSMTPServer(latency=latency, certfile=certfile, keyfile=keyfile, fail_rate=fail_rate, seed=seed,
+			pipelining=pipelining, chunking=chunking) as stub:
+		needs_site = any(scenario in SITE_SCENARIOS for scenario in scenarios)
+		account = benchmark_account(stub, tls) if needs_site else None
+
+		if account:
+			account.__enter__()
+
+		try:
+			for scenario in scenarios:
+				for concurrency in concurrencies:
+					for size in sizes:
+						latencies, errors, duration = RUNNERS[scenario](stub, tls, site, concurrency, messages, size)
+						results.append(summarize(
+							scenario, latencies, duration, errors,
+							concurrency=concurrency if scenario != "setup" else 1,
+							size=size
+						))
+		finally:
+			if account:
+				account.__exit__(None, None, None)
+
+		stub_stats = dict(stub.stats)
+
+	return make_report(
+		results,
+		messages=messages,
+		latency=latency,
+		tls=tls,
+		fail_rate=fail_rate,
+		pipelining=pipelining,
+		chunking=chunking,
+		site=site,
+		stub=stub_stats
+	)
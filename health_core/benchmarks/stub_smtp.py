@@ -0,0 +1,362 @@
+# -*- coding: utf-8 -*-
+"""
+Local SMTP stand-in for benchmarks and tests.
+
+Speaks enough ESMTP for smtplib (EHLO, STARTTLS, AUTH, MAIL/RCPT/DATA,
+RSET, NOOP, QUIT), and optionally PIPELINING and CHUNKING (BDAT). It accepts
+any credentials and discards messages unless asked to keep them. Latency
+and failures can be injected to model slow or flaky providers.
+
+Replies are written once the client has to wait for them, i.e. when no
+further command is buffered, so a pipelined group of commands costs one
+injected latency and one counted round trip, as on a real link.
+"""
+from __future__ import unicode_literals
+import os
+import random
+import socket
+import socketserver
+import ssl
+import subprocess
+import threading
+import time
+
+
+def make_self_signed_cert(directory):
+	"""
+	Creates a throwaway self-signed certificate for `localhost` with the openssl CLI.
+
+	Returns:
+		tuple: (certfile, keyfile) paths
+	"""
+	certfile = os.path.join(directory, "stub_smtp_cert.pem")
+	keyfile = os.path.join(directory, "stub_smtp_key.pem")
+
+	if not (os.path.exists(certfile) and os.path.exists(keyfile)):
+		subprocess.run([
+			"openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes",
+			"-keyout", keyfile, "-out", certfile, "-days", "2", "-subj", "/CN=localhost"
+		], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+	return certfile, keyfile
+
+
+class StubSMTPServer(object):
+	"""
+	Threaded stub SMTP server.
+
+	Args:
+		host (str): Interface to listen on
+		port (int): Port, 0 picks a free one
+		latency (float): Seconds to wait before every reply, modelling a round trip
+		certfile (str): Certificate enabling STARTTLS (or implicit TLS)
+		keyfile (str): Key for `certfile`
+		implicit_tls (bool): Wrap connections in TLS immediately (SMTPS)
+		fail_rate (float): Fraction of messages rejected with a 451 after DATA
+		disconnect_rate (float): Fraction of transactions where the connection is dropped after MAIL
+		max_recipients (int): RCPT TOs accepted per transaction before answering 452
+		seed (int): Seed for failure injection, for reproducible runs
+		keep_messages (bool): Keep accepted messages (without dot-stuffing) in `messages`
+		pipelining (bool): Advertise PIPELINING
+		chunking (bool): Advertise CHUNKING and accept BDAT
+	"""
+
+	def __init__(self, host="127.0.0.1", port=0, latency=0.0, certfile=None, keyfile=None,
+			implicit_tls=False, fail_rate=0.0, disconnect_rate=0.0, max_recipients=None, seed=None,
+			keep_messages=False, pipelining=False, chunking=False):
+		self.host = host
+		self.port = port
+		self.latency = latency
+		self.implicit_tls = implicit_tls
+		self.fail_rate = fail_rate
+		self.disconnect_rate = disconnect_rate
+		self.max_recipients = max_recipients
+		self.random = random.Random(seed)
+		self.keep_messages = keep_messages
+		self.pipelining = pipelining
+		self.chunking = chunking
+		self.messages = []
+		self.ssl_context = None
+		self.stats = {
+			"connections": 0, "tls_handshakes": 0, "tls_resumed": 0, "messages": 0, "recipients": 0,
+			"bytes": 0, "commands": 0, "rejected": 0, "disconnects": 0,
+			"round_trips": 0
+		}
+		self._stats_lock = threading.Lock()
+		self._server = None
+		self._thread = None
+
+		if certfile:
+			self.ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+			self.ssl_context.load_cert_chain(certfile, keyfile)
+
+	@property
+	def address(self):
+		return self.host, self.port
+
+	def start(self):
+		stub = self
+
+		class Server(socketserver.ThreadingTCPServer):
+			daemon_threads = True
+			allow_reuse_address = True
+
+		class Handler(socketserver.BaseRequestHandler):
+			def handle(self):
+				StubSMTPSession(stub, self.request).run()
+
+		self._server = Server((self.host, self.port), Handler)
+		self.port = self._server.server_address[1]
+		self._thread = threading.Thread(target=self._server.serve_forever, name="stub-smtp", daemon=True)
+		self._thread.start()
+
+		return self.address
+
+	def stop(self):
+		if self._server:
+			self._server.shutdown()
+			self._server.server_close()
+			self._server = None
+
+	def count(self, stat, value=1):
+		with self._stats_lock:
+			self.stats[stat] += value
+
+	def chance(self, rate):
+		if not rate:
+			return False
+		with self._stats_lock:
+			return self.random.random() < rate
+
+	def __enter__(self):
+		self.start()
+		return self
+
+	def __exit__(self, *args):
+		self.stop()
+
+
+class LineReader(object):
+	"""Buffered reader that can tell whether a full command is already waiting."""
+
+	def __init__(self, sock):
+		self.sock = sock
+		self.buffer = bytearray()
+
+	def has_line(self):
+		return b"\n" in self.buffer
+
+	def fill(self):
+		data = self.sock.recv(65536)
+		self.buffer += data
+		return bool(data)
+
+	def readline(self):
+		while b"\n" not in self.buffer:
+			if not self.fill():
+				return self.take(len(self.buffer))
+		return self.take(self.buffer.index(b"\n") + 1)
+
+	def read(self, size):
+		while len(self.buffer) < size:
+			if not self.fill():
+				break
+		return self.take(min(size, len(self.buffer)))
+
+	def take(self, size):
+		data = bytes(self.buffer[:size])
+		del self.buffer[:size]
+		return data
+
+
+class StubSMTPSession(object):
+	"""One client connection to the stub server."""
+
+	def __init__(self, stub, sock):
+		self.stub = stub
+		self.sock = sock
+		self.reader = None
+		self.tls = False
+		self.recipients = 0
+		self.pending = []
+		self.deferred = False
+		self.chunks = []
+
+	def run(self):
+		self.stub.count("connections")
+
+		try:
+			if self.stub.implicit_tls and self.stub.ssl_context:
+				self.start_tls()
+
+			self.reader = LineReader(self.sock)
+			self.reply("220 stub.local ESMTP ready")
+
+			while True:
+				line = self.readline()
+				if not line:
+					break
+
+				self.stub.count("commands")
+				if not self.dispatch(line.decode("utf-8", "replace").rstrip("\r\n")):
+					break
+			self.flush()
+		except (OSError, ssl.SSLError):
+			pass
+		finally:
+			try:
+				self.sock.close()
+			except OSError:
+				pass
+
+	def readline(self):
+		# The client is about to wait for the replies so far
+		if not self.reader.has_line() and not self.deferred:
+			self.flush()
+		return self.reader.readline()
+
+	def reply(self, *lines, **kwargs):
+		"""
+		Queues reply lines. A `deferred` reply (to an intermediate BDAT chunk
+		from a pipelining client) is only written with the next one the client
+		has to wait for.
+		"""
+		self.pending.extend(lines)
+		self.deferred = kwargs.get("deferred", False)
+
+	def flush(self):
+		self.deferred = False
+		if not self.pending:
+			return
+		if self.stub.latency:
+			time.sleep(self.stub.latency)
+		self.stub.count("round_trips")
+		lines, self.pending = self.pending, []
+		self.sock.sendall("".join(line + "\r\n" for line in lines).encode("utf-8"))
+
+	def start_tls(self):
+		self.sock = self.stub.ssl_context.wrap_socket(self.sock, server_side=True)
+		self.tls = True
+		self.stub.count("tls_handshakes")
+		if self.sock.session_reused:
+			self.stub.count("tls_resumed")
+
+	def ehlo_lines(self):
+		return ["SIZE 52428800", "8BITMIME", "AUTH PLAIN LOGIN"] + (
+			["PIPELINING"] if self.stub.pipelining else []
+		) + (
+			["CHUNKING"] if self.stub.chunking else []
+		) + (
+			["STARTTLS"] if self.stub.ssl_context and not self.tls else []
+		)
+
+	def dispatch(self, line):
+		command, _, argument = line.partition(" ")
+		command = command.upper()
+
+		if command == "EHLO":
+			features = self.ehlo_lines()
+			self.reply("250-stub.local", *["250-" + f for f in features[:-1]] + ["250 " + features[-1]])
+		elif command == "HELO":
+			self.reply("250 stub.local")
+		elif command == "STARTTLS":
+			if not self.stub.ssl_context or self.tls:
+				self.reply("454 TLS not available")
+			else:
+				self.reply("220 Ready to start TLS")
+				self.flush()
+				self.start_tls()
+				self.reader = LineReader(self.sock)
+		elif command == "AUTH":
+			self.authenticate(argument)
+		elif command == "MAIL":
+			self.recipients = 0
+			self.chunks = []
+			if self.stub.chance(self.stub.disconnect_rate):
+				self.stub.count("disconnects")
+				return False
+			self.reply("250 OK")
+		elif command == "RCPT":
+			if self.stub.max_recipients and self.recipients >= self.stub.max_recipients:
+				self.reply("452 4.5.3 Too many recipients")
+			else:
+				self.recipients += 1
+				self.stub.count("recipients")
+				self.reply("250 OK")
+		elif command == "DATA":
+			if not self.recipients:
+				self.reply("554 5.5.1 No valid recipients")
+			else:
+				self.reply("354 End data with <CR><LF>.<CR><LF>")
+				self.receive_data()
+		elif command == "BDAT" and self.stub.chunking:
+			self.receive_chunk(argument)
+		elif command == "RSET":
+			self.recipients = 0
+			self.chunks = []
+			self.reply("250 OK")
+		elif command == "NOOP":
+			self.reply("250 OK")
+		elif command == "QUIT":
+			self.reply("221 Bye")
+			return False
+		else:
+			self.reply("502 Command not implemented")
+
+		return True
+
+	def authenticate(self, argument):
+		mechanism, _, initial = argument.partition(" ")
+		mechanism = mechanism.upper()
+
+		if mechanism == "PLAIN":
+			if not initial:
+				self.reply("334 ")
+				self.readline()
+		elif mechanism == "LOGIN":
+			if not initial:
+				self.reply("334 VXNlcm5hbWU6")
+				self.readline()
+			self.reply("334 UGFzc3dvcmQ6")
+			self.readline()
+		else:
+			self.reply("504 Unrecognized authentication type")
+			return
+
+		self.reply("235 Authentication successful")
+
+	def receive_data(self):
+		lines = []
+		while True:
+			line = self.readline()
+			if not line or line in (b".\r\n", b".\n"):
+				break
+			lines.append(line[1:] if line.startswith(b"..") else line)
+
+		self.accept(lines)
+
+	def receive_chunk(self, argument):
+		size, _, last = argument.partition(" ")
+		# BDAT data follows the command without waiting for a reply
+		self.chunks.append(self.reader.read(int(size)))
+
+		if last.strip().upper() != "LAST":
+			self.reply("250 {0} octets received".format(size), deferred=self.stub.pipelining)
+		elif not self.recipients:
+			self.chunks = []
+			self.reply("554 5.5.1 No valid recipients")
+		else:
+			chunks, self.chunks = self.chunks, []
+			self.accept(chunks)
+
+	def accept(self, parts):
+		self.stub.count("bytes", sum(len(part) for part in parts))
+
+		if self.stub.chance(self.stub.fail_rate):
+			self.stub.count("rejected")
+			self.reply("451 4.3.0 Temporary failure (injected)")
+		else:
+			self.stub.count("messages")
+			if self.stub.keep_messages:
+				self.stub.messages.append(b"".join(parts))
+			self.reply("250 OK queued")
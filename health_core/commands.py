@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import sys
+import time
+
+import click
+
+from frappe.commands import get_site, pass_context
+
+
+@click.command("health-core-email-worker")
+@click.option("--batch-size", type=int, help="Email Queue rows sent per batch")
+@click.option("--poll-interval", type=float, help="Seconds to wait for an enqueue notification before polling")
+@pass_context
+def email_worker(context, batch_size=None, poll_interval=None):
+	"""Run a resident worker that sends Email Queue rows as soon as they are inserted."""
+	from health_core.utils.queue_worker import EmailQueueWorker
+
+	site = get_site(context)
+	EmailQueueWorker(site, batch_size=batch_size, poll_interval=poll_interval).run()
+
+
+def parse_int_list(value):
+	return [int(item) for item in value.split(",") if item.strip()]
+
+
+@click.command("health-core-benchmark")
+@click.option("--scenario", "scenarios", multiple=True, help="Scenario to run (repeatable): pool, no_pool, no_resume, setup, test_email, test_email_endpoint, queue_flush")
+@click.option("--concurrency", default="1,4,16", help="Comma-separated concurrency levels")
+@click.option("--messages", default=200, type=int, help="Messages per run")
+@click.option("--size", default="1024,102400", help="Comma-separated message body sizes in bytes")
+@click.option("--latency", default=0.0, type=float, help="Seconds the stub waits before each reply")
+@click.option("--tls", is_flag=True, help="Enable STARTTLS on the stub server")
+@click.option("--fail-rate", default=0.0, type=float, help="Fraction of messages the stub rejects")
+@click.option("--pipelining", is_flag=True, help="Advertise PIPELINING on the stub server")
+@click.option("--chunking", is_flag=True, help="Advertise CHUNKING (BDAT) on the stub server")
+@click.option("--output", help="Write the JSON report to this path")
+@click.option("--baseline", help="Compare against this JSON report and exit non-zero on regressions")
+@click.option("--threshold", default=0.1, type=float, help="Allowed relative throughput/p95 change")
+@pass_context
+def benchmark(context, scenarios=None, concurrency=None, messages=None, size=None, latency=None,
+		tls=False, fail_rate=None, pipelining=False, chunking=False, output=None, baseline=None, threshold=None):
+	"""Benchmark the email send path against a local stub SMTP server."""
+	import frappe
+	from health_core.benchmarks.report import format_table, load_report, save_report
+	from health_core.benchmarks.send_path import SCENARIOS, SITE_SCENARIOS, run_benchmarks
+
+	scenarios = list(scenarios or ("pool", "no_pool"))
+	unknown = [scenario for scenario in scenarios if scenario not in SCENARIOS]
+	if unknown:
+		raise click.BadParameter("Unknown scenario(s): {0}".format(", ".join(unknown)), param_hint="--scenario")
+
+	site = None
+	if any(scenario in SITE_SCENARIOS for scenario in scenarios):
+		site = get_site(context)
+		frappe.init(site=site)
+		frappe.connect()
+
+	try:
+		report = run_benchmarks(
+			scenarios, parse_int_list(concurrency), parse_int_list(size), messages,
+			site=site, latency=latency, tls=tls, fail_rate=fail_rate,
+			pipelining=pipelining, chunking=chunking
+		)
+	finally:
+		if site:
+			frappe.destroy()
+
+	click.echo(format_table(report["results"], [
+		"scenario", "concurrency", "size", "operations", "errors",
+		"ops_per_sec", "mean_ms", "p50_ms", "p95_ms", "p99_ms"
+	]))
+
+	if output:
+		save_report(report, output)
+		click.echo("Report written to {0}".format(output))
+
+	if baseline and report_regressions(load_report(baseline), report, threshold):
+		sys.exit(1)
+
+
+@click.command("health-core-benchmark-compare")
+@click.argument("baseline")
+@click.argument("current")
+@click.option("--threshold", default=0.1, type=float, help="Allowed relative throughput/p95 change")
+def benchmark_compare(baseline, current, threshold=None):
+	"""Compare two benchmark reports and exit non-zero on regressions."""
+	from health_core.benchmarks.report import load_report
+
+	if report_regressions(load_report(baseline), load_report(current), threshold):
+		sys.exit(1)
+
+
+def report_regressions(baseline, current, threshold):
+	"""Prints a comparison table and returns True if any row regressed."""
+	from health_core.benchmarks.report import compare_reports, format_table
+
+	comparison = compare_reports(baseline, current, threshold=threshold)
+	click.echo(format_table(comparison, [
+		"scenario", "concurrency", "size", "ops_per_sec", "throughput_change", "p95_ms", "p95_change", "regression"
+	]))
+
+	regressions = [row for row in comparison if row["regression"]]
+	if regressions:
+		click.echo("{0} regression(s) beyond {1:.0%}".format(len(regressions), threshold))
+	return bool(regressions)
+
+
+@click.command("health-core-load-test")
+@click.option("--url", help="Site URL to load (default: the site's own URL)")
+@click.option("--mix", default=None, help="Comma-separated endpoint=weight pairs: get_smtp_status, get_email_accounts, send_test_email, reset_to_default_smtp")
+@click.option("--concurrency", default="1,2,4,8,16,32", help="Comma-separated concurrency levels, in rising order")
+@click.option("--duration", default=10.0, type=float, help="Seconds per concurrency level")
+@click.option("--api-key", help="API key for endpoints that need a login (reset_to_default_smtp)")
+@click.option("--api-secret", help="API secret for --api-key")
+@click.option("--latency", default=0.0, type=float, help="Seconds the stub SMTP server waits before each reply")
+@click.option("--tls", is_flag=True, help="Enable STARTTLS on the stub server")
+@click.option("--min-gain", default=0.1, type=float, help="Throughput growth per level below which an endpoint counts as saturated")
+@click.option("--max-error-rate", default=0.01, type=float, help="Error rate above which an endpoint counts as saturated")
+@click.option("--output", help="Write the JSON report to this path")
+@click.option("--baseline", help="Compare against this JSON report and exit non-zero on regressions")
+@click.option("--threshold", default=0.1, type=float, help="Allowed relative throughput/p95 change")
+@pass_context
+def load_test(context, url=None, mix=None, concurrency=None, duration=None, api_key=None, api_secret=None,
+		latency=None, tls=False, min_gain=None, max_error_rate=None, output=None, baseline=None, threshold=None):
+	"""Load the whitelisted health_core endpoints over HTTP at rising concurrency and find where each saturates."""
+	import frappe
+	from frappe.utils import get_url
+	from health_core.benchmarks.load_test import AUTH_ENDPOINTS, DEFAULT_MIX, parse_mix, run_load_test
+	from health_core.benchmarks.report import format_table, load_report, save_report
+
+	try:
+		mix = parse_mix(mix or DEFAULT_MIX)
+	except ValueError as e:
+		raise click.BadParameter(str(e), param_hint="--mix")
+
+	if any(endpoint in AUTH_ENDPOINTS for endpoint in mix) and not (api_key and api_secret):
+		raise click.UsageError("reset_to_default_smtp needs --api-key and --api-secret")
+
+	site = get_site(context)
+	frappe.init(site=site)
+	frappe.connect()
+
+	try:
+		report = run_load_test(
+			url or get_url(), mix, parse_int_list(concurrency), duration,
+			api_token="{0}:{1}".format(api_key, api_secret) if api_key else None,
+			tls=tls, latency=latency, min_gain=min_gain, max_error_rate=max_error_rate
+		)
+	finally:
+		frappe.destroy()
+
+	click.echo(format_table(report["results"], [
+		"scenario", "concurrency", "operations", "errors", "throttled", "error_rate",
+		"ops_per_sec", "p50_ms", "p95_ms", "p99_ms"
+	]))
+	click.echo("")
+	click.echo(format_table(report["meta"]["saturation"], [
+		"endpoint", "peak_concurrency", "peak_ops_per_sec", "peak_p95_ms", "saturated_at", "reason"
+	]))
+
+	if output:
+		save_report(report, output)
+		click.echo("Report written to {0}".format(output))
+
+	if baseline and report_regressions(load_report(baseline), report, threshold):
+		sys.exit(1)
+
+
+@click.command("health-core-provision-sites")
+@click.option("--workers", type=int, help="Parallel worker processes (default: CPU count)")
+@click.option("--test-email", type=click.Choice(["none", "deferred", "now"]), default="none",
+	help="Verification email for created or updated accounts: skip it, enqueue it on the site, or send it inline")
+@pass_context
+def provision_sites(context, workers=None, test_email=None):
+	"""Create or reconcile the default SMTP Email Account on many sites in parallel (use --site all for the whole bench)."""
+	import os
+	from health_core.benchmarks.report import format_table
+	from health_core.setup.provision import FAILED, count_statuses, provision_sites as run
+
+	if not context.sites:
+		raise click.UsageError("Specify the sites to provision with --site (or --site all)")
+
+	def progress(result):
+		click.echo("{0}: {1}{2}".format(
+			result["site"], result["status"], " ({0})".format(result["error"]) if result["error"] else ""
+		))
+
+	start = time.perf_counter()
+	results = run(context.sites, workers=workers, test_email=test_email, sites_path=os.getcwd(), on_result=progress)
+
+	click.echo(format_table(results, ["site", "status", "action", "seconds", "error"]))
+	counts = count_statuses(results)
+	click.echo("{0} sites in {1:.1f}s: {2} ok, {3} skipped, {4} failed".format(
+		len(results), time.perf_counter() - start, counts["ok"], counts["skipped"], counts[FAILED]
+	))
+
+	if counts[FAILED]:
+		sys.exit(1)
+
+
+commands = [email_worker, benchmark, benchmark_compare, load_test, provision_sites]
@@ -59,11 +59,12 @@ app_license = "MIT"
 # ------------
 
 after_install = "health_core.setup.install.after_install"
+after_migrate = "health_core.setup.install.disable_frappe_queue_flush"
 
 # Uninstallation
 # ---------------
 
-# before_uninstall = "health_core.uninstall.before_uninstall"
+before_uninstall = "health_core.setup.install.before_uninstall"
 # after_uninstall = "health_core.uninstall.after_uninstall"
 
 # Desk Notifications
@@ -96,34 +97,37 @@ after_install = "health_core.setup.install.after_install"
 # ---------------
 # Hook on document methods and events
 
-# doc_events = {
-# 	"*": {
-# 		"on_update": "method",
-# 		"on_cancel": "method",
-# 		"on_trash": "method"
-#	}
-# }
+doc_events = {
+	"Email Account": {
+		"after_insert": "health_core.utils.cache.bump_email_account_version",
+		"on_update": "health_core.utils.cache.bump_email_account_version",
+		"on_trash": "health_core.utils.cache.bump_email_account_version"
+	},
+	"Email Queue": {
+		"before_insert": [
+			"health_core.utils.lanes.set_lane",
+			"health_core.utils.dedup.cancel_duplicate"
+		],
+		"after_insert": "health_core.utils.queue_worker.notify_email_queued"
+	}
+}
 
 # Scheduled Tasks
 # ---------------
 
-# scheduler_events = {
-# 	"all": [
-# 		"health_core.tasks.all"
-# 	],
-# 	"daily": [
-# 		"health_core.tasks.daily"
-# 	],
-# 	"hourly": [
-# 		"health_core.tasks.hourly"
-# 	],
-# 	"weekly": [
-# 		"health_core.tasks.weekly"
-# 	]
-# 	"monthly": [
-# 		"health_core.tasks.monthly"
-# 	]
-# }
+scheduler_events = {
+	"all": [
+		"health_core.utils.audit.flush_audit_buffer"
+	],
+	"cron": {
+		"* * * * *": [
+			"health_core.utils.smtp_health.probe_smtp_servers",
+			"health_core.utils.retry.flush_retries",
+			"health_core.utils.flush_scheduler.adaptive_flush",
+			"health_core.utils.outbox.ingest_outbox"
+		]
+	}
+}
 
 # Testing
 # -------
@@ -0,0 +1,8 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+
+def execute():
+	from health_core.setup.install import setup_email_account_fields
+
+	setup_email_account_fields()
@@ -3,6 +3,8 @@ from __future__ import unicode_literals
 import frappe
 import json
 from frappe.utils import get_url
+from health_core.utils.smtp_pool import send_mail
+from health_core.utils.templates import render_template
 
 
 def after_install():
@@ -11,6 +13,10 @@ def after_install():
 	Sets up the default 4Geeks SMTP email account configuration.
 	"""
 	try:
+		setup_email_queue_fields()
+		setup_email_queue_indexes()
+		setup_email_account_fields()
+		disable_frappe_queue_flush()
 		setup_default_email_account()
 		frappe.db.commit()
 		
@@ -22,10 +28,164 @@ def after_install():
 		frappe.throw(f"Failed to configure default email account: {str(e)}")
 
 
-def setup_default_email_account():
+# Fields health_core adds to Email Queue for its own flush engine
+EMAIL_QUEUE_CUSTOM_FIELDS = {
+	"Email Queue": [
+		{
+			"fieldname": "health_core_claim",
+			"label": "Health Core Claim",
+			"fieldtype": "Data",
+			"insert_after": "status",
+			"hidden": 1,
+			"read_only": 1,
+			"no_copy": 1
+		},
+		{
+			"fieldname": "health_core_claimed_at",
+			"label": "Health Core Claimed At",
+			"fieldtype": "Datetime",
+			"insert_after": "health_core_claim",
+			"hidden": 1,
+			"read_only": 1,
+			"no_copy": 1
+		},
+		{
+			"fieldname": "health_core_next_attempt",
+			"label": "Health Core Next Attempt",
+			"fieldtype": "Datetime",
+			"insert_after": "health_core_claimed_at",
+			"hidden": 1,
+			"read_only": 1,
+			"no_copy": 1
+		},
+		{
+			"fieldname": "health_core_attempts",
+			"label": "Health Core Failed Attempts",
+			"fieldtype": "Int",
+			"insert_after": "health_core_next_attempt",
+			"hidden": 1,
+			"read_only": 1,
+			"no_copy": 1
+		},
+		{
+			"fieldname": "health_core_lane",
+			"label": "Priority Lane",
+			"fieldtype": "Select",
+			"options": "high\nnormal\nbulk",
+			"default": "normal",
+			"insert_after": "priority",
+			"read_only": 1,
+			"in_standard_filter": 1
+		}
+	]
+}
+
+
+def setup_email_queue_fields():
+	"""
+	Adds the custom fields health_core's sharded queue flush relies on to Email Queue.
+	This function is idempotent - existing fields are updated in place.
+	"""
+	from frappe.custom.doctype.custom_field.custom_field import create_custom_fields
+
+	create_custom_fields(EMAIL_QUEUE_CUSTOM_FIELDS, update=True)
+
+
+def setup_email_queue_indexes():
+	"""
+	Adds the composite indexes on Email Queue that backlog analytics
+	(status, email_account, creation), priority lane claims
+	(health_core_lane, status, creation) and due retries
+	(status, health_core_next_attempt) read from.
+	This function is idempotent - existing indexes are left alone, and an
+	index is skipped until its custom field exists.
+	"""
+	from health_core.utils.backlog import BACKLOG_INDEX, BACKLOG_INDEX_FIELDS
+	from health_core.utils.lanes import LANE_INDEX, LANE_INDEX_FIELDS
+	from health_core.utils.retry import RETRY_INDEX, RETRY_INDEX_FIELDS
+
+	for index_name, fields in (
+		(BACKLOG_INDEX, BACKLOG_INDEX_FIELDS),
+		(LANE_INDEX, LANE_INDEX_FIELDS),
+		(RETRY_INDEX, RETRY_INDEX_FIELDS)
+	):
+		if all(frappe.db.has_column("Email Queue", field) for field in fields):
+			frappe.db.add_index("Email Queue", fields, index_name=index_name)
+
+
+# Frappe's own Email Queue flush, replaced by health_core.utils.queue_flush
+FRAPPE_QUEUE_FLUSH = "frappe.email.queue.flush"
+
+
+def disable_frappe_queue_flush():
+	"""
+	Stops Frappe's scheduled `queue.flush` job. It ignores health_core's claims,
+	retry schedule and lanes, so alongside health_core's flush it would send
+	rows during their backoff or send a row a shard has already claimed a second
+	time. Runs after every migrate, as job syncing may re-create the job.
+	"""
+	for name in frappe.get_all("Scheduled Job Type", filters={"method": FRAPPE_QUEUE_FLUSH, "stopped": 0}, pluck="name"):
+		frappe.db.set_value("Scheduled Job Type", name, "stopped", 1)
+
+
+def before_uninstall():
+	"""Hands Email Queue flushing back to Frappe."""
+	for name in frappe.get_all("Scheduled Job Type", filters={"method": FRAPPE_QUEUE_FLUSH, "stopped": 1}, pluck="name"):
+		frappe.db.set_value("Scheduled Job Type", name, "stopped", 0)
+
+
+# Fields health_core adds to Email Account for multi-account routing
+EMAIL_ACCOUNT_CUSTOM_FIELDS = {
+	"Email Account": [
+		{
+			"fieldname": "health_core_routing",
+			"label": "Use for Health Core Routing",
+			"fieldtype": "Check",
+			"insert_after": "default_outgoing",
+			"depends_on": "enable_outgoing",
+			"description": "Share outgoing mail without a dedicated account with the other routing accounts, "
+				"weighted by latency, error rate and remaining quota"
+		},
+		{
+			"fieldname": "health_core_daily_quota",
+			"label": "Daily Send Quota",
+			"fieldtype": "Int",
+			"insert_after": "health_core_routing",
+			"depends_on": "health_core_routing",
+			"description": "Messages this account may send per day (0 for no limit)"
+		}
+	]
+}
+
+
+def setup_email_account_fields():
+	"""
+	Adds the routing pool custom fields to Email Account.
+	This function is idempotent - existing fields are updated in place.
+	"""
+	from frappe.custom.doctype.custom_field.custom_field import create_custom_fields
+
+	create_custom_fields(EMAIL_ACCOUNT_CUSTOM_FIELDS, update=True)
+
+
+# How setup_default_email_account verifies a created or updated account
+TEST_EMAIL_NOW = "now"
+TEST_EMAIL_DEFERRED = "deferred"
+TEST_EMAIL_NONE = "none"
+
+
+def setup_default_email_account(test_email=TEST_EMAIL_NOW):
 	"""
 	Creates or updates the default 4Geeks SMTP email account configuration.
 	This function is idempotent - it can be run multiple times safely.
+	
+	Args:
+		test_email (str): `now` sends the verification email before returning,
+			`deferred` enqueues it to run after the transaction commits,
+			`none` skips it
+	
+	Returns:
+		str: `created`, `updated`, `unchanged` or `skipped` (no SMTP credentials)
 	"""
 	
 	# Check if a default email account already exists
@@ -41,7 +201,7 @@ def setup_default_email_account():
 	
 	if not smtp_user or not smtp_password:
 		frappe.logger().warning("SMTP credentials not found in site configuration. Skipping email account setup.")
-		return
+		return "skipped"
 	
 	# 4Geeks SMTP configuration
 	email_account_data = {
@@ -79,9 +239,11 @@ def setup_default_email_account():
 				frappe.logger().info(f"Updated existing default email account: {existing_name}")
 				
 				# Send test email to verify configuration
-				send_test_email(email_account)
+				verify_email_account(email_account, test_email)
+				return "updated"
 			else:
 				frappe.logger().info("4Geeks SMTP configuration already exists and is set as default")
+				return "unchanged"
 				
 		except Exception as e:
 			frappe.logger().error(f"Error updating existing email account: {str(e)}")
@@ -95,13 +257,32 @@ def setup_default_email_account():
 			frappe.logger().info("Created new 4Geeks Health SMTP email account")
 			
 			# Send test email to verify configuration
-			send_test_email(email_account)
+			verify_email_account(email_account, test_email)
+			return "created"
 			
 		except Exception as e:
 			frappe.logger().error(f"Error creating new email account: {str(e)}")
 			raise
 
 
+def verify_email_account(email_account, test_email=TEST_EMAIL_NOW):
+	"""Sends, enqueues or skips the verification email for a saved Email Account."""
+	if test_email == TEST_EMAIL_NOW:
+		send_test_email(email_account)
+	elif test_email == TEST_EMAIL_DEFERRED:
+		frappe.enqueue(
+			"health_core.setup.install.send_account_test_email",
+			queue="short",
+			email_account=email_account.name,
+			enqueue_after_commit=True
+		)
+
+
+def send_account_test_email(email_account):
+	"""Background job: sends the verification email for an Email Account by name."""
+	send_test_email(frappe.get_doc("Email Account", email_account))
+
+
 def send_test_email(email_account):
 	"""
 	Sends a test email to verify the SMTP configuration is working.
@@ -129,36 +310,21 @@ def send_test_email(email_account):
 		
 		# Prepare test email content
 		subject = "4Geeks Health SMTP Configuration Test"
-		message = f"""
-		<p>Hello,</p>
-		
-		<p>This is a test email to confirm that your 4Geeks Health system has been successfully configured with the default SMTP service.</p>
-		
-		<p><strong>Configuration Details:</strong></p>
-		<ul>
-			<li>Email Account: {email_account.email_account_name}</li>
-			<li>SMTP Server: {email_account.smtp_server}</li>
-			<li>SMTP Port: {email_account.smtp_port}</li>
-			<li>From Email: {email_account.email_id}</li>
-		</ul>
-		
-		<p>Your system is now ready to send emails for patient communications, invoices, and reminders.</p>
-		
-		<p>If you need to modify these settings, you can do so by navigating to:</p>
-		<p><strong>Setup → Email → Email Account</strong></p>
-		
-		<p>Best regards,<br>
-		4Geeks Health System</p>
-		"""
+		message = render_template("smtp_setup_test_email", {
+			"email_account_name": email_account.email_account_name,
+			"smtp_server": email_account.smtp_server,
+			"smtp_port": email_account.smtp_port,
+			"email_id": email_account.email_id
+		})
 		
-		# Send the test email
-		frappe.sendmail(
+		# Send the test email over the pooled SMTP session
+		send_mail(
 			recipients=[admin_email],
 			subject=subject,
 			message=message,
+			email_account=email_account.name,
 			reference_doctype="Email Account",
-			reference_name=email_account.name,
-			now=True
+			reference_name=email_account.name
 		)
 		
 		frappe.logger().info(f"Test email sent successfully to {admin_email}")
@@ -184,28 +350,19 @@ def send_test_email(email_account):
 def create_audit_log(action, details, status="Success"):
 	"""
 	Creates an audit log entry for SMTP configuration operations.
+	The event is buffered and written to the Communication doctype in batches
+	by a background flusher, keeping the insert out of the request path.
 	
 	Args:
 		action (str): The action performed
 		details (str): Details about the action
 		status (str): Status of the action (Success/Failed)
 	"""
+	from health_core.utils.audit import log_event
+	
 	try:
-		# Create a Communication document for audit logging
-		audit_log = frappe.get_doc({
-			"doctype": "Communication",
-			"communication_type": "Automated Message",
-			"content": f"<p><strong>Action:</strong> {action}</p><p><strong>Details:</strong> {details}</p><p><strong>Status:</strong> {status}</p>",
-			"subject": f"Health Core SMTP Setup - {action}",
-			"sender": "Administrator",
-			"communication_medium": "Email",
-			"sent_or_received": "Sent",
-			"reference_doctype": "Email Account",
-			"status": "Linked"
-		})
-		
-		audit_log.insert(ignore_permissions=True)
-		frappe.logger().info(f"Audit log created for action: {action}")
+		log_event(action=action, details=details, status=status)
+		frappe.logger().info(f"Audit log queued for action: {action}")
 		
 	except Exception as e:
 		frappe.logger().error(f"Failed to create audit log: {str(e)}")
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+Fleet provisioning: creates or reconciles the default SMTP Email Account on
+many sites of a bench in parallel.
+
+Sites are handed to a process pool; each worker process initializes and
+connects to one site at a time, so sites never share a database connection.
+Verification emails are skipped or enqueued on each site's own queue instead
+of being sent inline.
+"""
+from __future__ import unicode_literals
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import frappe
+
+from health_core.setup.install import TEST_EMAIL_DEFERRED
+
+
+OK = "ok"
+SKIPPED = "skipped"
+FAILED = "failed"
+
+
+def provision_site(site, test_email=TEST_EMAIL_DEFERRED, sites_path="."):
+	"""
+	Runs `setup_default_email_account` on one site and commits.
+
+	Returns:
+		dict: `site`, `status` (ok, skipped or failed), `action`, `seconds` and `error`
+	"""
+	from health_core.setup.install import setup_default_email_account
+
+	start = time.perf_counter()
+	result = {"site": site, "status": OK, "action": "", "seconds": None, "error": ""}
+
+	try:
+		frappe.init(site=site, sites_path=sites_path)
+		frappe.connect()
+
+		if "health_core" not in frappe.get_installed_apps():
+			result.update({"status": SKIPPED, "action": "not installed"})
+		else:
+			result["action"] = setup_default_email_account(test_email=test_email)
+			frappe.db.commit()
+			if result["action"] == "skipped":
+				result.update({"status": SKIPPED, "action": "no credentials"})
+	except Exception as e:
+		if getattr(frappe.local, "db", None):
+			frappe.db.rollback()
+		result.update({"status": FAILED, "error": str(e) or type(e).__name__})
+	finally:
+		frappe.destroy()
+
+	result["seconds"] = round(time.perf_counter() - start, 2)
+	return result
+
+
+def provision_sites(sites, workers=None, test_email=TEST_EMAIL_DEFERRED, sites_path=".", on_result=None):
+	"""
+	Provisions `sites` on a pool of `workers` processes.
+
+	Args:
+		on_result (callable): Called with each site's result as it completes
+
+	Returns:
+		list: Per-site results, sorted by site
+	"""
+	results = []
+
+	with ProcessPoolExecutor(max_workers=workers) as executor:
+		futures = {
+			executor.submit(provision_site, site, test_email, sites_path): site
+			for site in sites
+		}
+		for future in as_completed(futures):
+			try:
+				result = future.result()
+			except Exception as e:
+				# The worker process itself died
+				result = {"site": futures[future], "status": FAILED, "action": "", "seconds": None,
+					"error": str(e) or type(e).__name__}
+			results.append(result)
+			if on_result:
+				on_result(result)
+
+	return sorted(results, key=lambda result: result["site"])
+
+
+def count_statuses(results):
+	counts = {OK: 0, SKIPPED: 0, FAILED: 0}
+	for result in results:
+		counts[result["status"]] += 1
+	return counts
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import json
+import unittest
+from unittest.mock import patch
+
+from health_core.tests.utils import FakeRedis
+
+
+class TestAuditBuffer(unittest.TestCase):
+	"""
+	Test cases for write-behind audit logging.
+	"""
+
+	def setUp(self):
+		self.redis = FakeRedis()
+		self.patchers = [
+			patch('frappe.cache', return_value=self.redis),
+			patch('health_core.utils.audit.enqueue_flush')
+		]
+		self.mocks = [patcher.start() for patcher in self.patchers]
+
+	def tearDown(self):
+		for patcher in self.patchers:
+			patcher.stop()
+
+	def test_events_buffered_not_inserted(self):
+		"""Test that logging an event does not write to the database"""
+		from health_core.utils.audit import log_event
+
+		with patch('health_core.utils.audit.write_events') as mock_write:
+			log_event("SMTP Test Email Sent", "details")
+
+		mock_write.assert_not_called()
+		self.assertEqual(len(self.redis.data["site|health_core:audit_buffer"]), 1)
+		# First event into an empty buffer schedules a flush
+		self.mocks[1].assert_called_once()
+
+	def test_buffer_is_bounded(self):
+		"""Test that the buffer drops the oldest events beyond its limit"""
+		import frappe
+		from health_core.utils.audit import log_event
+
+		with patch.dict(frappe.conf, {"audit_buffer_limit": 3}):
+			for i in range(5):
+				log_event("Action {0}".format(i), "details")
+
+		buffered = self.redis.data["site|health_core:audit_buffer"]
+		self.assertEqual(len(buffered), 3)
+		self.assertIn("Action 4", buffered[-1])
+
+	def test_flush_writes_in_batches(self):
+		"""Test that the flusher drains the buffer with bulk writes"""
+		import frappe
+		from health_core.utils.audit import log_event, flush_audit_buffer
+
+		for i in range(7):
+			log_event("Action {0}".format(i), "details")
+
+		with patch.dict(frappe.conf, {"audit_flush_batch_size": 3}), \
+				patch('health_core.utils.audit.write_events') as mock_write, \
+				patch('frappe.db'):
+			written = flush_audit_buffer()
+
+		self.assertEqual(written, 7)
+		self.assertEqual([len(call[0][0]) for call in mock_write.call_args_list], [3, 3, 1])
+		self.assertEqual(self.redis.data["site|health_core:audit_buffer"], [])
+
+	def test_held_events_moved_when_redis_returns(self):
+		"""Test that events held while Redis was down are pushed, in order, once it is back"""
+		from health_core.utils.audit import _local_buffer, log_event
+
+		self.addCleanup(_local_buffer.clear)
+		with patch.object(FakeRedis, 'pipeline', side_effect=ConnectionError):
+			log_event("Action 0", "details")
+			log_event("Action 1", "details")
+		self.assertNotIn("site|health_core:audit_buffer", self.redis.data)
+
+		log_event("Action 2", "details")
+
+		buffered = self.redis.data["site|health_core:audit_buffer"]
+		self.assertEqual([json.loads(item)["action"] for item in buffered], ["Action 0", "Action 1", "Action 2"])
+		self.assertFalse(any(_local_buffer.values()))
+
+	def test_flush_queued_once_until_it_runs(self):
+		"""Test that a waiting flush job is not queued again, and is again once it runs"""
+		# Use the real enqueue_flush
+		self.patchers.pop().stop()
+		from health_core.utils.audit import enqueue_flush, flush_audit_buffer
+		with patch('frappe.enqueue', create=True) as mock_enqueue:
+			enqueue_flush()
+			enqueue_flush()
+			self.assertEqual(mock_enqueue.call_count, 1)
+
+			flush_audit_buffer()
+			enqueue_flush()
+			self.assertEqual(mock_enqueue.call_count, 2)
+
+		self.assertNotIn("deduplicate", mock_enqueue.call_args[1])
+
+
+if __name__ == '__main__':
+	unittest.main()
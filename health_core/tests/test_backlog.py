@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import datetime
+import unittest
+from unittest.mock import patch
+
+import frappe
+
+
+class TestBacklog(unittest.TestCase):
+	"""
+	Test cases for Email Queue backlog analytics.
+	"""
+
+	def test_age_buckets_are_contiguous(self):
+		"""Test that every age falls into exactly one bucket"""
+		from health_core.utils.backlog import get_age_conditions
+
+		now = datetime.datetime(2026, 1, 1, 12, 0, 0)
+		columns, values = get_age_conditions(now)
+
+		self.assertEqual(len(columns), 5)
+		self.assertIn("creation > %(age_0)s", columns[0])
+		self.assertIn("creation > %(age_1)s and creation <= %(age_0)s", columns[1])
+		self.assertIn("creation <= %(age_3)s", columns[4])
+		self.assertEqual(values["age_3"], now - datetime.timedelta(days=1))
+
+	@patch('frappe.db.sql')
+	def test_aggregates(self, mock_sql):
+		"""Test that per-account aggregates roll up into totals without loading rows"""
+		from health_core.utils.backlog import compute_backlog
+
+		now = datetime.datetime(2026, 1, 1, 12, 0, 0)
+		mock_sql.side_effect = [
+			[frappe._dict(status="Sent", count=1000000), frappe._dict(status="Not Sent", count=7)],
+			[
+				frappe._dict(email_account="Relay", count=5, oldest=now - datetime.timedelta(hours=2),
+					under_1m=3, **{"1m_5m": 0, "5m_1h": 1, "1h_1d": 1, "over_1d": 0}),
+				frappe._dict(email_account="", count=2, oldest=now - datetime.timedelta(seconds=30),
+					under_1m=2, **{"1m_5m": 0, "5m_1h": 0, "1h_1d": 0, "over_1d": 0})
+			],
+			[frappe._dict(attempts=0, count=6), frappe._dict(attempts=2, count=1)]
+		]
+
+		backlog = compute_backlog(now)
+
+		self.assertEqual(backlog["pending"], 7)
+		self.assertEqual(backlog["oldest_pending_seconds"], 7200)
+		self.assertEqual(backlog["by_status"], {"Sent": 1000000, "Not Sent": 7})
+		self.assertEqual(backlog["by_age"]["under_1m"], 5)
+		self.assertEqual(backlog["by_age"]["1h_1d"], 1)
+		self.assertEqual(backlog["by_attempts"], {0: 6, 2: 1})
+		self.assertEqual([row["email_account"] for row in backlog["by_account"]], ["Relay", None])
+		self.assertTrue(all("group by" in call[0][0] for call in mock_sql.call_args_list))
+
+	def test_backlog_is_cached(self):
+		"""Test that repeated calls within the TTL reuse the cached aggregates"""
+		from health_core.utils.backlog import get_backlog
+
+		cache = {}
+		redis = type("Redis", (), {
+			"get_value": lambda self, key: cache.get(key),
+			"set_value": lambda self, key, value, expires_in_sec=None: cache.__setitem__(key, value)
+		})()
+
+		with patch('frappe.cache', return_value=redis), \
+				patch('health_core.utils.backlog.compute_backlog', return_value={"pending": 3}) as mock_compute:
+			self.assertEqual(get_backlog(), {"pending": 3})
+			self.assertEqual(get_backlog(), {"pending": 3})
+
+		mock_compute.assert_called_once()
+
+
+if __name__ == '__main__':
+	unittest.main()
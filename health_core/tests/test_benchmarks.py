@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import unittest
+
+
+class TestBenchmarks(unittest.TestCase):
+	"""
+	Test cases for the send-path benchmark suite and its stub SMTP server.
+	"""
+
+	def test_pool_reuses_stub_connections(self):
+		"""Test that pooled sends reuse one connection while unpooled sends open one each"""
+		from health_core.benchmarks.send_path import run_no_pool, run_pool
+		from health_core.benchmarks.stub_smtp import StubSMTPServer
+
+		with StubSMTPServer() as stub:
+			latencies, errors, duration = run_pool(stub, False, None, 1, 10, 512)
+			self.assertEqual((len(latencies), errors), (10, 0))
+			self.assertEqual(stub.stats["connections"], 1)
+
+			latencies, errors, duration = run_no_pool(stub, False, None, 1, 10, 512)
+			self.assertEqual((len(latencies), errors), (10, 0))
+			self.assertEqual(stub.stats["connections"], 11)
+			self.assertEqual(stub.stats["messages"], 20)
+
+	def test_injected_failures_are_counted(self):
+		"""Test that stub rejections show up as benchmark errors"""
+		from health_core.benchmarks.send_path import run_no_pool
+		from health_core.benchmarks.stub_smtp import StubSMTPServer
+
+		with StubSMTPServer(fail_rate=1.0) as stub:
+			latencies, errors, duration = run_no_pool(stub, False, None, 2, 6, 512)
+
+		self.assertEqual((len(latencies), errors), (0, 6))
+		self.assertEqual(stub.stats["rejected"], 6)
+
+	def test_compare_reports_flags_regressions(self):
+		"""Test throughput and p95 regression detection between two reports"""
+		from health_core.benchmarks.report import compare_reports, make_report, summarize
+
+		baseline = make_report([
+			summarize("pool", [0.01] * 100, 1.0, concurrency=4, size=1024),
+			summarize("no_pool", [0.05] * 100, 5.0, concurrency=4, size=1024)
+		])
+		current = make_report([
+			summarize("pool", [0.01] * 100, 1.05, concurrency=4, size=1024),
+			summarize("no_pool", [0.08] * 100, 8.0, concurrency=4, size=1024)
+		])
+
+		comparison = {row["scenario"]: row for row in compare_reports(baseline, current, threshold=0.1)}
+
+		self.assertFalse(comparison["pool"]["regression"])
+		self.assertTrue(comparison["no_pool"]["regression"])
+		self.assertEqual(comparison["no_pool"]["p95_change"], 0.6)
+
+	def test_load_level_counts_outcomes(self):
+		"""Test that a load level separates successes, errors and throttled calls per endpoint"""
+		from health_core.benchmarks.load_test import ALL, classify, parse_mix, run_level, summarize_level
+
+		responses = {
+			"get_smtp_status": (200, {"message": {"status": "success"}}),
+			"get_email_accounts": (200, {"message": {"status": "error", "message": "Error: boom"}}),
+			"send_test_email": (429, {"exc_type": "TooManyRequestsError"}),
+		}
+
+		class FakeClient(object):
+			def call(self, endpoint):
+				return classify(*responses[endpoint])
+
+		mix = parse_mix("get_smtp_status=2,get_email_accounts,send_test_email")
+		samples, duration = run_level(FakeClient, mix, 3, 0.05)
+		rows = {row["scenario"]: row for row in summarize_level(samples, duration, 3)}
+
+		self.assertEqual(rows["get_smtp_status"]["error_rate"], 0)
+		self.assertEqual(rows["get_email_accounts"]["error_rate"], 1)
+		self.assertEqual(rows["send_test_email"]["operations"], 0)
+		self.assertGreater(rows["send_test_email"]["throttled"], 0)
+		self.assertEqual(
+			rows[ALL]["operations"],
+			rows["get_smtp_status"]["operations"] + rows["get_email_accounts"]["operations"]
+		)
+		self.assertTrue(all(row["concurrency"] == 3 for row in rows.values()))
+		self.assertRaises(ValueError, parse_mix, "get_metrics=1")
+
+	def test_find_saturation(self):
+		"""Test that saturation is the first level where throughput stops growing or errors appear"""
+		from health_core.benchmarks.load_test import find_saturation
+		from health_core.benchmarks.report import summarize
+
+		def level(endpoint, concurrency, ops, errors=0):
+			row = summarize(endpoint, [concurrency / 1000.0] * ops, 1.0, errors, concurrency=concurrency)
+			row["error_rate"] = errors / float(ops + errors)
+			return row
+
+		results = [
+			level("get_smtp_status", 1, 100), level("get_smtp_status", 2, 190),
+			level("get_smtp_status", 4, 360), level("get_smtp_status", 8, 370),
+			level("send_test_email", 1, 50), level("send_test_email", 2, 95, errors=5),
+			level("get_email_accounts", 1, 100), level("get_email_accounts", 2, 200),
+		]
+
+		saturation = {row["endpoint"]: row for row in find_saturation(results)}
+
+		self.assertEqual(
+			(saturation["get_smtp_status"]["peak_concurrency"], saturation["get_smtp_status"]["saturated_at"]), (4, 8)
+		)
+		self.assertEqual(saturation["get_smtp_status"]["reason"], "throughput")
+		self.assertEqual((saturation["send_test_email"]["saturated_at"], saturation["send_test_email"]["reason"]), (2, "errors"))
+		self.assertIsNone(saturation["get_email_accounts"]["saturated_at"])
+		self.assertEqual(saturation["get_email_accounts"]["peak_ops_per_sec"], 200)
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import smtplib
+import unittest
+from unittest.mock import MagicMock, patch
+
+from health_core.tests.test_smtp_pool import make_settings
+
+
+class TestBulkEmail(unittest.TestCase):
+	"""
+	Test cases for bulk multi-recipient sending.
+	"""
+
+	def setUp(self):
+		# Send outcomes feed routing stats in Redis; covered in test_routing
+		patcher = patch('health_core.utils.bulk_email.record_send')
+		self.mock_record_send = patcher.start()
+		self.addCleanup(patcher.stop)
+
+	def test_parse_and_validate_recipients(self):
+		"""Test parsing, de-duplication and validation of recipient lists"""
+		from health_core.utils.bulk_email import parse_recipients, validate_recipients
+
+		recipients = parse_recipients("a@example.com, B@example.com;\nb@EXAMPLE.com not-an-email c@example")
+		valid, invalid = validate_recipients(recipients)
+
+		self.assertEqual(valid, ["a@example.com", "B@example.com"])
+		self.assertEqual(invalid, ["not-an-email", "c@example"])
+		self.assertEqual(parse_recipients('["x@example.com"]'), ["x@example.com"])
+
+	def test_groups_share_one_message(self):
+		"""Test that recipients are grouped into as few SMTP transactions as allowed"""
+		from health_core.utils.bulk_email import _send_groups
+
+		pool = MagicMock()
+		pool.send.return_value = {}
+		valid = ["user{0}@example.com".format(i) for i in range(250)]
+
+		outcomes = list(_send_groups(pool, "key", make_settings(), b"msg", valid, [], 100))
+
+		self.assertEqual(pool.send.call_count, 3)
+		self.assertEqual([len(call[0][3]) for call in pool.send.call_args_list], [100, 100, 50])
+		self.assertTrue(all(outcome["status"] == "sent" for outcome in outcomes))
+
+	def test_per_recipient_outcomes(self):
+		"""Test that refusals and failures are reported per recipient"""
+		from health_core.utils.bulk_email import _send_groups
+
+		pool = MagicMock()
+		pool.send.side_effect = [
+			{"b@example.com": (550, b"No such user")},
+			smtplib.SMTPRecipientsRefused({
+				"c@example.com": (550, b"No such user"),
+				"d@example.com": (550, b"No such user")
+			}),
+			smtplib.SMTPServerDisconnected("Connection lost")
+		]
+
+		outcomes = list(_send_groups(
+			pool, "key", make_settings(), b"msg",
+			["a@example.com", "b@example.com", "c@example.com", "d@example.com", "e@example.com"], ["bad"], 2
+		))
+		statuses = {outcome["recipient"]: outcome["status"] for outcome in outcomes}
+
+		self.assertEqual(statuses, {
+			"bad": "invalid",
+			"a@example.com": "sent",
+			"b@example.com": "failed",
+			"c@example.com": "failed",
+			"d@example.com": "failed",
+			"e@example.com": "failed"
+		})
+		self.assertEqual(self.mock_record_send.call_count, 3)
+
+
+	def test_audit_logged_after_sending(self):
+		"""Test that the bulk send audit entry is written with the real outcome, after the sends"""
+		from health_core.utils.smtp_manager import send_bulk_email
+
+		sent = []
+
+		def outcomes():
+			for address in ("a@example.com", "b@example.com"):
+				sent.append(address)
+				yield {"recipient": address, "status": "failed", "error": "550"}
+
+		def create_audit_log(action, details, status):
+			self.assertEqual(len(sent), 2)
+			audits.append((status, details))
+
+		audits = []
+		with patch('frappe.has_permission', return_value=True), \
+				patch('health_core.utils.bulk_email.iter_bulk_send',
+					return_value=({"valid": 2, "invalid": 0, "email_account": "Relay"}, outcomes())), \
+				patch('health_core.setup.install.create_audit_log', side_effect=create_audit_log):
+			# Past the rate limit and timing decorators
+			result = send_bulk_email.__wrapped__.__wrapped__(["a@example.com", "b@example.com"], "Notice", "<p>Closed</p>")
+
+		self.assertEqual(result["status"], "partial")
+		self.assertEqual(audits, [("Failed", "Bulk email 'Notice' from Relay by user Administrator: 0 sent, 2 failed, 0 invalid")])
+
+
+if __name__ == '__main__':
+	unittest.main()
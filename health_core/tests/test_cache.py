@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import json
+import time
+import unittest
+from unittest.mock import patch, MagicMock
+
+from health_core.tests.utils import FakeRedis
+
+
+class TestStatusCache(unittest.TestCase):
+	"""
+	Test cases for cached SMTP status and Email Account version invalidation.
+	"""
+
+	def setUp(self):
+		from health_core.utils.cache import clear_local_cache
+
+		clear_local_cache()
+		self.redis = FakeRedis()
+		self.patcher = patch('frappe.cache', return_value=self.redis)
+		self.patcher.start()
+
+	def tearDown(self):
+		self.patcher.stop()
+
+	def test_value_computed_once(self):
+		"""Test that repeated reads do not call the generator again"""
+		from health_core.utils.cache import get_versioned_value
+
+		generator = MagicMock(return_value={"status": "success"})
+
+		for i in range(5):
+			self.assertEqual(get_versioned_value("key", generator, 60), {"status": "success"})
+
+		generator.assert_called_once()
+
+	def test_version_bump_invalidates(self):
+		"""Test that an Email Account change forces a recompute"""
+		from health_core.utils.cache import get_versioned_value, bump_email_account_version
+
+		generator = MagicMock(side_effect=[{"configured": False}, {"configured": True}])
+		self.assertFalse(get_versioned_value("key", generator, 60)["configured"])
+
+		# Run the after_commit callback immediately
+		with patch('frappe.db') as mock_db:
+			mock_db.after_commit.add.side_effect = lambda callback: callback()
+			bump_email_account_version()
+
+		self.assertTrue(get_versioned_value("key", generator, 60)["configured"])
+		self.assertEqual(generator.call_count, 2)
+
+	def test_cached_value_is_copied(self):
+		"""Test that callers cannot mutate the cached value"""
+		from health_core.utils.cache import get_versioned_value
+
+		generator = MagicMock(return_value={"accounts": []})
+		get_versioned_value("key", generator, 60)["accounts"].append("mutated")
+
+		self.assertEqual(get_versioned_value("key", generator, 60), {"accounts": []})
+
+
+	def test_conditional_response(self):
+		"""Test that a matching If-None-Match gets a 304 without building the payload"""
+		import frappe
+		from health_core.utils.cache import get_conditional_response
+
+		generator = MagicMock(return_value={"status": "success", "accounts": []})
+		self.redis.data["site|health_core:email_account_version"] = 7
+
+		with patch.object(frappe.local, "request", MagicMock(), create=True):
+			with patch('frappe.get_request_header', return_value=None):
+				response = get_conditional_response("guest", generator)
+			self.assertEqual(response.status_code, 200)
+			self.assertEqual(response.headers["ETag"], '"guest-7"')
+			self.assertEqual(json.loads(response.get_data())["message"]["status"], "success")
+
+			with patch('frappe.get_request_header', return_value='W/"guest-7"'):
+				response = get_conditional_response("guest", generator)
+			self.assertEqual(response.status_code, 304)
+
+			with patch('frappe.get_request_header', return_value='"guest-6"'):
+				response = get_conditional_response("guest", generator)
+			self.assertEqual(response.status_code, 200)
+
+		generator.assert_called_once_with(7)
+
+	def test_lost_version_not_reused(self):
+		"""Test that a counter lost to eviction or a Redis restart never restarts below old versions"""
+		from health_core.utils.cache import get_email_account_version, get_versioned_value
+
+		generator = MagicMock(side_effect=[{"configured": False}, {"configured": True}])
+		before = get_email_account_version()
+		self.assertFalse(get_versioned_value("key", generator, 60)["configured"])
+
+		# Redis evicts every key; this process still holds its local entry
+		self.redis.data.clear()
+		with patch('time.time', return_value=time.time() + 1):
+			self.assertGreater(get_email_account_version(), before)
+			self.assertTrue(get_versioned_value("key", generator, 60)["configured"])
+
+
+if __name__ == '__main__':
+	unittest.main()
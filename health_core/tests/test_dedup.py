@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import unittest
+from unittest.mock import MagicMock, patch
+
+import frappe
+
+from health_core.tests.utils import FakeRedis
+
+
+MIME = """Content-Type: multipart/alternative; boundary="==============={boundary}=="
+MIME-Version: 1.0
+From: Clinic <clinic@example.com>
+To: patient@example.com
+Subject: Appointment confirmed
+Date: {date}
+Message-Id: <{message_id}@example.com>
+
+--==============={boundary}==
+Content-Type: text/html; charset="utf-8"
+
+<p>See you on Monday at 10:00</p>
+--==============={boundary}==--
+"""
+
+
+class TestDedup(unittest.TestCase):
+	"""
+	Test cases for enqueue-time email deduplication.
+	"""
+
+	def setUp(self):
+		self.redis = FakeRedis()
+		status_field = frappe._dict(options="\nNot Sent\nSending\nSent\nPartially Sent\nError\nExpired\nCancelled")
+		self.patchers = [
+			patch('frappe.cache', return_value=self.redis),
+			patch('frappe.get_meta', return_value=MagicMock(get_field=MagicMock(return_value=status_field)), create=True),
+			patch.object(frappe, "db", MagicMock()),
+			patch.dict(frappe.conf, {"email_dedup_window": 60})
+		]
+		for patcher in self.patchers:
+			patcher.start()
+
+	def tearDown(self):
+		for patcher in self.patchers:
+			patcher.stop()
+
+	def test_message_hash(self):
+		"""Test that the hash ignores recipient order and case but not content"""
+		from health_core.utils.dedup import message_hash
+
+		digest = message_hash(["a@example.com", "B@example.com"], "Subject", "<p>Hi</p>", "Account")
+
+		self.assertEqual(len(digest), 32)
+		self.assertEqual(digest, message_hash(["b@example.com", "a@example.com"], "Subject", "<p>Hi</p>", "Account"))
+		self.assertNotEqual(digest, message_hash(["a@example.com", "b@example.com"], "Subject", "<p>Hello</p>", "Account"))
+		self.assertNotEqual(digest, message_hash(["a@example.com", "b@example.com"], "Subject", "<p>Hi</p>", "Other"))
+
+	def test_duplicates_merged_into_first_job(self):
+		"""Test that a repeated test email returns the first job instead of queueing another"""
+		from health_core.utils.email_jobs import enqueue_email_job
+
+		with patch('frappe.enqueue') as mock_enqueue, \
+				patch('health_core.utils.email_jobs.set_job_status'), \
+				patch('health_core.utils.dedup.inc') as mock_inc:
+			first = enqueue_email_job("to@example.com", "Test", "<p>12:00:01</p>", "Relay", dedup_content="smtp_test_email")
+			second = enqueue_email_job("to@example.com", "Test", "<p>12:00:02</p>", "Relay", dedup_content="smtp_test_email")
+			other = enqueue_email_job("other@example.com", "Test", "<p>12:00:02</p>", "Relay", dedup_content="smtp_test_email")
+
+		self.assertEqual(first, second)
+		self.assertNotEqual(first, other)
+		self.assertEqual(mock_enqueue.call_count, 2)
+		mock_inc.assert_called_once_with("health_core_email_duplicates_total", source="job")
+
+		with patch.dict(frappe.conf, {"email_dedup_window": 0}), \
+				patch('frappe.enqueue'), patch('health_core.utils.email_jobs.set_job_status'):
+			self.assertNotEqual(enqueue_email_job("to@example.com", "Test", "x", "Relay", dedup_content="smtp_test_email"), first)
+
+	def make_row(self, boundary, date, message_id):
+		return frappe._dict(
+			status="Not Sent",
+			sender="clinic@example.com",
+			reference_doctype="Patient Appointment",
+			reference_name="APT-0001",
+			recipients=[frappe._dict(recipient="patient@example.com")],
+			message=MIME.format(boundary=boundary, date=date, message_id=message_id)
+		)
+
+	def test_queue_row_cancelled(self):
+		"""Test that an Email Queue row identical but for Message-Id, Date and boundary is cancelled"""
+		from health_core.utils.dedup import cancel_duplicate
+
+		first = self.make_row("1111111111111111111", "Mon, 05 Jan 2026 10:00:00 +0000", "abc")
+		second = self.make_row("2222222222222222222", "Mon, 05 Jan 2026 10:00:03 +0000", "def")
+
+		cancel_duplicate(first)
+		cancel_duplicate(second)
+
+		self.assertEqual(first.status, "Not Sent")
+		self.assertEqual(second.status, "Cancelled")
+
+	def test_rolled_back_row_releases_claim(self):
+		"""Test that a row whose insert rolls back does not cancel the retried insert"""
+		from health_core.utils.dedup import cancel_duplicate
+
+		cancel_duplicate(self.make_row("1111111111111111111", "Mon, 05 Jan 2026 10:00:00 +0000", "abc"))
+		frappe.db.after_rollback.add.assert_called_once()
+		# The transaction rolls back
+		frappe.db.after_rollback.add.call_args[0][0]()
+
+		retried = self.make_row("2222222222222222222", "Mon, 05 Jan 2026 10:00:03 +0000", "def")
+		cancel_duplicate(retried)
+
+		self.assertEqual(retried.status, "Not Sent")
+
+	def test_local_fallback_expires(self):
+		"""Test the in-process stand-in used while Redis is unreachable"""
+		from health_core.utils.dedup import claim_local
+
+		self.assertIsNone(claim_local("digest", "job-1", 60, now=1000))
+		self.assertEqual(claim_local("digest", "job-2", 60, now=1030), "job-1")
+		self.assertIsNone(claim_local("digest", "job-3", 60, now=1061))
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import frappe
+import smtplib
+import unittest
+from unittest.mock import patch
+
+
+class TestEmailJobs(unittest.TestCase):
+	"""
+	Test cases for background test email jobs.
+	"""
+
+	def setUp(self):
+		self.jobs = {}
+		self.patchers = [
+			patch('health_core.utils.email_jobs.get_job', side_effect=lambda job_id: self.jobs.get(job_id)),
+			patch('health_core.utils.email_jobs.set_job_status', side_effect=self.jobs.__setitem__),
+			patch('frappe.enqueue')
+		]
+		for patcher in self.patchers:
+			patcher.start()
+
+	def tearDown(self):
+		for patcher in self.patchers:
+			patcher.stop()
+
+	def test_enqueue_returns_immediately(self):
+		"""Test that queueing a test email records a queued job without sending"""
+		from health_core.utils.email_jobs import enqueue_email_job
+
+		with patch('health_core.utils.email_jobs.send_mail') as mock_send_mail:
+			job_id = enqueue_email_job("to@example.com", "Subject", "<p>Body</p>", "Test Account")
+
+		mock_send_mail.assert_not_called()
+		frappe.enqueue.assert_called_once()
+		self.assertEqual(self.jobs[job_id]["status"], "queued")
+
+	def test_failed_job_records_error(self):
+		"""Test that a failed send is recorded with its error and timings"""
+		from health_core.utils.email_jobs import run_email_job, get_job_status
+
+		with patch('health_core.utils.email_jobs.send_mail', side_effect=smtplib.SMTPAuthenticationError(535, b"Bad credentials")):
+			run_email_job("job1", "to@example.com", "Subject", "<p>Body</p>", "Test Account")
+
+		job = get_job_status("job1", public=True)
+		self.assertEqual(job["status"], "failed")
+		self.assertIn("Bad credentials", job["error"])
+		self.assertIn("total", job["timings"])
+		self.assertNotIn("recipient", job)
+
+	def test_unknown_job(self):
+		"""Test that an unknown job id returns an error"""
+		from health_core.utils.email_jobs import get_job_status
+
+		self.assertEqual(get_job_status("missing")["status"], "error")
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import time
+import unittest
+from unittest.mock import patch
+
+import frappe
+
+
+def make_result(claimed=0, sent=0):
+	return {"claimed": claimed, "sent": sent, "failed": claimed - sent, "deferred": 0, "more": False}
+
+
+class TestFlushScheduler(unittest.TestCase):
+	"""
+	Test cases for the adaptive Email Queue flush schedule.
+	"""
+
+	def setUp(self):
+		from health_core.utils.flush_scheduler import get_bounds
+
+		with patch.dict(frappe.conf, {"email_flush_min_interval": 0.5, "email_flush_max_interval": 240,
+				"email_flush_min_batch": 10, "email_flush_max_batch": 1000, "email_flush_target_seconds": 10}):
+			self.bounds = get_bounds()
+
+	def test_schedule_follows_load(self):
+		"""Test that a backlog speeds flushes up and grows batches, and an idle queue slows them down"""
+		from health_core.utils.flush_scheduler import adjust, initial_state
+
+		state = dict(initial_state(self.bounds), interval=60)
+
+		# Burst: 5000 rows waiting, 50 rows/second measured
+		for depth in (5000, 4500, 4000):
+			state = adjust(state, depth, make_result(100, 100), 2.0, self.bounds)
+		self.assertEqual(state["interval"], 7.5)
+		self.assertEqual(state["batch_size"], 500)
+
+		for i in range(5):
+			state = adjust(state, 3000, make_result(500, 500), 10.0, self.bounds)
+		self.assertEqual(state["interval"], 0.5)
+
+		# Drained: back off towards the ceiling and shrink the batch
+		for i in range(12):
+			state = adjust(state, 0, make_result(20, 20), 0.4, self.bounds)
+		self.assertEqual(state["interval"], 240)
+		self.assertEqual(state["batch_size"], 10)
+		self.assertTrue(state["idle"])
+
+	def test_stalled_queue_backs_off(self):
+		"""Test that rows nobody can send slow the schedule down without shrinking the batch"""
+		from health_core.utils.flush_scheduler import adjust, initial_state
+
+		state = dict(initial_state(self.bounds), interval=2, batch_size=300)
+		state = adjust(state, 800, make_result(300, 0), 30.0, self.bounds)
+
+		self.assertEqual((state["interval"], state["batch_size"], state["idle"]), (4, 300, False))
+
+	def test_tick_skipped_until_due(self):
+		"""Test that ticks before the next run do nothing unless mail arrived while idle"""
+		from health_core.utils.flush_scheduler import adaptive_flush
+
+		state = {"interval": 120, "batch_size": 10, "rate": 0.0, "next_run": time.time() + 100, "idle": False}
+
+		with patch('health_core.utils.queue_worker.is_worker_running', return_value=False), \
+				patch('health_core.utils.flush_scheduler.get_state', side_effect=lambda bounds=None: dict(state)), \
+				patch('health_core.utils.flush_scheduler.get_pending_depth', return_value=1), \
+				patch('health_core.utils.flush_scheduler.acquire_lock', return_value=True), \
+				patch('health_core.utils.flush_scheduler.release_lock'), \
+				patch('health_core.utils.flush_scheduler.save_state'), \
+				patch('health_core.utils.queue_flush.flush_queue', return_value=make_result(1, 1)) as mock_flush:
+			self.assertIsNone(adaptive_flush())
+			mock_flush.assert_not_called()
+
+			state["idle"] = True
+			self.assertIsNotNone(adaptive_flush())
+			mock_flush.assert_called_once_with(10)
+
+
+if __name__ == '__main__':
+	unittest.main()
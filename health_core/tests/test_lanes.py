@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import unittest
+from unittest.mock import patch
+
+import frappe
+
+
+class TestLanes(unittest.TestCase):
+	"""
+	Test cases for Email Queue priority lanes.
+	"""
+
+	def test_lane_classification(self):
+		"""Test that rows are tagged high, normal or bulk when enqueued"""
+		from health_core.utils.lanes import email_lane, get_lane, set_lane
+
+		self.assertEqual(get_lane(frappe._dict(reference_doctype="User", priority=1)), "high")
+		self.assertEqual(get_lane(frappe._dict(reference_doctype="Newsletter", priority=1)), "bulk")
+		self.assertEqual(get_lane(frappe._dict(add_unsubscribe_link=1, priority=1)), "bulk")
+		self.assertEqual(get_lane(frappe._dict(priority=0)), "bulk")
+		self.assertEqual(get_lane(frappe._dict(priority=1, recipients=[{}] * 50)), "bulk")
+		self.assertEqual(get_lane(frappe._dict(priority=1, recipients=[{}])), "normal")
+
+		# Reminder campaigns stay out of the high lane whatever they reference
+		self.assertEqual(get_lane(frappe._dict(reference_doctype="User", add_unsubscribe_link=1, priority=1)), "bulk")
+		self.assertEqual(get_lane(frappe._dict(reference_doctype="Patient Appointment", priority=1, recipients=[{}])), "normal")
+		with email_lane("high"):
+			self.assertEqual(get_lane(frappe._dict(reference_doctype="Patient Appointment", priority=1)), "high")
+
+		with patch.dict(frappe.conf, {"email_lane_doctypes": {"Lab Result": "high"}}):
+			self.assertEqual(get_lane(frappe._dict(reference_doctype="Lab Result")), "high")
+
+		doc = frappe._dict(reference_doctype="Newsletter")
+		with email_lane("high"):
+			set_lane(doc)
+		self.assertEqual(doc.health_core_lane, "high")
+		self.assertIsNone(frappe.flags.health_core_email_lane)
+
+	def test_weighted_split(self):
+		"""Test that normal gets its weighted share of the space the high lane leaves"""
+		from health_core.utils.lanes import split_remaining
+
+		self.assertEqual(split_remaining(100), 75)
+		with patch.dict(frappe.conf, {"email_lane_weights": {"normal": 1, "bulk": 1}}):
+			self.assertEqual(split_remaining(9), 5)
+
+	def test_slo_misses_counted(self):
+		"""Test that lane latency beyond the lane's SLO is counted as a miss"""
+		from health_core.utils.lanes import record_sent
+
+		with patch('health_core.utils.lanes.observe') as mock_observe, \
+				patch('health_core.utils.lanes.inc') as mock_inc:
+			record_sent("high", 5)
+			record_sent("high", 45)
+			record_sent("bulk", 45)
+
+		self.assertEqual(mock_observe.call_count, 3)
+		mock_inc.assert_called_once_with("health_core_lane_slo_missed_total", lane="high")
+
+
+if __name__ == '__main__':
+	unittest.main()
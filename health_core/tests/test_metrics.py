@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import unittest
+
+
+class TestMetrics(unittest.TestCase):
+	"""
+	Test cases for per-worker metrics and their Prometheus rendering.
+	"""
+
+	def test_histogram_rendering(self):
+		"""Test that histogram buckets are cumulative and labelled by worker"""
+		from health_core.utils.metrics import Registry, format_labels, render
+
+		registry = Registry(buckets=(0.1, 1.0))
+		for value in (0.05, 0.5, 0.5, 3.0):
+			registry.observe("health_core_smtp_phase_seconds", value, format_labels({"phase": "send"}))
+		registry.inc("health_core_emails_sent_total", 4, format_labels({"path": "direct"}))
+
+		text = render({"web:1": registry.snapshot()}, queue_depth=[("Not Sent", 7)], send_rate=0.5)
+
+		self.assertIn('health_core_smtp_phase_seconds_bucket{phase="send",worker="web:1",le="0.1"} 1', text)
+		self.assertIn('health_core_smtp_phase_seconds_bucket{phase="send",worker="web:1",le="1.0"} 3', text)
+		self.assertIn('health_core_smtp_phase_seconds_bucket{phase="send",worker="web:1",le="+Inf"} 4', text)
+		self.assertIn('health_core_smtp_phase_seconds_count{phase="send",worker="web:1"} 4', text)
+		self.assertIn('health_core_emails_sent_total{path="direct",worker="web:1"} 4', text)
+		self.assertIn('health_core_email_queue{status="Not Sent"} 7', text)
+		self.assertIn("# TYPE health_core_smtp_phase_seconds histogram", text)
+		self.assertEqual(text.count("# TYPE health_core_smtp_phase_seconds"), 1)
+
+	def test_timed_endpoint_counts_errors(self):
+		"""Test that endpoint calls are timed and error responses counted"""
+		from health_core.utils.metrics import get_registry, timed_endpoint
+
+		@timed_endpoint
+		def endpoint(fail=False):
+			return {"status": "error" if fail else "success"}
+
+		registry = get_registry()
+		registry.counters.clear()
+		registry.histograms.clear()
+
+		endpoint()
+		endpoint(fail=True)
+
+		labels = 'endpoint="test_metrics.endpoint"'
+		self.assertEqual(registry.histograms[("health_core_endpoint_seconds", labels)]["count"], 2)
+		self.assertEqual(registry.counters[("health_core_endpoint_errors_total", labels)], 1)
+
+	def test_smtp_phases_recorded(self):
+		"""Test that SMTP phases land in both the caller's timings and the histogram"""
+		from health_core.utils.metrics import get_registry
+		from health_core.utils.smtp_pool import timed_phase
+
+		registry = get_registry()
+		registry.histograms.clear()
+		timings = {}
+
+		with timed_phase(timings, "auth"):
+			pass
+		with timed_phase(None, "auth"):
+			pass
+
+		self.assertIn("auth", timings)
+		self.assertEqual(registry.histograms[("health_core_smtp_phase_seconds", 'phase="auth"')]["count"], 2)
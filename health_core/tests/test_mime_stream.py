@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import email
+import email.policy
+import io
+import os
+import tempfile
+import unittest
+from email.message import EmailMessage
+
+from health_core.utils.smtp_pool import SMTPConnectionPool, SMTPSettings
+
+
+class ReadOnceStream(io.RawIOBase):
+	"""A non-seekable binary stream, like a file-store or HTTP response body."""
+
+	def __init__(self, data):
+		self._data = io.BytesIO(data)
+
+	def readable(self):
+		return True
+
+	def readinto(self, buffer):
+		chunk = self._data.read(len(buffer))
+		buffer[:len(chunk)] = chunk
+		return len(chunk)
+
+
+def make_message(attachments):
+	from health_core.utils.mime_stream import StreamingMessage
+
+	headers = EmailMessage()
+	headers["From"] = "clinic@example.com"
+	headers["To"] = "patient@example.com"
+	headers["Subject"] = "Your lab results"
+
+	body = EmailMessage()
+	body.set_content("Results attached\n.\nThanks")
+	body.add_alternative("<p>Results attached</p>", subtype="html")
+
+	return StreamingMessage(headers, body, attachments)
+
+
+class TestStreamingMessage(unittest.TestCase):
+	"""
+	Test cases for the memory-bounded streaming MIME builder.
+	"""
+
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.path = os.path.join(self.directory, "results.pdf")
+		self.content = os.urandom(3 * 1024 * 1024 + 11)
+		with open(self.path, "wb") as f:
+			f.write(self.content)
+
+	def tearDown(self):
+		os.remove(self.path)
+		os.rmdir(self.directory)
+
+	def test_chunks_are_bounded(self):
+		"""Test that a large attachment is encoded in small chunks whose total matches the SIZE estimate"""
+		from health_core.utils.mime_stream import CHUNK_SIZE
+
+		with make_message([self.path, {"fname": "note.txt", "fcontent": "short"}]) as msg:
+			chunks = list(msg.iter_chunks())
+			size = msg.size()
+
+		self.assertLessEqual(max(len(chunk) for chunk in chunks), CHUNK_SIZE * 2)
+		self.assertEqual(sum(len(chunk) for chunk in chunks), size)
+		self.assertTrue(all(chunk.endswith(b"\r\n") for chunk in chunks))
+
+	def test_streamed_to_stub_server(self):
+		"""Test that mapped and spooled attachments arrive intact and the message can be replayed"""
+		from health_core.benchmarks.stub_smtp import StubSMTPServer
+
+		with StubSMTPServer(keep_messages=True) as stub:
+			settings = SMTPSettings(
+				host="127.0.0.1", port=stub.port, use_tls=0, use_ssl=0, login=None, password=None,
+				email_id="clinic@example.com", sender_name="Clinic", timeout=5, modified="1"
+			)
+			pool = SMTPConnectionPool()
+			with make_message([self.path, {"fname": "scan.bin", "fileobj": ReadOnceStream(self.content[:100000])}]) as msg:
+				for i in range(2):
+					refused = pool.send(("test.local", "Clinic"), settings, "clinic@example.com", ["patient@example.com"], msg)
+					self.assertEqual(refused, {})
+			pool.close_all()
+
+		self.assertEqual(len(stub.messages), 2)
+		self.assertEqual(stub.messages[0], stub.messages[1])
+
+		received = email.message_from_bytes(stub.messages[0], policy=email.policy.default)
+		parts = [part for part in received.walk() if part.get_filename()]
+		self.assertEqual([part.get_filename() for part in parts], ["results.pdf", "scan.bin"])
+		self.assertEqual(parts[0].get_content_type(), "application/pdf")
+		self.assertEqual(parts[0].get_payload(decode=True), self.content)
+		self.assertEqual(parts[1].get_payload(decode=True), self.content[:100000])
+		self.assertIn("Results attached\n.\nThanks", received.get_body(("plain",)).get_content().replace("\r\n", "\n"))
+
+
+if __name__ == '__main__':
+	unittest.main()
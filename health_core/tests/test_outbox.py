@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+
+import frappe
+
+
+def make_payload(i):
+	return json.dumps({"id": str(i), "kwargs": {"recipients": ["patient{0}@example.com".format(i)]}}).encode()
+
+
+class TestOutbox(unittest.TestCase):
+	"""
+	Test cases for the local outbox journal and its ingester.
+	"""
+
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, self.directory)
+
+	def write(self, count, segment_size=1024 * 1024):
+		from health_core.utils.outbox import OutboxWriter
+
+		writer = OutboxWriter(self.directory, segment_size=segment_size, fsync_interval=0)
+		for i in range(count):
+			writer.append(make_payload(i))
+		writer.close()
+
+	def read_all(self):
+		from health_core.utils.outbox import list_segments, read_records, seal_active_segment
+
+		seal_active_segment(self.directory)
+		records = []
+		for path in list_segments(self.directory):
+			with open(path, "rb") as f:
+				records.extend(read_records(f.read())[0])
+		return records
+
+	def test_segments_rotate_in_order(self):
+		"""Test that appends roll over into sealed segments and read back in order"""
+		from health_core.utils.outbox import list_segments
+
+		self.write(100, segment_size=1000)
+
+		self.assertGreater(len(list_segments(self.directory)), 5)
+		self.assertEqual(self.read_all(), [make_payload(i) for i in range(100)])
+
+	def test_torn_and_corrupt_records_skipped(self):
+		"""Test that the reader resynchronises after a torn tail or a corrupt record"""
+		from health_core.utils.outbox import frame, read_records
+
+		good = [frame(make_payload(i)) for i in range(3)]
+		corrupt = bytearray(frame(make_payload(99)))
+		corrupt[-2] ^= 0xFF
+		data = good[0] + bytes(corrupt) + b"garbage" + good[1] + good[2][:-5]
+
+		records, skipped = read_records(data)
+
+		self.assertEqual(records, [make_payload(0), make_payload(1)])
+		self.assertEqual(skipped, len(corrupt) + len(b"garbage") + len(good[2]) - 5)
+
+	def test_ingest_resumes_after_crash(self):
+		"""Test that a crashed ingest resumes from the last committed batch and removes the segment"""
+		from health_core.utils.outbox import ingest_outbox, list_segments
+
+		self.write(250)
+		delivered = []
+
+		def crash_at_220(record, mode):
+			if len(delivered) == 220:
+				raise KeyboardInterrupt
+			delivered.append(record["id"])
+
+		with patch.dict(frappe.conf, {"email_outbox_dir": self.directory, "email_outbox_batch_size": 100}), \
+				patch.object(frappe, "db", MagicMock()):
+			with patch('health_core.utils.outbox.deliver', side_effect=crash_at_220):
+				self.assertRaises(KeyboardInterrupt, ingest_outbox)
+
+			# Batch 201-220 was never committed and is delivered again
+			del delivered[200:]
+			with patch('health_core.utils.outbox.deliver', side_effect=lambda record, mode: delivered.append(record["id"])):
+				self.assertEqual(ingest_outbox(), 50)
+
+		self.assertEqual(delivered, [str(i) for i in range(250)])
+		self.assertEqual(list_segments(self.directory), [])
+		self.assertEqual(os.listdir(self.directory), [".lock"])
+
+	def test_sendmail_journals_when_enabled(self):
+		"""Test that sendmail acknowledges from the journal, and falls back for immediate or binary mail"""
+		from health_core.utils.outbox import _writers, sendmail
+
+		frappe.sendmail = MagicMock(return_value=None)
+		self.addCleanup(delattr, frappe, "sendmail")
+		self.addCleanup(lambda: _writers.pop((self.directory, os.getpid())).close())
+
+		with patch.dict(frappe.conf, {"email_outbox": 1, "email_outbox_dir": self.directory}):
+			record_id = sendmail(recipients=["patient@example.com"], subject="Reminder", message="Tomorrow 9:00")
+			sendmail(recipients=["patient@example.com"], subject="Code", message="123456", now=True)
+			sendmail(recipients=["patient@example.com"], subject="Scan", message="",
+				attachments=[{"fname": "scan.pdf", "fcontent": b"%PDF"}])
+
+			records = [json.loads(record) for record in self.read_all()]
+
+		self.assertEqual([record["id"] for record in records], [record_id])
+		self.assertEqual(records[0]["kwargs"]["subject"], "Reminder")
+		self.assertEqual(frappe.sendmail.call_count, 2)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+
+import frappe
+
+
+class TestProvision(unittest.TestCase):
+	"""
+	Test cases for parallel multi-site SMTP provisioning.
+	"""
+
+	@patch('frappe.get_installed_apps', create=True, return_value=["frappe", "health_core"])
+	def test_provision_site(self, mock_installed_apps):
+		"""Test that a site is set up with the requested test email mode and reported"""
+		from health_core.setup.provision import provision_site
+
+		with patch('health_core.setup.install.setup_default_email_account', return_value="created") as mock_setup:
+			result = provision_site("clinic.local", test_email="none")
+
+		mock_setup.assert_called_once_with(test_email="none")
+		self.assertEqual(result["status"], "ok")
+		self.assertEqual(result["action"], "created")
+
+		with patch('health_core.setup.install.setup_default_email_account', side_effect=Exception("SMTP down")):
+			result = provision_site("clinic.local")
+
+		self.assertEqual(result["status"], "failed")
+		self.assertEqual(result["error"], "SMTP down")
+
+		mock_installed_apps.return_value = ["frappe"]
+		self.assertEqual(provision_site("other.local")["status"], "skipped")
+
+	def test_deferred_test_email(self):
+		"""Test that a deferred verification email is enqueued after commit instead of sent"""
+		from health_core.setup.install import verify_email_account
+
+		account = MagicMock()
+		account.name = "4Geeks Health SMTP"
+
+		with patch('frappe.enqueue') as mock_enqueue, \
+				patch('health_core.setup.install.send_test_email') as mock_send:
+			verify_email_account(account, "deferred")
+			verify_email_account(account, "none")
+
+		mock_send.assert_not_called()
+		mock_enqueue.assert_called_once()
+		self.assertEqual(mock_enqueue.call_args[1]["email_account"], "4Geeks Health SMTP")
+		self.assertTrue(mock_enqueue.call_args[1]["enqueue_after_commit"])
+
+	def test_sites_run_in_worker_processes(self):
+		"""Test that every site gets a result from the process pool, failures included"""
+		from health_core.setup.provision import count_statuses, provision_sites
+
+		seen = []
+		results = provision_sites(["b.local", "a.local"], workers=2, sites_path=tempfile.gettempdir(),
+			on_result=seen.append)
+
+		self.assertEqual([result["site"] for result in results], ["a.local", "b.local"])
+		self.assertEqual(len(seen), 2)
+		self.assertEqual(sum(count_statuses(results).values()), 2)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import frappe
+import unittest
+from unittest.mock import patch
+
+
+class TestQueueFlush(unittest.TestCase):
+	"""
+	Test cases for the sharded Email Queue flush.
+	"""
+
+	def test_rows_sharded_by_account(self):
+		"""Test that claimed rows are grouped by sending account, using the default when unset"""
+		from health_core.utils.queue_flush import shard_rows
+
+		rows = [
+			frappe._dict(name="Q1", email_account="Gmail"),
+			frappe._dict(name="Q2", email_account=None),
+			frappe._dict(name="Q3", email_account="Gmail"),
+			frappe._dict(name="Q4", email_account="Relay")
+		]
+
+		shards = shard_rows(rows, "Relay")
+
+		self.assertEqual(shards["Gmail"], ["Q1", "Q3"])
+		self.assertEqual(shards["Relay"], ["Q2", "Q4"])
+
+	def test_lanes_claimed_fairly(self):
+		"""Test that high rows fill the batch first and bulk is capped behind normal mail"""
+		from health_core.utils.queue_flush import claim_lanes
+
+		backlog = {"high": 10, "normal": 1000, "bulk": 50000}
+		claims = []
+
+		def claim_batch(limit, lease, exclude, default_account, lane, token=None):
+			claims.append((lane, limit))
+			count = min(limit, backlog[lane])
+			backlog[lane] -= count
+			return "token", [frappe._dict(name="{0}-{1}".format(lane, i), health_core_lane=lane) for i in range(count)]
+
+		with patch('health_core.utils.queue_flush.claim_batch', side_effect=claim_batch), \
+				patch.dict(frappe.conf, {"email_lane_max_bulk_batch": 100}):
+			token, rows, more = claim_lanes(500, 300)
+
+			self.assertEqual([row.health_core_lane for row in rows[:10]], ["high"] * 10)
+			self.assertEqual(claims, [("high", 500), ("normal", 368), ("bulk", 100), ("normal", 22)])
+			self.assertTrue(more)
+
+			# Once normal mail is drained, bulk still only gets capped batches
+			backlog["normal"] = 0
+			token, rows, more = claim_lanes(500, 300)
+			self.assertEqual(len(rows), 100)
+			self.assertTrue(more)
+
+	def test_split_shard_respects_limit(self):
+		"""Test that an account's rows are never split across more threads than its limit"""
+		from health_core.utils.queue_flush import split_shard
+
+		chunks = split_shard(["Q{0}".format(i) for i in range(10)], 3)
+		self.assertEqual(len(chunks), 3)
+		self.assertEqual(sum(len(chunk) for chunk in chunks), 10)
+
+		self.assertEqual(len(split_shard(["Q1", "Q2"], 5)), 2)
+
+	@patch('frappe.db.get_value')
+	def test_account_concurrency(self, mock_get_value):
+		"""Test per-account overrides, service defaults and the global default"""
+		from health_core.utils.queue_flush import get_account_concurrency, SERVICE_CONCURRENCY
+
+		conf = {"email_account_concurrency": {"Relay": 10}, "email_account_default_concurrency": 6}
+
+		with patch.dict(frappe.conf, conf):
+			self.assertEqual(get_account_concurrency("Relay"), 10)
+
+			mock_get_value.return_value = "GMail"
+			self.assertEqual(get_account_concurrency("4Geeks Health SMTP"), SERVICE_CONCURRENCY["GMail"])
+
+			mock_get_value.return_value = None
+			self.assertEqual(get_account_concurrency("Other"), 6)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import unittest
+from unittest.mock import patch
+
+import frappe
+
+
+class TestRateLimit(unittest.TestCase):
+	"""
+	Test cases for token-bucket rate limiting of whitelisted methods.
+	"""
+
+	def setUp(self):
+		from health_core.utils import rate_limit
+
+		rate_limit._local_buckets.clear()
+		frappe.local.request_ip = "203.0.113.7"
+
+	def test_local_bucket_refills(self):
+		"""Test that a bucket admits a burst, rejects, then refills over time"""
+		from health_core.utils.rate_limit import check_local_buckets
+
+		buckets = [("ip", 2, 1.0)]
+
+		self.assertEqual(check_local_buckets(buckets, now=100), 0)
+		self.assertEqual(check_local_buckets(buckets, now=100), 0)
+		self.assertAlmostEqual(check_local_buckets(buckets, now=100.25), 0.75)
+		self.assertEqual(check_local_buckets(buckets, now=101), 0)
+
+	def test_rejection_does_not_charge_other_buckets(self):
+		"""Test that a call rejected by one bucket takes no token from the others"""
+		from health_core.utils.rate_limit import check_local_buckets
+
+		both = [("ip", 2, 1.0), ("recipient", 1, 0.01)]
+
+		self.assertEqual(check_local_buckets(both, now=100), 0)
+		self.assertTrue(check_local_buckets(both, now=100))
+		# The rejected call above left the IP bucket with one token
+		self.assertEqual(check_local_buckets([("ip", 2, 1.0)], now=100), 0)
+		self.assertTrue(check_local_buckets([("ip", 2, 1.0)], now=100))
+
+	def test_decorator_sheds_before_calling(self):
+		"""Test that rejected calls never reach the method and raise TooManyRequestsError"""
+		from health_core.utils.rate_limit import Limit, check_local_buckets, rate_limit
+
+		calls = []
+
+		@rate_limit(Limit("ip", 10, 60), Limit("recipient_email", 2, 3600))
+		def endpoint(recipient_email=None):
+			calls.append(recipient_email)
+			return {"status": "queued"}
+
+		with patch.dict(frappe.conf, {"rate_limits": {}}), \
+				patch("health_core.utils.rate_limit.check_buckets", check_local_buckets):
+			endpoint(recipient_email="a@example.com")
+			endpoint(recipient_email="A@example.com ")
+			with self.assertRaises(frappe.TooManyRequestsError):
+				endpoint(recipient_email="a@example.com")
+			endpoint(recipient_email="b@example.com")
+
+		self.assertEqual(len(calls), 3)
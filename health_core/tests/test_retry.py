@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import datetime
+import random
+import unittest
+from unittest.mock import patch
+
+import frappe
+
+
+class TestRetry(unittest.TestCase):
+	"""
+	Test cases for Email Queue retry backoff.
+	"""
+
+	def test_backoff_grows_with_jitter(self):
+		"""Test that delays double per attempt, stay within half the cap and are spread out"""
+		from health_core.utils.retry import get_backoff
+
+		rng = random.Random(1)
+		with patch.dict(frappe.conf, {"email_retry_base_delay": 60, "email_retry_max_delay": 600}):
+			for attempt, delay in ((1, 60), (2, 120), (3, 240), (4, 480), (8, 600)):
+				backoff = get_backoff(attempt, rng)
+				self.assertGreaterEqual(backoff, delay / 2)
+				self.assertLessEqual(backoff, delay)
+
+			spread = {round(get_backoff(1, rng)) for i in range(20)}
+		self.assertGreater(len(spread), 5)
+
+	@patch('frappe.db.commit')
+	@patch('frappe.db.sql')
+	def test_failed_rows_scheduled_or_abandoned(self, mock_sql, mock_commit):
+		"""Test that failed rows get a future next attempt until they run out of attempts"""
+		from health_core.utils.retry import schedule_retries
+
+		now = datetime.datetime(2026, 1, 1, 12, 0, 0)
+		mock_sql.side_effect = [
+			[frappe._dict(name="Q1", health_core_attempts=0), frappe._dict(name="Q2", health_core_attempts=3)],
+			None,
+			None
+		]
+
+		with patch.dict(frappe.conf, {"email_retry_max_attempts": 4}), \
+				patch('health_core.utils.retry.inc'):
+			result = schedule_retries(["Q1", "Q2", "Q3"], now=now, rng=random.Random(1))
+
+		self.assertEqual(result, {"scheduled": 1, "abandoned": 1})
+
+		scheduled = mock_sql.call_args_list[1][0][1]
+		self.assertEqual(scheduled["name"], "Q1")
+		self.assertTrue(now + datetime.timedelta(seconds=30) <= scheduled["next_attempt"] <= now + datetime.timedelta(seconds=60))
+		self.assertEqual(scheduled["attempts"], 1)
+		self.assertIn("status = 'Error'", mock_sql.call_args_list[2][0][0])
+
+	@patch('frappe.db.commit')
+	def test_attempts_counted_without_frappe_retry(self, mock_commit):
+		"""Test that rows whose Frappe `retry` stays 0 (connection errors) still back off longer and are given up on"""
+		from health_core.utils.retry import schedule_retries
+
+		now = datetime.datetime(2026, 1, 1, 12, 0, 0)
+		row = frappe._dict(name="Q1", retry=0, health_core_attempts=0)
+		delays = []
+
+		def sql(query, values=None, as_dict=False):
+			if query.strip().startswith("select"):
+				return [row]
+			row.health_core_attempts = values["attempts"]
+			if "next_attempt" in values:
+				delays.append((values["next_attempt"] - now).total_seconds())
+			else:
+				row.status = "Error"
+
+		with patch.dict(frappe.conf, {"email_retry_max_attempts": 4, "email_retry_base_delay": 60}), \
+				patch('frappe.db.sql', side_effect=sql), patch('health_core.utils.retry.inc'):
+			results = [schedule_retries(["Q1"], now=now, rng=random.Random(1)) for i in range(4)]
+
+		self.assertEqual(row.retry, 0)
+		self.assertEqual(len(delays), 3)
+		self.assertTrue(delays[0] <= 60 <= delays[1] <= 120 <= delays[2])
+		self.assertEqual(results[-1], {"scheduled": 0, "abandoned": 1})
+		self.assertEqual((row.status, row.health_core_attempts), ("Error", 4))
+
+	@patch('frappe.db.commit')
+	@patch('frappe.db.sql', return_value=[])
+	def test_claims_split_fresh_and_due_rows(self, mock_sql, mock_commit):
+		"""Test that the regular flush skips rows awaiting a retry and the retry flush takes due ones in order"""
+		from health_core.utils.queue_flush import claim_batch
+
+		claim_batch(10)
+		claim_batch(10, retries=True)
+
+		fresh, due = mock_sql.call_args_list[0][0][0], mock_sql.call_args_list[1][0][0]
+		self.assertIn("health_core_next_attempt is null", fresh)
+		self.assertIn("health_core_next_attempt <= %(now)s", due)
+		self.assertIn("order by health_core_next_attempt asc", due)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import random
+import smtplib
+import unittest
+from collections import Counter
+from unittest.mock import MagicMock, patch
+
+import frappe
+
+from health_core.tests.utils import FakeRedis
+from health_core.tests.test_smtp_pool import make_settings
+
+
+class TestRouting(unittest.TestCase):
+	"""
+	Test cases for multi-account routing and failover.
+	"""
+
+	def setUp(self):
+		self.redis = FakeRedis()
+		frappe.local.site = "test.local"
+		self.patchers = [
+			patch('frappe.cache', return_value=self.redis),
+			patch('health_core.utils.routing.get_routing_accounts', return_value=[
+				frappe._dict(name="A", email_id="a@clinic.example", daily_quota=0),
+				frappe._dict(name="B", email_id="b@clinic.example", daily_quota=0),
+				frappe._dict(name="C", email_id="c@clinic.example", daily_quota=100)
+			]),
+			patch('health_core.utils.routing.get_quota_used', return_value={"C": 50})
+		]
+		for patcher in self.patchers:
+			patcher.start()
+
+	def tearDown(self):
+		for patcher in self.patchers:
+			patcher.stop()
+
+		from health_core.utils import routing
+		routing._stats.clear()
+
+	def test_traffic_follows_weights(self):
+		"""Test that faster accounts get more traffic and throttled ones none"""
+		from health_core.utils.routing import get_router, record_send
+
+		for _ in range(10):
+			record_send("A", 0.1)
+			record_send("B", 0.4)
+		self.redis.set_value("health_core:smtp_throttled:C", {"reason": "throttled"})
+
+		router = get_router()
+		router.rng = random.Random(1)
+		counts = Counter(router.choose() for _ in range(1000))
+
+		self.assertEqual(router.available, ["A", "B"])
+		self.assertEqual(counts["C"], 0)
+		self.assertAlmostEqual(counts["A"] / 1000.0, 0.8, delta=0.05)
+
+	def test_quota_and_errors_reduce_weight(self):
+		"""Test that the quota left and the error rate scale an account's weight"""
+		from health_core.utils.routing import get_router, record_send
+
+		record_send("B", error=smtplib.SMTPDataError(554, b"Message rejected"))
+		weights = get_router().weights
+
+		# C has half its quota left; B failed once (error rate 0.2)
+		self.assertAlmostEqual(weights["C"], weights["A"] / 2)
+		self.assertAlmostEqual(weights["B"], weights["A"] * 0.64)
+
+	def test_throttle_classification(self):
+		"""Test that throttling responses are told apart from ordinary rejections"""
+		from health_core.utils.routing import get_throttle_reason, is_failover_error, is_throttled, record_send
+
+		self.assertEqual(get_throttle_reason(smtplib.SMTPSenderRefused(421, b"Too many connections", "a@x.com")), "throttled")
+		self.assertEqual(get_throttle_reason(smtplib.SMTPDataError(451, b"4.7.0 Try again later, rate limited")), "throttled")
+		self.assertEqual(get_throttle_reason(smtplib.SMTPDataError(550, b"5.4.5 Daily sending quota exceeded")), "quota")
+		self.assertIsNone(get_throttle_reason(smtplib.SMTPDataError(550, b"5.1.1 No such user")))
+		self.assertIsNone(get_throttle_reason(smtplib.SMTPRecipientsRefused({"a@x.com": (550, b"No such user")})))
+
+		self.assertTrue(is_failover_error(smtplib.SMTPServerDisconnected()))
+		self.assertFalse(is_failover_error(smtplib.SMTPDataError(550, b"5.1.1 No such user")))
+
+		self.assertEqual(record_send("A", error=smtplib.SMTPDataError(421, b"Service busy")), "throttled")
+		self.assertTrue(is_throttled("A"))
+
+	def test_rows_routed_across_pool(self):
+		"""Test that unassigned, default-account and pool rows are spread over the pool"""
+		from health_core.utils.queue_flush import shard_rows
+		from health_core.utils.routing import Router
+
+		router = Router([("A", 1.0), ("B", 1.0)], rng=random.Random(3),
+			domains={"A": "clinic.example", "B": "clinic.example"})
+		rows = [frappe._dict(name="Q{0}".format(i), email_account=account, sender="Clinic <noreply@clinic.example>")
+			for i, account in enumerate([None, "Default", "A", "Other"] * 25)]
+
+		shards = shard_rows(rows, "Default", router)
+
+		self.assertEqual(set(shards), {"A", "B", "Other"})
+		self.assertEqual(len(shards["Other"]), 25)
+		self.assertEqual(len(shards["A"]) + len(shards["B"]), 75)
+		self.assertGreater(len(shards["B"]), 25)
+
+	def test_rerouted_rows_keep_from_domain(self):
+		"""Test that a queued row only moves to a pool account in its From header's domain"""
+		from email import message_from_string
+		from email.message import EmailMessage
+		from email.utils import parseaddr
+		from health_core.utils.queue_flush import shard_rows
+		from health_core.utils.routing import get_router
+
+		rows = []
+		for i, sender in enumerate(["Clinic <noreply@clinic.example>", "Lab <results@lab.example>"] * 20):
+			# The From header Frappe built into the queued message
+			msg = EmailMessage()
+			msg["From"] = sender
+			rows.append(frappe._dict(name="Q{0}".format(i), email_account="Default", sender=sender, message=msg.as_string()))
+
+		shards = shard_rows(rows, "Default", get_router())
+		accounts = {name: account for account, names in shards.items() for name in names}
+		addresses = {"A": "a@clinic.example", "B": "b@clinic.example", "C": "c@clinic.example"}
+
+		for row in rows:
+			from_domain = parseaddr(message_from_string(row.message)["From"])[1].split("@")[1]
+			account = accounts[row.name]
+			if from_domain == "clinic.example":
+				self.assertEqual(addresses[account].split("@")[1], from_domain)
+			else:
+				# No pool account can send as lab.example
+				self.assertEqual(account, "Default")
+		self.assertEqual(len(shards["Default"]), 20)
+
+	def test_send_mail_fails_over(self):
+		"""Test that a throttled account's message is retried from the next routed account"""
+		from health_core.utils.smtp_pool import send_mail
+
+		throttled = smtplib.SMTPDataError(421, b"Rate limit exceeded")
+		with patch('health_core.utils.routing.route_accounts', return_value=["A", "B"]), \
+				patch('health_core.utils.smtp_pool.send_from_account', side_effect=[throttled, {}]) as mock_send:
+			self.assertEqual(send_mail("user@example.com", "Subject", "<p>Hi</p>"), {})
+
+		self.assertEqual([call[0][0] for call in mock_send.call_args_list], ["A", "B"])
+
+		rejected = smtplib.SMTPDataError(550, b"Message rejected")
+		with patch('health_core.utils.routing.route_accounts', return_value=["A", "B"]), \
+				patch('health_core.utils.smtp_pool.send_from_account', side_effect=[rejected, {}]):
+			self.assertRaises(smtplib.SMTPDataError, send_mail, "user@example.com", "Subject", "<p>Hi</p>")
+
+	def test_bulk_groups_fail_over(self):
+		"""Test that bulk groups move to the failover account once the first is throttled"""
+		from health_core.utils.bulk_email import _send_groups
+		from health_core.utils.routing import is_throttled
+
+		pool = MagicMock()
+		pool.send.side_effect = [{}, smtplib.SMTPDataError(421, b"Too many messages"), {}, {}]
+		failover = (("site", "B"), make_settings(email_id="b@example.com"), b"msg-b")
+
+		outcomes = list(_send_groups(
+			pool, ("site", "A"), make_settings(), b"msg-a",
+			["user{0}@example.com".format(i) for i in range(6)], [], 2, [failover]
+		))
+
+		self.assertTrue(all(outcome["status"] == "sent" for outcome in outcomes))
+		self.assertEqual(len(outcomes), 6)
+		self.assertEqual([call[0][0] for call in pool.send.call_args_list], [
+			("site", "A"), ("site", "A"), ("site", "B"), ("site", "B")
+		])
+		# The throttling reply is recorded, so routing and queue flushes skip A too
+		self.assertTrue(is_throttled("A"))
+		self.assertFalse(is_throttled("B"))
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import time
+import unittest
+from unittest.mock import MagicMock, patch
+
+import frappe
+
+from health_core.tests.utils import FakeRedis
+from health_core.tests.test_smtp_pool import make_settings
+
+
+class TestSMTPHealth(unittest.TestCase):
+	"""
+	Test cases for the SMTP health prober and circuit breaker.
+	"""
+
+	def setUp(self):
+		self.redis = FakeRedis()
+		self.patchers = [
+			patch('frappe.cache', return_value=self.redis),
+			patch.dict(frappe.conf, {"smtp_circuit_failure_threshold": 3, "smtp_circuit_cooldown": 60})
+		]
+		for patcher in self.patchers:
+			patcher.start()
+
+	def tearDown(self):
+		for patcher in self.patchers:
+			patcher.stop()
+
+	def test_circuit_opens_and_recovers(self):
+		"""Test closed -> open at the threshold -> half-open trial -> closed"""
+		from health_core.utils.smtp_health import allow_request, get_circuit, record_failure, record_success
+
+		for i in range(3):
+			self.assertTrue(allow_request("Relay"))
+			record_failure("Relay")
+
+		self.assertEqual(get_circuit("Relay")["state"], "open")
+		self.assertFalse(allow_request("Relay"))
+
+		with patch('health_core.utils.smtp_health.time.time', return_value=get_circuit("Relay")["opened_at"] + 61):
+			self.assertTrue(allow_request("Relay"))
+			# Only one trial is admitted while half-open
+			self.assertFalse(allow_request("Relay"))
+
+		record_success("Relay")
+		self.assertEqual(get_circuit("Relay"), {"state": "closed", "failures": 0})
+		self.assertTrue(allow_request("Relay"))
+
+	def test_failed_trial_reopens(self):
+		"""Test that a failing half-open trial reopens the circuit with a fresh cooldown"""
+		from health_core.utils.smtp_health import allow_request, get_circuit, record_failure
+
+		self.redis.set_value("health_core:smtp_circuit:Relay", {"state": "open", "failures": 3, "opened_at": 0})
+
+		self.assertTrue(allow_request("Relay"))
+		self.assertEqual(get_circuit("Relay")["state"], "half_open")
+
+		record_failure("Relay")
+		self.assertEqual(get_circuit("Relay")["state"], "open")
+		self.assertFalse(allow_request("Relay"))
+
+	@patch('health_core.utils.smtp_pool.open_session', side_effect=ConnectionRefusedError("refused"))
+	@patch('health_core.utils.smtp_pool.get_account_settings', return_value=make_settings())
+	def test_probe_stores_health(self, mock_settings, mock_open_session):
+		"""Test that a failed probe is cached for status endpoints and counted by the breaker"""
+		from health_core.utils.smtp_health import add_health, get_circuit, probe_account
+
+		probe_account("Relay")
+
+		# AUTH is skipped unless smtp_probe_auth is set
+		self.assertIsNone(mock_open_session.call_args[0][0].password)
+		self.assertEqual(get_circuit("Relay")["failures"], 1)
+
+		status = add_health({"status": "success", "account_details": {"name": "Relay"}})
+		self.assertEqual(status["health"]["status"], "down")
+		self.assertEqual(status["health"]["error"], "refused")
+
+	@patch('health_core.utils.queue_flush.release_claim')
+	@patch('health_core.utils.queue_flush.send_queued_email')
+	@patch('health_core.utils.queue_flush.allow_request', return_value=False)
+	def test_open_circuit_defers_shard(self, mock_allow, mock_send, mock_release):
+		"""Test that a shard for an account with an open circuit is released unsent"""
+		import threading
+		from health_core.utils.queue_flush import send_shard
+
+		result = send_shard("test.local", "token", "Relay", ["Q1", "Q2"], threading.BoundedSemaphore(1))
+
+		self.assertEqual(result, {"sent": 0, "failed": 0, "deferred": 2})
+		mock_send.assert_not_called()
+		mock_release.assert_called_once_with("token", ["Q1", "Q2"])
+
+	@patch('health_core.utils.queue_flush.claim_lanes', return_value=("token", [], False))
+	@patch('health_core.utils.queue_flush.get_router', return_value=None)
+	@patch('health_core.utils.queue_flush.get_default_outgoing_account', return_value="Default")
+	def test_circuit_opened_elsewhere_seen_by_next_flush(self, mock_default, mock_router, mock_claim):
+		"""Test that a long-lived process skips an account whose circuit another process opened"""
+		from health_core.utils.queue_flush import flush_queue
+
+		with patch('frappe.get_all', return_value=["Relay"]), \
+				patch.object(frappe, "db", MagicMock(**{"get_default.return_value": 0})):
+			flush_queue(10)
+			# A worker in another process opens the circuit between the two flushes
+			self.redis.data["site|health_core:smtp_circuit:Relay"] = {"state": "open", "failures": 3, "opened_at": time.time()}
+			flush_queue(10)
+
+		self.assertEqual(mock_claim.call_args_list[0][0][2], [])
+		self.assertEqual(mock_claim.call_args_list[1][0][2], ["Relay"])
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import email
+import email.policy
+import unittest
+from email.message import EmailMessage
+
+from health_core.utils.smtp_pool import SMTPSettings, open_session
+
+
+RECIPIENTS = ["patient{0}@example.com".format(i) for i in range(50)]
+
+
+def make_message():
+	msg = EmailMessage()
+	msg["From"] = "clinic@example.com"
+	msg["To"] = "undisclosed-recipients:;"
+	msg["Subject"] = "Clinic closed on Monday"
+	msg.set_content("The clinic is closed on Monday.\n.\nSee you on Tuesday.")
+	return msg.as_bytes()
+
+
+class TestSMTPPipeline(unittest.TestCase):
+	"""
+	Test cases for pipelined and chunked SMTP transactions against the local stub server.
+	"""
+
+	def send(self, stub, recipients, msg, max_recipients=None):
+		from health_core.utils.smtp_pipeline import send_message
+
+		settings = SMTPSettings(
+			host="127.0.0.1", port=stub.port, use_tls=0, use_ssl=0, login=None, password=None,
+			email_id="clinic@example.com", sender_name="Clinic", timeout=5, modified="1"
+		)
+		session = open_session(settings)
+		try:
+			before = stub.stats["round_trips"]
+			refused = send_message(session, "clinic@example.com", recipients, msg, max_recipients)
+			# The final reply is counted once the stub waits for the next command
+			session.noop()
+			return refused, stub.stats["round_trips"] - before - 1
+		finally:
+			session.quit()
+
+	def test_round_trips(self):
+		"""Test that one message to 50 recipients takes 2 round trips with PIPELINING instead of 53"""
+		from health_core.benchmarks.stub_smtp import StubSMTPServer
+
+		for options, expected in (({}, 53), ({"pipelining": True}, 2), ({"pipelining": True, "chunking": True}, 2)):
+			with StubSMTPServer(keep_messages=True, **options) as stub:
+				refused, round_trips = self.send(stub, RECIPIENTS, make_message())
+
+			self.assertEqual(refused, {})
+			self.assertEqual(round_trips, expected, options)
+			self.assertEqual(stub.stats["recipients"], 50)
+			received = email.message_from_bytes(stub.messages[0], policy=email.policy.default)
+			self.assertIn("\n.\nSee you", received.get_content().replace("\r\n", "\n"))
+
+	def test_server_recipient_limit(self):
+		"""Test that recipients refused with 452 are sent in further transactions on the same session"""
+		from health_core.benchmarks.stub_smtp import StubSMTPServer
+
+		with StubSMTPServer(pipelining=True, max_recipients=20, keep_messages=True) as stub:
+			refused, round_trips = self.send(stub, RECIPIENTS, make_message())
+
+		self.assertEqual(refused, {})
+		self.assertEqual(stub.stats["recipients"], 50)
+		self.assertEqual(len(stub.messages), 3)
+		self.assertEqual(stub.stats["connections"], 1)
+		self.assertEqual(round_trips, 6)
+
+	def test_streamed_attachment_over_bdat(self):
+		"""Test that a streaming message is sent as BDAT chunks without dot-stuffing"""
+		import os
+		import tempfile
+		from health_core.benchmarks.stub_smtp import StubSMTPServer
+		from health_core.utils.mime_stream import StreamingMessage
+
+		content = os.urandom(500000)
+		with tempfile.NamedTemporaryFile(suffix=".pdf") as f:
+			f.write(content)
+			f.flush()
+
+			headers = EmailMessage()
+			headers["Subject"] = "Lab results"
+			body = EmailMessage()
+			body.set_content(".\nResults attached")
+
+			with StubSMTPServer(pipelining=True, chunking=True, keep_messages=True) as stub:
+				with StreamingMessage(headers, body, [f.name]) as msg:
+					refused, round_trips = self.send(stub, ["patient@example.com"], msg)
+					size = msg.size(stuffed=False)
+
+		received = email.message_from_bytes(stub.messages[0], policy=email.policy.default)
+		self.assertEqual(len(stub.messages[0]), size)
+		self.assertEqual(next(received.iter_attachments()).get_content(), content)
+		self.assertEqual(round_trips, 2)
+
+
+if __name__ == '__main__':
+	unittest.main()
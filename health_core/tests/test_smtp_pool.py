@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import smtplib
+import unittest
+from unittest.mock import patch, MagicMock
+
+from health_core.utils.smtp_pool import SMTPConnectionPool, SMTPSettings
+
+
+def make_settings(**overrides):
+	values = dict(
+		host="smtp.example.com", port=587, use_tls=1, use_ssl=0, login="user@example.com",
+		password="secret", email_id="user@example.com", sender_name="Test",
+		timeout=5, modified="1"
+	)
+	values.update(overrides)
+	return SMTPSettings(**values)
+
+
+def make_session():
+	session = MagicMock()
+	# A server without PIPELINING or CHUNKING, so sends go through sendmail
+	session.has_extn.return_value = False
+	session.esmtp_features = {}
+	session.sendmail.return_value = {}
+	session.noop.return_value = (250, b"OK")
+	return session
+
+
+class TestSMTPConnectionPool(unittest.TestCase):
+	"""
+	Test cases for the pooled SMTP connection manager.
+	"""
+
+	def setUp(self):
+		self.key = ("test.local", "Test Account")
+		self.settings = make_settings()
+
+	@patch('health_core.utils.smtp_pool.open_session')
+	def test_connection_is_reused(self, mock_open_session):
+		"""Test that consecutive sends share a single SMTP connection"""
+		mock_open_session.side_effect = lambda settings, timings=None: make_session()
+		pool = SMTPConnectionPool()
+
+		for i in range(10):
+			pool.send(self.key, self.settings, "user@example.com", ["to@example.com"], b"msg")
+
+		self.assertEqual(mock_open_session.call_count, 1)
+		self.assertEqual(pool.stats["reused"], 9)
+
+	@patch('health_core.utils.smtp_pool.open_session')
+	def test_max_messages_per_connection(self, mock_open_session):
+		"""Test that a connection is retired after max_messages sends"""
+		mock_open_session.side_effect = lambda settings, timings=None: make_session()
+		pool = SMTPConnectionPool(max_messages=3)
+
+		for i in range(7):
+			pool.send(self.key, self.settings, "user@example.com", ["to@example.com"], b"msg")
+
+		self.assertEqual(mock_open_session.call_count, 3)
+
+	@patch('health_core.utils.smtp_pool.open_session')
+	def test_dead_connection_fails_noop(self, mock_open_session):
+		"""Test that idle connections failing NOOP are replaced"""
+		dead = make_session()
+		dead.noop.side_effect = smtplib.SMTPServerDisconnected()
+		mock_open_session.side_effect = [dead, make_session()]
+		pool = SMTPConnectionPool(noop_interval=0)
+
+		pool.send(self.key, self.settings, "user@example.com", ["to@example.com"], b"msg")
+		pool.send(self.key, self.settings, "user@example.com", ["to@example.com"], b"msg")
+
+		self.assertEqual(mock_open_session.call_count, 2)
+		self.assertEqual(pool.stats["evicted"], 1)
+
+	@patch('health_core.utils.smtp_pool.open_session')
+	def test_reconnect_on_disconnect(self, mock_open_session):
+		"""Test that a send on a dropped reused connection is retried once"""
+		first = make_session()
+		first.sendmail.side_effect = [{}, smtplib.SMTPServerDisconnected()]
+		mock_open_session.side_effect = [first, make_session()]
+		pool = SMTPConnectionPool()
+
+		pool.send(self.key, self.settings, "user@example.com", ["to@example.com"], b"msg")
+		refused = pool.send(self.key, self.settings, "user@example.com", ["to@example.com"], b"msg")
+
+		self.assertEqual(refused, {})
+		self.assertEqual(mock_open_session.call_count, 2)
+
+	@patch('health_core.utils.smtp_pool.open_session')
+	def test_rejected_message_not_retried(self, mock_open_session):
+		"""Test that message-level rejections are raised without reconnecting"""
+		session = make_session()
+		session.sendmail.side_effect = smtplib.SMTPDataError(554, b"Rejected")
+		mock_open_session.return_value = session
+		pool = SMTPConnectionPool()
+
+		with self.assertRaises(smtplib.SMTPDataError):
+			pool.send(self.key, self.settings, "user@example.com", ["to@example.com"], b"msg")
+
+		self.assertEqual(mock_open_session.call_count, 1)
+
+	@patch('health_core.utils.smtp_pool.open_session')
+	def test_idle_eviction(self, mock_open_session):
+		"""Test that idle connections are closed after idle_timeout"""
+		session = make_session()
+		mock_open_session.return_value = session
+		pool = SMTPConnectionPool(idle_timeout=0)
+
+		pool.send(self.key, self.settings, "user@example.com", ["to@example.com"], b"msg")
+		pool.evict_idle()
+
+		session.quit.assert_called_once()
+		self.assertEqual(pool.stats["evicted"], 1)
+
+	@patch('health_core.utils.smtp_pool.open_session')
+	def test_changed_settings_drop_idle_connections(self, mock_open_session):
+		"""Test that updating an account's settings closes its idle connections"""
+		session = make_session()
+		mock_open_session.return_value = session
+		pool = SMTPConnectionPool()
+		pool.set_settings(self.key, self.settings)
+
+		pool.send(self.key, self.settings, "user@example.com", ["to@example.com"], b"msg")
+		pool.set_settings(self.key, make_settings(modified="2"))
+
+		session.quit.assert_called_once()
+
+
+	@patch('health_core.utils.smtp_pool.open_session')
+	def test_prewarm_fills_idle_sessions(self, mock_open_session):
+		"""Test that pre-warming opens sessions up to the requested (and max_idle) count"""
+		mock_open_session.side_effect = lambda settings: make_session()
+		pool = SMTPConnectionPool(max_idle=3)
+
+		self.assertEqual(pool.prewarm(self.key, self.settings, 2), 2)
+		self.assertEqual(pool.prewarm(self.key, self.settings, 5), 1)
+
+		mock_open_session.side_effect = None
+		pool.send(self.key, self.settings, "user@example.com", ["to@example.com"], b"msg")
+
+		self.assertEqual(mock_open_session.call_count, 3)
+		self.assertEqual(pool.stats["reused"], 1)
+
+	@patch('health_core.utils.smtp_pool.smtplib.SMTP')
+	@patch('health_core.utils.smtp_pool.socket.getaddrinfo')
+	def test_open_session_falls_through_addresses(self, mock_getaddrinfo, mock_smtp):
+		"""Test that an unreachable first address (e.g. broken IPv6) falls through to the next"""
+		import socket
+		from health_core.utils.smtp_pool import open_session
+
+		mock_getaddrinfo.return_value = [
+			(socket.AF_INET6, socket.SOCK_STREAM, 6, "", ("2001:db8::25", 587, 0, 0)),
+			(socket.AF_INET, socket.SOCK_STREAM, 6, "", ("192.0.2.25", 587))
+		]
+		unreachable, reachable = make_session(), make_session()
+		unreachable.connect.side_effect = OSError(101, "Network is unreachable")
+		mock_smtp.side_effect = [unreachable, reachable]
+
+		timings = {}
+		with patch('health_core.utils.smtp_pool.get_ssl_context'):
+			session = open_session(make_settings(use_tls=0), timings)
+
+		self.assertIs(session, reachable)
+		reachable.connect.assert_called_once_with("192.0.2.25", 587)
+		unreachable.close.assert_called_once()
+		self.assertEqual(set(timings), {"dns", "connect", "ehlo", "auth"})
+
+		# Every address failing raises the last error
+		first, second = make_session(), make_session()
+		first.connect.side_effect = OSError(101, "Network is unreachable")
+		second.connect.side_effect = ConnectionRefusedError("refused")
+		mock_smtp.side_effect = [first, second]
+		with patch('health_core.utils.smtp_pool.get_ssl_context'):
+			self.assertRaises(ConnectionRefusedError, open_session, make_settings(use_tls=0))
+
+
+class TestTLSSessionResumption(unittest.TestCase):
+	"""
+	Test cases for TLS session resumption against the local TLS SMTP stub.
+	"""
+
+	def test_reconnect_resumes_tls_session(self):
+		"""Test that a second STARTTLS connection resumes the first one's session"""
+		import tempfile
+		from health_core.benchmarks.stub_smtp import StubSMTPServer, make_self_signed_cert
+		from health_core.utils.smtp_pool import make_ssl_context, open_session
+
+		certfile, keyfile = make_self_signed_cert(tempfile.gettempdir())
+		context = make_ssl_context()
+
+		with StubSMTPServer(certfile=certfile, keyfile=keyfile) as stub:
+			settings = make_settings(host="localhost", port=stub.port)
+			resumed = []
+			for i in range(3):
+				session = open_session(settings, context=context)
+				resumed.append(session.sock.session_reused)
+				session.quit()
+
+			# A fresh context has no session to offer
+			session = open_session(settings, context=make_ssl_context())
+			resumed.append(session.sock.session_reused)
+			session.quit()
+
+		self.assertEqual(resumed, [False, True, True, False])
+		self.assertEqual(stub.stats["tls_handshakes"], 4)
+		self.assertEqual(stub.stats["tls_resumed"], 2)
+
+
+if __name__ == '__main__':
+	unittest.main()
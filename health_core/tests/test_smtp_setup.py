@@ -88,6 +88,17 @@ class TestSMTPSetup(unittest.TestCase):
 			self.assertEqual(result['status'], 'success')
 			self.assertTrue(result['configured'])
 
+	def test_frappe_queue_flush_disabled(self):
+		"""Test that Frappe's own queue flush job is stopped so that only health_core's flush sends Email Queue rows"""
+		from health_core.setup.install import FRAPPE_QUEUE_FLUSH, disable_frappe_queue_flush
+
+		with patch('frappe.get_all', return_value=["queue.flush"]) as mock_get_all, \
+				patch('frappe.db.set_value', create=True) as mock_set_value:
+			disable_frappe_queue_flush()
+
+		self.assertEqual(mock_get_all.call_args[1]["filters"], {"method": FRAPPE_QUEUE_FLUSH, "stopped": 0})
+		mock_set_value.assert_called_once_with("Scheduled Job Type", "queue.flush", "stopped", 1)
+
 
 class TestSMTPManager(unittest.TestCase):
 	"""
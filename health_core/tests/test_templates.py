@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+
+class TestTemplates(unittest.TestCase):
+	"""
+	Test cases for the compiled email template registry.
+	"""
+
+	def setUp(self):
+		from health_core.utils.templates import clear_template_cache
+
+		clear_template_cache()
+		self.directory = tempfile.mkdtemp()
+
+	def tearDown(self):
+		from health_core.utils.templates import clear_template_cache
+
+		clear_template_cache()
+		shutil.rmtree(self.directory)
+
+	def write_template(self, source, mtime):
+		path = os.path.join(self.directory, "notice.html")
+		with open(path, "w") as f:
+			f.write(source)
+		os.utime(path, (mtime, mtime))
+		return path
+
+	def test_render_many_compiles_once(self):
+		"""Test that a template is parsed once for many renders"""
+		import frappe
+		from health_core.utils import templates
+
+		path = self.write_template("<p>Hello {{ name }}</p>", 1000)
+		jenv = frappe.get_jenv()
+
+		with patch.object(templates, "get_template_path", return_value=path), \
+				patch.object(jenv, "from_string", wraps=jenv.from_string) as from_string:
+			rendered = templates.render_many("notice", [{"name": "Ana"}, {"name": "Luis"}])
+			templates.render_template("notice", {"name": "Eva"})
+
+		self.assertEqual(rendered, ["<p>Hello Ana</p>", "<p>Hello Luis</p>"])
+		self.assertEqual(from_string.call_count, 1)
+
+	def test_modified_template_is_recompiled(self):
+		"""Test that a newer file replaces the cached compiled template"""
+		from health_core.utils import templates
+
+		path = self.write_template("<p>Old {{ name }}</p>", 1000)
+
+		with patch.object(templates, "get_template_path", return_value=path):
+			self.assertEqual(templates.render_template("notice", {"name": "x"}), "<p>Old x</p>")
+			self.write_template("<p>New {{ name }}</p>", 2000)
+			self.assertEqual(templates.render_template("notice", {"name": "x"}), "<p>New x</p>")
+
+	def test_test_email_template(self):
+		"""Test the shipped test email template for both callers"""
+		from health_core.utils.templates import render_template
+
+		guest = render_template("smtp_test_email", {"email_account_name": "4Geeks Health SMTP", "sent_at": "now"})
+		manual = render_template("smtp_test_email", {"email_account_name": "4Geeks Health SMTP", "sent_at": "now", "sent_by": "admin@example.com"})
+
+		self.assertIn("Email Account: 4Geeks Health SMTP", guest)
+		self.assertIn("Test Mode: Guest Access", guest)
+		self.assertIn("Sent by: admin@example.com", manual)
+		self.assertNotIn("Guest Access", manual)
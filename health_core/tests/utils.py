@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+Shared helpers for the health_core test cases.
+"""
+from __future__ import unicode_literals
+
+
+class FakePipeline(object):
+	"""Queues commands and runs them against the FakeRedis on `execute`."""
+
+	def __init__(self, redis):
+		self.redis = redis
+		self.commands = []
+
+	def __getattr__(self, name):
+		def command(*args, **kwargs):
+			self.commands.append((name, args, kwargs))
+		return command
+
+	def execute(self):
+		commands, self.commands = self.commands, []
+		return [getattr(self.redis, name)(*args, **kwargs) for name, args, kwargs in commands]
+
+
+class FakeRedis(object):
+	"""Minimal stand-in for frappe.cache() covering the calls health_core makes."""
+
+	def __init__(self):
+		self.data = {}
+		# Like frappe.local.cache: get_value/set_value keep values here for the
+		# life of the process unless called with expires
+		self.local = {}
+
+	def make_key(self, key):
+		return "site|" + key
+
+	def pipeline(self):
+		return FakePipeline(self)
+
+	def get(self, key):
+		return self.data.get(key)
+
+	def set(self, key, value, ex=None, nx=False):
+		if nx and key in self.data:
+			return None
+		self.data[key] = value
+		return True
+
+	def delete(self, *keys):
+		for key in keys:
+			self.data.pop(key, None)
+
+	def incr(self, key):
+		self.data[key] = int(self.data.get(key) or 0) + 1
+		return self.data[key]
+
+	def expire(self, key, seconds):
+		return True
+
+	def rpush(self, key, *values):
+		items = self.data.setdefault(key, [])
+		items.extend(values)
+		return len(items)
+
+	def lpush(self, key, *values):
+		items = self.data.setdefault(key, [])
+		for value in values:
+			items.insert(0, value)
+		return len(items)
+
+	def lrange(self, key, start, stop):
+		return list(self.data.get(key, [])[start:None if stop == -1 else stop + 1])
+
+	def ltrim(self, key, start, stop):
+		self.data[key] = self.data.get(key, [])[start:None if stop == -1 else stop + 1]
+		return True
+
+	def get_value(self, key, generator=None, user=None, expires=False, *args, **kwargs):
+		key = self.make_key(key)
+		if not expires and key in self.local:
+			return self.local[key]
+		value = self.data.get(key)
+		if not expires:
+			self.local[key] = value
+		return value
+
+	def set_value(self, key, value, user=None, expires_in_sec=None, *args, **kwargs):
+		key = self.make_key(key)
+		self.data[key] = value
+		if not expires_in_sec:
+			self.local[key] = value
+
+	def delete_value(self, key, *args, **kwargs):
+		key = self.make_key(key)
+		self.data.pop(key, None)
+		self.local.pop(key, None)
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import atexit
+import json
+import threading
+from collections import defaultdict, deque
+
+import frappe
+from frappe.utils import cint, now
+
+
+AUDIT_BUFFER_KEY = "health_core:audit_buffer"
+# Set while a flush job is queued, so bursts of events queue only one
+FLUSH_QUEUED_KEY = "health_core:audit_flush_queued"
+# Frees the flag if the queued job is lost (e.g. its transaction rolled back)
+FLUSH_QUEUED_TTL = 300
+
+DEFAULT_BUFFER_LIMIT = 10000
+DEFAULT_BATCH_SIZE = 500
+
+COMMUNICATION_FIELDS = (
+	"name", "creation", "modified", "owner", "modified_by", "docstatus", "idx",
+	"communication_type", "communication_medium", "sent_or_received", "status",
+	"subject", "content", "sender", "reference_doctype", "communication_date"
+)
+
+# Events that could not be pushed to Redis, grouped by site; moved to Redis by
+# the next event that reaches it, or written directly on shutdown
+_local_buffer = defaultdict(lambda: deque(maxlen=DEFAULT_BUFFER_LIMIT))
+_local_buffer_lock = threading.Lock()
+
+
+def log_event(action, details, status="Success"):
+	"""
+	Appends an audit event to the site's Redis buffer without touching the database.
+
+	The buffer is capped at `audit_buffer_limit` events (oldest dropped first).
+	A flush job is queued when the first event lands in an empty buffer and
+	whenever a full batch has accumulated. Events held in this process while
+	Redis was unreachable are pushed ahead of this one once it is back.
+
+	Args:
+		action (str): The action performed
+		details (str): Details about the action
+		status (str): Status of the action (Success/Failed)
+	"""
+	event = {
+		"action": action,
+		"details": details,
+		"status": status,
+		"user": frappe.session.user if getattr(frappe.local, "session", None) else "Administrator",
+		"timestamp": now()
+	}
+
+	site = frappe.local.site
+	with _local_buffer_lock:
+		held = list(_local_buffer.pop(site, ()))
+	events = held + [event]
+
+	try:
+		cache = frappe.cache()
+		key = cache.make_key(AUDIT_BUFFER_KEY)
+		limit = cint(frappe.conf.get("audit_buffer_limit")) or DEFAULT_BUFFER_LIMIT
+
+		pipe = cache.pipeline()
+		pipe.rpush(key, *[json.dumps(item) for item in events])
+		pipe.ltrim(key, -limit, -1)
+		length, _ = pipe.execute()
+
+		if held:
+			frappe.logger("health_core").info(f"Health Core: {len(held)} audit events held while Redis was down moved to the buffer")
+		if length > limit:
+			frappe.logger("health_core").warning("Health Core audit buffer full, oldest events dropped")
+
+		batch_size = get_batch_size()
+		if length == len(events) or length // batch_size > (length - len(events)) // batch_size:
+			enqueue_flush()
+	except Exception:
+		with _local_buffer_lock:
+			_local_buffer[site].extend(events)
+
+
+def get_batch_size():
+	return cint(frappe.conf.get("audit_flush_batch_size")) or DEFAULT_BATCH_SIZE
+
+
+def enqueue_flush():
+	"""Queues a flush job unless one is already waiting (RQ job deduplication needs Frappe v15+)."""
+	cache = frappe.cache()
+	if not cache.set(cache.make_key(FLUSH_QUEUED_KEY), 1, nx=True, ex=FLUSH_QUEUED_TTL):
+		return
+
+	frappe.enqueue(
+		"health_core.utils.audit.flush_audit_buffer",
+		queue="short",
+		enqueue_after_commit=True
+	)
+
+
+def pop_batch(size):
+	"""Atomically removes and returns up to `size` events from the head of the buffer."""
+	cache = frappe.cache()
+	key = cache.make_key(AUDIT_BUFFER_KEY)
+
+	pipe = cache.pipeline()
+	pipe.lrange(key, 0, size - 1)
+	pipe.ltrim(key, size, -1)
+	items, _ = pipe.execute()
+
+	return [json.loads(frappe.safe_decode(item)) for item in items]
+
+
+def write_events(events):
+	"""
+	Writes audit events as Communication records with a single bulk insert.
+
+	This skips the per-document insert path (hooks, timeline links, permission
+	checks); the records have the same fields `create_audit_log` always wrote.
+	"""
+	if not events:
+		return
+
+	values = []
+	for event in events:
+		timestamp = event["timestamp"]
+		values.append((
+			frappe.generate_hash(length=10),
+			timestamp,
+			timestamp,
+			event.get("user") or "Administrator",
+			event.get("user") or "Administrator",
+			0,
+			0,
+			"Automated Message",
+			"Email",
+			"Sent",
+			"Linked",
+			f"Health Core SMTP Setup - {event['action']}",
+			f"<p><strong>Action:</strong> {event['action']}</p><p><strong>Details:</strong> {event['details']}</p><p><strong>Status:</strong> {event['status']}</p>",
+			"Administrator",
+			"Email Account",
+			timestamp
+		))
+
+	frappe.db.bulk_insert("Communication", COMMUNICATION_FIELDS, values)
+
+
+def flush_audit_buffer():
+	"""
+	Background flusher: drains the Redis audit buffer into Communication in batches.
+	Runs from the scheduler and whenever `log_event` queues it.
+
+	Returns:
+		int: Number of events written
+	"""
+	# Events logged from here on queue a new job
+	cache = frappe.cache()
+	cache.delete(cache.make_key(FLUSH_QUEUED_KEY))
+
+	batch_size = get_batch_size()
+	written = 0
+
+	while True:
+		events = pop_batch(batch_size)
+		if not events:
+			break
+
+		try:
+			write_events(events)
+			frappe.db.commit()
+		except Exception:
+			frappe.db.rollback()
+			# Put the batch back at the head so it is retried on the next flush
+			cache = frappe.cache()
+			pipe = cache.pipeline()
+			pipe.lpush(cache.make_key(AUDIT_BUFFER_KEY), *[json.dumps(event) for event in reversed(events)])
+			pipe.execute()
+			frappe.log_error(title="Health Core: audit log flush failed")
+			break
+
+		written += len(events)
+		if len(events) < batch_size:
+			break
+
+	return written
+
+
+def flush_local_buffer():
+	"""
+	Writes events still held in this process (because Redis was unavailable)
+	straight to the database. Registered to run when the worker shuts down.
+	"""
+	with _local_buffer_lock:
+		pending = {site: list(events) for site, events in _local_buffer.items() if events}
+		_local_buffer.clear()
+
+	for site, events in pending.items():
+		try:
+			frappe.init(site=site)
+			frappe.connect()
+			write_events(events)
+			frappe.db.commit()
+		except Exception as e:
+			frappe.logger("health_core").error(f"Health Core: failed to write {len(events)} buffered audit events for {site}: {e}")
+		finally:
+			frappe.destroy()
+
+
+atexit.register(flush_local_buffer)
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+Email Queue backlog analytics.
+
+All figures come from a few GROUP BY queries, never from rows loaded into
+Python. The status and per-account/age aggregates only read the composite
+index on (status, email_account, creation) that health_core adds to Email
+Queue, so they stay fast with millions of rows; the result is cached in Redis
+for a few seconds so dashboards polling it do not repeat the scans.
+"""
+from __future__ import unicode_literals
+
+import frappe
+from frappe.utils import add_to_date, cint, get_datetime, now_datetime
+
+
+BACKLOG_KEY = "health_core:queue_backlog"
+BACKLOG_INDEX = "health_core_backlog_index"
+BACKLOG_INDEX_FIELDS = ["status", "email_account", "creation"]
+DEFAULT_BACKLOG_TTL = 15
+
+PENDING_STATUSES = ("Not Sent", "Partially Sent")
+
+# (label, upper bound of the age in seconds); the last bucket is open-ended
+AGE_BUCKETS = (
+	("under_1m", 60),
+	("1m_5m", 300),
+	("5m_1h", 3600),
+	("1h_1d", 86400),
+	("over_1d", None)
+)
+
+
+def get_backlog():
+	"""
+	Returns the backlog aggregates, cached for `queue_backlog_cache_ttl`
+	seconds (default 15).
+	"""
+	cache = frappe.cache()
+	backlog = cache.get_value(BACKLOG_KEY)
+	if backlog is None:
+		backlog = compute_backlog()
+		ttl = cint(frappe.conf.get("queue_backlog_cache_ttl")) or DEFAULT_BACKLOG_TTL
+		cache.set_value(BACKLOG_KEY, backlog, expires_in_sec=ttl)
+	return backlog
+
+
+def get_age_conditions(now):
+	"""
+	Returns the SELECT expressions counting pending rows per age bucket, and
+	their query values (bucket boundaries as creation timestamps).
+	"""
+	columns = []
+	values = {}
+	lower = None
+
+	for i, (label, upper) in enumerate(AGE_BUCKETS):
+		conditions = []
+		if upper is not None:
+			values["age_{0}".format(i)] = add_to_date(now, seconds=-upper)
+			conditions.append("creation > %(age_{0})s".format(i))
+		if lower is not None:
+			conditions.append("creation <= %({0})s".format(lower))
+		lower = "age_{0}".format(i) if upper is not None else None
+
+		columns.append("sum(case when {0} then 1 else 0 end) as `{1}`".format(" and ".join(conditions), label))
+
+	return columns, values
+
+
+def compute_backlog(now=None):
+	"""
+	Aggregates the Email Queue.
+
+	Returns:
+		dict: `by_status` counts, pending rows `by_account` and `by_age`, the
+			total `pending`, `oldest_pending_seconds` and pending rows `by_attempts`,
+			keyed by `health_core_attempts` (failed sends so far)
+	"""
+	now = now or now_datetime()
+	age_columns, values = get_age_conditions(now)
+	values["pending"] = PENDING_STATUSES
+
+	by_status = frappe.db.sql("""
+		select status, count(*) as count
+		from `tabEmail Queue`
+		group by status
+	""", as_dict=True)
+
+	accounts = frappe.db.sql("""
+		select coalesce(email_account, '') as email_account, count(*) as count,
+			min(creation) as oldest, {age_columns}
+		from `tabEmail Queue`
+		where status in %(pending)s
+		group by email_account
+	""".format(age_columns=", ".join(age_columns)), values, as_dict=True)
+
+	# Frappe's own retry column misses connection and refused-recipient errors
+	by_attempts = frappe.db.sql("""
+		select health_core_attempts as attempts, count(*) as count
+		from `tabEmail Queue`
+		where status in %(pending)s
+		group by health_core_attempts
+		order by health_core_attempts
+	""", values, as_dict=True)
+
+	by_age = dict.fromkeys((label for label, _ in AGE_BUCKETS), 0)
+	by_account = []
+	oldest = None
+
+	for row in accounts:
+		age = {label: cint(row.get(label)) for label, _ in AGE_BUCKETS}
+		for label, count in age.items():
+			by_age[label] += count
+
+		oldest_seconds = max(int((now - get_datetime(row.oldest)).total_seconds()), 0)
+		oldest = oldest_seconds if oldest is None else max(oldest, oldest_seconds)
+
+		by_account.append({
+			"email_account": row.email_account or None,
+			"pending": cint(row.count),
+			"oldest_pending_seconds": oldest_seconds,
+			"by_age": age
+		})
+
+	by_account.sort(key=lambda row: row["pending"], reverse=True)
+
+	return {
+		"generated_at": str(now),
+		"pending": sum(row["pending"] for row in by_account),
+		"oldest_pending_seconds": oldest,
+		"by_status": {row.status: cint(row.count) for row in by_status},
+		"by_account": by_account,
+		"by_age": by_age,
+		"by_attempts": {cint(row.attempts): cint(row.count) for row in by_attempts}
+	}
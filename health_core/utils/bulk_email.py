@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import json
+import re
+import smtplib
+import time
+
+import frappe
+from frappe.utils import cint
+
+from health_core.utils.metrics import inc
+from health_core.utils.routing import is_failover_error, record_send, route_accounts
+from health_core.utils.smtp_pool import (
+	build_message,
+	get_account_settings,
+	get_pool,
+	get_pool_key
+)
+
+
+DEFAULT_MAX_RECIPIENTS_PER_MESSAGE = 100
+DEFAULT_MAX_RECIPIENTS_PER_REQUEST = 10000
+
+# Single compiled pattern applied to the whole list in one pass
+EMAIL_PATTERN = re.compile(r"^[^@\s<>,;\"]+@[A-Za-z0-9-]+(\.[A-Za-z0-9-]+)+$")
+SEPARATORS = re.compile(r"[\s,;]+")
+
+
+def parse_recipients(recipients):
+	"""
+	Accepts recipients as a list, a JSON list or a comma/semicolon/newline separated string.
+
+	Returns:
+		list: Stripped, non-empty addresses in the given order
+	"""
+	if isinstance(recipients, str):
+		stripped = recipients.strip()
+		if stripped.startswith("["):
+			recipients = json.loads(stripped)
+		else:
+			recipients = SEPARATORS.split(stripped)
+
+	return [address.strip() for address in (recipients or []) if address and address.strip()]
+
+
+def validate_recipients(recipients):
+	"""
+	Validates and de-duplicates (case-insensitively) a list of addresses.
+
+	Returns:
+		tuple: (valid addresses, invalid addresses), each in the given order
+	"""
+	seen = set()
+	valid = []
+	invalid = []
+	match = EMAIL_PATTERN.match
+
+	for address in recipients:
+		normalized = address.lower()
+		if normalized in seen:
+			continue
+		seen.add(normalized)
+		(valid if match(address) else invalid).append(address)
+
+	return valid, invalid
+
+
+def chunk(items, size):
+	for i in range(0, len(items), size):
+		yield items[i:i + size]
+
+
+def iter_bulk_send(recipients, subject, message, email_account=None):
+	"""
+	Sends one message to many recipients over a single pooled SMTP session.
+
+	The message is built once. Recipients are sent in groups of up to
+	`smtp_max_recipients` RCPT TOs per DATA, with the recipient list kept out of
+	the headers. All database lookups happen before this function returns, so
+	the returned iterator only does SMTP and Redis work and can be streamed
+	after the request has finished.
+
+	Without an `email_account` the message is sent from a routed account; the
+	other available routing pool accounts are prepared as failovers in case it
+	is throttled or unreachable part-way through. Like `send_mail`, each group's
+	outcome is recorded for routing, so a throttling reply takes the account out
+	of the pool and the queue flush; the site must be initialised while the
+	iterator runs.
+
+	Args:
+		recipients: Addresses as accepted by `parse_recipients`
+		subject (str): Email subject
+		message (str): HTML body
+		email_account (str): Email Account to send from. Defaults to a routed or the default outgoing account.
+
+	Returns:
+		tuple: (summary dict with `valid` and `invalid` counts, iterator of per-recipient outcomes)
+	"""
+	valid, invalid = validate_recipients(parse_recipients(recipients))
+
+	limit = cint(frappe.conf.get("bulk_email_max_recipients")) or DEFAULT_MAX_RECIPIENTS_PER_REQUEST
+	if len(valid) > limit:
+		frappe.throw(f"Too many recipients: {len(valid)} (maximum {limit} per request)")
+
+	accounts = [email_account] if email_account else route_accounts()
+	if not accounts:
+		frappe.throw("No default outgoing email account configured")
+
+	senders = []
+	for account in accounts:
+		settings = get_account_settings(account)
+		msg = build_message(settings, ["undisclosed-recipients:;"], subject, message).as_bytes()
+		senders.append((get_pool_key(account), settings, msg))
+	group_size = cint(frappe.conf.get("smtp_max_recipients")) or DEFAULT_MAX_RECIPIENTS_PER_MESSAGE
+
+	summary = {"valid": len(valid), "invalid": len(invalid), "email_account": accounts[0]}
+	key, settings, msg = senders[0]
+	outcomes = _send_groups(get_pool(), key, settings, msg, valid, invalid, group_size, senders[1:])
+
+	return summary, outcomes
+
+
+def _send_groups(pool, key, settings, msg, valid, invalid, group_size, failovers=()):
+	failovers = list(failovers)
+
+	for address in invalid:
+		yield {"recipient": address, "status": "invalid", "error": "Invalid email address"}
+
+	for group in chunk(valid, group_size):
+		error = None
+		while True:
+			start = time.perf_counter()
+			try:
+				refused = pool.send(key, settings, settings.email_id, group, msg)
+				record_send(key[1], time.perf_counter() - start)
+			except Exception as e:
+				record_send(key[1], error=e)
+				if failovers and is_failover_error(e):
+					# Resend this group, and send the rest, from the next account
+					inc("health_core_route_failovers_total", email_account=key[1], error=type(e).__name__)
+					key, settings, msg = failovers.pop(0)
+					continue
+				if isinstance(e, smtplib.SMTPRecipientsRefused):
+					refused = e.recipients
+				else:
+					error = e
+			break
+
+		if error:
+			for address in group:
+				yield {"recipient": address, "status": "failed", "error": str(error)}
+			continue
+
+		for address in group:
+			if address in refused:
+				code, response = refused[address]
+				yield {
+					"recipient": address,
+					"status": "failed",
+					"error": "{0} {1}".format(code, frappe.safe_decode(response))
+				}
+			else:
+				yield {"recipient": address, "status": "sent"}
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import copy
+import json
+import threading
+import time
+
+import frappe
+from frappe.utils import cint
+
+
+# Counter bumped whenever an Email Account is inserted, updated or trashed.
+# Cached values derived from Email Accounts are stored with the version they
+# were computed at and are discarded as soon as it changes.
+EMAIL_ACCOUNT_VERSION_KEY = "health_core:email_account_version"
+SMTP_STATUS_KEY = "health_core:smtp_status"
+EMAIL_ACCOUNTS_KEY = "health_core:email_accounts"
+EMAIL_ACCOUNTS_RESPONSE_KEY = "health_core:email_accounts_response:{0}"
+
+DEFAULT_STATUS_TTL = 60
+# Listings are invalidated by the version counter; the TTL only bounds memory
+DEFAULT_LISTING_TTL = 3600
+
+EMAIL_ACCOUNT_LISTING_FIELDS = [
+	"name", "email_account_name", "email_id", "smtp_server",
+	"smtp_port", "use_tls", "use_ssl", "enable_outgoing",
+	"default_outgoing", "service"
+]
+
+# In-process cache: (site, key) -> (expires_at, version, value)
+_local_cache = {}
+_local_cache_lock = threading.Lock()
+
+
+def get_email_account_version():
+	"""
+	Returns the current Email Account version for this site (a single Redis GET).
+
+	redis_cache evicts keys and is not persistent, so a missing counter is
+	seeded from the clock in milliseconds. That is ahead of any version handed
+	out before it was lost (bumps add one per Email Account change), so stale
+	local entries and old ETags never match a re-seeded version.
+	"""
+	cache = frappe.cache()
+	key = cache.make_key(EMAIL_ACCOUNT_VERSION_KEY)
+	version = cache.get(key)
+	if version is None:
+		cache.set(key, int(time.time() * 1000), nx=True)
+		version = cache.get(key)
+	return cint(version)
+
+
+def bump_email_account_version(doc=None, method=None):
+	"""
+	doc_event handler for Email Account `after_insert`, `on_update` and `on_trash`.
+
+	Bumps the version once the transaction commits, so no reader can cache
+	pre-commit data under the new version.
+	"""
+	site = frappe.local.site
+
+	def bump():
+		# Seed a lost counter first; INCR on a missing key would restart it at 1
+		get_email_account_version()
+		cache = frappe.cache()
+		cache.incr(cache.make_key(EMAIL_ACCOUNT_VERSION_KEY))
+		clear_local_cache(site)
+
+	frappe.db.after_commit.add(bump)
+
+
+def clear_local_cache(site=None):
+	with _local_cache_lock:
+		for key in list(_local_cache):
+			if site is None or key[0] == site:
+				del _local_cache[key]
+
+
+def get_versioned_value(key, generator, ttl, version=None):
+	"""
+	Returns a value derived from Email Accounts, computing it only on a miss.
+
+	Lookups go to the in-process cache first, then Redis; both are keyed by the
+	current Email Account version and expire after `ttl` seconds. Only on a miss
+	is `generator` called (and the database touched).
+
+	Args:
+		key (str): Cache key
+		generator (callable): Computes the value
+		ttl (int): Seconds to keep the value
+		version (int): Email Account version, if the caller has already read it
+
+	Returns:
+		A deep copy of the cached value
+	"""
+	if version is None:
+		version = get_email_account_version()
+	local_key = (frappe.local.site, key)
+	now = time.monotonic()
+
+	entry = _local_cache.get(local_key)
+	if entry and entry[0] > now and entry[1] == version:
+		return copy.deepcopy(entry[2])
+
+	cached = frappe.cache().get_value(key, expires=True)
+	if cached and cached.get("version") == version:
+		value = cached["value"]
+	else:
+		value = generator()
+		frappe.cache().set_value(key, {"version": version, "value": value}, expires_in_sec=ttl)
+
+	with _local_cache_lock:
+		_local_cache[local_key] = (now + ttl, version, value)
+
+	return copy.deepcopy(value)
+
+
+def get_cached_smtp_status():
+	"""
+	Returns `validate_smtp_configuration()`, cached in Redis and in-process.
+
+	The TTL is `smtp_status_cache_ttl` seconds from site config (default 60);
+	any Email Account change invalidates it immediately.
+
+	Returns:
+		dict: Configuration status and details
+	"""
+	from health_core.setup.install import validate_smtp_configuration
+
+	ttl = cint(frappe.conf.get("smtp_status_cache_ttl")) or DEFAULT_STATUS_TTL
+	return get_versioned_value(SMTP_STATUS_KEY, validate_smtp_configuration, ttl)
+
+
+def get_listing_ttl():
+	return cint(frappe.conf.get("email_account_listing_cache_ttl")) or DEFAULT_LISTING_TTL
+
+
+def get_email_account_listing(version=None):
+	"""Returns the Email Account listing shown by the account endpoints, cached by version."""
+	return get_versioned_value(
+		EMAIL_ACCOUNTS_KEY,
+		lambda: frappe.get_all(
+			"Email Account",
+			fields=EMAIL_ACCOUNT_LISTING_FIELDS,
+			order_by="default_outgoing desc, creation desc"
+		),
+		get_listing_ttl(),
+		version=version
+	)
+
+
+def etag_matches(etag):
+	header = frappe.get_request_header("If-None-Match")
+	if not header:
+		return False
+	if header.strip() == "*":
+		return True
+	# Proxies that compress responses (e.g. nginx gzip) turn the ETag into a weak one
+	for candidate in header.split(","):
+		candidate = candidate.strip()
+		if (candidate[2:] if candidate.startswith("W/") else candidate) == etag:
+			return True
+	return False
+
+
+def get_conditional_response(variant, generator):
+	"""
+	Serves a payload derived from Email Accounts with a version-based ETag.
+
+	A request whose `If-None-Match` matches the current version gets a 304
+	after a single Redis read. Otherwise the serialized payload is served from
+	the versioned cache, and `generator` only runs (touching the database) on a
+	miss. Outside an HTTP request the payload is returned as a dict.
+
+	Args:
+		variant (str): Distinguishes payloads of different endpoints or permission levels
+		generator (callable): Builds the payload, given the Email Account version
+
+	Returns:
+		Response or dict: The response, or the payload when not serving a request
+	"""
+	version = get_email_account_version()
+	etag = '"{0}-{1}"'.format(variant, version)
+	request = getattr(frappe.local, "request", None)
+
+	if request and etag_matches(etag):
+		return make_response(etag, status=304)
+
+	body = get_versioned_value(
+		EMAIL_ACCOUNTS_RESPONSE_KEY.format(variant),
+		lambda: frappe.as_json({"message": generator(version)}, indent=None),
+		get_listing_ttl(),
+		version=version
+	)
+
+	if not request:
+		return json.loads(body)["message"]
+
+	return make_response(etag, body)
+
+
+def make_response(etag, body=None, status=200):
+	from werkzeug.wrappers import Response
+
+	response = Response(body, status=status, mimetype="application/json")
+	response.headers["ETag"] = etag
+	# Clients may keep the response but must revalidate it on every poll
+	response.headers["Cache-Control"] = "private, no-cache"
+	return response
+
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+Enqueue-time deduplication of outgoing email.
+
+A message is identified by a 128-bit hash of its recipients, subject, body and
+reference. The first message with a given hash claims it in Redis
+(`SET NX EX`) for `email_dedup_window` seconds; identical messages inside the
+window are dropped (Email Queue rows are cancelled) or merged (test email jobs
+return the first job's id) before they reach SMTP. If Redis is unreachable each
+worker falls back to an in-process table with the same expiry. A claim made by
+an Email Queue row is released if the row's transaction rolls back, so a retry
+of the same message is not mistaken for a duplicate.
+"""
+from __future__ import unicode_literals
+import hashlib
+import re
+import threading
+import time
+
+import frappe
+
+from health_core.utils.metrics import inc
+
+
+DEDUP_KEY = "health_core:dedup:{0}"
+DEFAULT_WINDOW = 60
+LOCAL_LIMIT = 10000
+
+# Parts of a serialized MIME message that differ between otherwise identical messages
+VOLATILE_MIME = re.compile(r"^(?:Message-Id|Date):.*$|={15}\d+==", re.IGNORECASE | re.MULTILINE)
+
+# digest -> (expires at, value)
+_local_claims = {}
+_local_claims_lock = threading.Lock()
+
+
+def get_window():
+	"""Seconds within which identical messages are deduplicated; 0 disables it."""
+	window = frappe.conf.get("email_dedup_window")
+	return DEFAULT_WINDOW if window is None else int(window)
+
+
+def message_hash(recipients, subject, body, reference=None):
+	"""
+	Returns a compact hex digest identifying a message.
+
+	Args:
+		recipients (list): Addresses; order and case are ignored
+		subject (str): Email subject
+		body (str): Message body
+		reference: Anything else that makes the message distinct (e.g. the sending account)
+	"""
+	if isinstance(recipients, str):
+		recipients = [recipients]
+
+	digest = hashlib.blake2b(digest_size=16)
+	for part in (
+		",".join(sorted(address.strip().lower() for address in recipients)),
+		subject or "",
+		body or "",
+		repr(reference)
+	):
+		digest.update(frappe.safe_encode(part))
+		digest.update(b"\0")
+	return digest.hexdigest()
+
+
+def claim(digest, value, window):
+	"""
+	Claims `digest` for `window` seconds.
+
+	Returns:
+		str: The value stored by an earlier claim still inside the window, or None if this claim is the first
+	"""
+	try:
+		cache = frappe.cache()
+		key = cache.make_key(DEDUP_KEY.format(digest))
+		if cache.set(key, value, ex=window, nx=True):
+			return None
+		existing = cache.get(key)
+		return frappe.safe_decode(existing) if existing is not None else None
+	except Exception:
+		return claim_local(digest, value, window)
+
+
+def release(digest):
+	"""Drops a claim, e.g. because the message that made it was never committed."""
+	try:
+		cache = frappe.cache()
+		cache.delete(cache.make_key(DEDUP_KEY.format(digest)))
+	except Exception:
+		pass
+
+	with _local_claims_lock:
+		_local_claims.pop((getattr(frappe.local, "site", None), digest), None)
+
+
+def claim_local(digest, value, window, now=None):
+	"""In-process stand-in for `claim`, used while Redis is unavailable."""
+	now = now or time.monotonic()
+	key = (getattr(frappe.local, "site", None), digest)
+
+	with _local_claims_lock:
+		if len(_local_claims) >= LOCAL_LIMIT:
+			for stale in [k for k, (expires_at, _) in _local_claims.items() if expires_at <= now]:
+				del _local_claims[stale]
+			if len(_local_claims) >= LOCAL_LIMIT:
+				_local_claims.clear()
+
+		existing = _local_claims.get(key)
+		if existing and existing[0] > now:
+			return existing[1]
+
+		_local_claims[key] = (now + window, value)
+
+	return None
+
+
+def find_duplicate(source, recipients, subject, body, reference=None, value="1", release_on_rollback=False):
+	"""
+	Checks a message against the dedup window and claims it if it is new.
+
+	Args:
+		source (str): Where the message comes from, for the skip metric (`job`, `queue`)
+		value (str): Stored with the claim and returned to later duplicates, e.g. a job id
+		release_on_rollback (bool): Release a new claim if the current transaction rolls back
+
+	Returns:
+		str: The first message's value if this one is a duplicate, otherwise None
+	"""
+	window = get_window()
+	if window <= 0:
+		return None
+
+	digest = message_hash(recipients, subject, body, reference)
+	existing = claim(digest, value, window)
+	if existing is not None:
+		inc("health_core_email_duplicates_total", source=source)
+	elif release_on_rollback:
+		frappe.db.after_rollback.add(lambda: release(digest))
+	return existing
+
+
+def get_cancelled_status():
+	"""
+	Email Queue status for a dropped duplicate: "Cancelled" where the installed
+	Frappe has it, otherwise "Expired", which the queue also never sends.
+	"""
+	options = (frappe.get_meta("Email Queue").get_field("status").options or "").split("\n")
+	return "Cancelled" if "Cancelled" in options else "Expired"
+
+
+def cancel_duplicate(doc, method=None):
+	"""
+	doc_event handler for Email Queue `before_insert`: cancels a row identical
+	to one queued within the window, so it is never sent.
+	"""
+	if doc.get("status") not in (None, "", "Not Sent"):
+		return
+
+	recipients = [recipient.get("recipient") for recipient in doc.get("recipients") or [] if recipient.get("recipient")]
+	body = VOLATILE_MIME.sub("", doc.get("message") or "")
+	reference = (doc.get("sender"), doc.get("reference_doctype"), doc.get("reference_name"))
+
+	if find_duplicate("queue", recipients, "", body, reference, release_on_rollback=True) is not None:
+		doc.status = get_cancelled_status()
+		doc.error = "Duplicate of a message queued within the last {0} seconds".format(get_window())
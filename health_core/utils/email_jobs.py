@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import time
+
+import frappe
+from frappe.utils import now
+
+from health_core.utils.dedup import find_duplicate
+from health_core.utils.metrics import publish_metrics
+from health_core.utils.smtp_pool import send_mail
+
+
+JOB_KEY = "health_core:email_job:{0}"
+JOB_TTL = 3600
+
+# Fields of a job record that are safe to show to guests
+PUBLIC_FIELDS = ("job_id", "status", "queued_at", "started_at", "finished_at", "timings", "error")
+
+
+def enqueue_email_job(recipient_email, subject, message, email_account, audit_action=None, sent_by=None,
+		dedup_content=None):
+	"""
+	Queues an email to be sent by a background worker and returns immediately.
+
+	An identical email (same recipient, subject, content and account) queued
+	within `email_dedup_window` seconds is not queued again; the earlier job's
+	id is returned instead.
+
+	Args:
+		recipient_email (str): Recipient address
+		subject (str): Email subject
+		message (str): HTML body
+		email_account (str): Email Account to send from
+		audit_action (str): If set, an audit log "<audit_action> Sent/Failed" is written when the job finishes
+		sent_by (str): User who requested the send, recorded in the audit log
+		dedup_content (str): What identifies the content for deduplication
+			instead of `message`, for bodies with volatile parts such as a timestamp
+
+	Returns:
+		str: Job id to pass to `get_job_status`
+	"""
+	job_id = frappe.generate_hash(length=16)
+
+	duplicate_of = find_duplicate(
+		"job", recipient_email, subject, message if dedup_content is None else dedup_content,
+		email_account, value=job_id
+	)
+	if duplicate_of:
+		return duplicate_of
+
+	set_job_status(job_id, {
+		"job_id": job_id,
+		"status": "queued",
+		"recipient": recipient_email,
+		"email_account": email_account,
+		"queued_at": now()
+	})
+
+	frappe.enqueue(
+		"health_core.utils.email_jobs.run_email_job",
+		queue="short",
+		job_id=JOB_KEY.format(job_id),
+		email_job_id=job_id,
+		recipient_email=recipient_email,
+		subject=subject,
+		message=message,
+		email_account=email_account,
+		audit_action=audit_action,
+		sent_by=sent_by
+	)
+
+	return job_id
+
+
+def run_email_job(email_job_id, recipient_email, subject, message, email_account,
+		audit_action=None, sent_by=None):
+	"""
+	Background job: sends the email over the pooled SMTP session and records
+	the outcome and per-phase SMTP timings on the job.
+	"""
+	from health_core.setup.install import create_audit_log
+
+	job_id = email_job_id
+	job = get_job(job_id) or {"job_id": job_id}
+	job.update({"status": "sending", "started_at": now()})
+	set_job_status(job_id, job)
+
+	timings = {}
+	start = time.perf_counter()
+
+	try:
+		send_mail(
+			recipients=[recipient_email],
+			subject=subject,
+			message=message,
+			email_account=email_account,
+			reference_doctype="Email Account",
+			reference_name=email_account,
+			timings=timings
+		)
+	except Exception as e:
+		frappe.logger().error(f"Failed to send test email: {str(e)}")
+		job.update({"status": "failed", "error": str(e)})
+
+		if audit_action:
+			create_audit_log(
+				action=f"{audit_action} Failed",
+				details=f"Failed to send test email to {recipient_email}: {str(e)}",
+				status="Failed"
+			)
+	else:
+		job.update({"status": "sent"})
+
+		if audit_action:
+			create_audit_log(
+				action=f"{audit_action} Sent",
+				details=f"Test email sent to {recipient_email} by user {sent_by}",
+				status="Success"
+			)
+
+	timings["total"] = (time.perf_counter() - start) * 1000
+	job.update({
+		"finished_at": now(),
+		"timings": {phase: round(ms, 2) for phase, ms in timings.items()}
+	})
+	set_job_status(job_id, job)
+	publish_metrics()
+
+
+def get_job(job_id):
+	return frappe.cache().get_value(JOB_KEY.format(job_id))
+
+
+def set_job_status(job_id, job):
+	frappe.cache().set_value(JOB_KEY.format(job_id), job, expires_in_sec=JOB_TTL)
+
+
+def get_job_status(job_id, public=False):
+	"""
+	Returns the current state of an email job.
+
+	Args:
+		job_id (str): Id returned by `enqueue_email_job`
+		public (bool): Only include fields that are safe to show to guests
+
+	Returns:
+		dict: Job status (`queued`, `sending`, `sent` or `failed`), timings and error
+	"""
+	job = get_job(job_id) if job_id else None
+
+	if not job:
+		return {
+			"status": "error",
+			"message": "Unknown or expired job id"
+		}
+
+	if public:
+		job = {key: job.get(key) for key in PUBLIC_FIELDS if key in job}
+
+	return job
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""
+Load-following Email Queue flush schedule.
+
+Instead of flushing on a fixed cron interval, a scheduled job runs every
+scheduler tick and flushes in a loop, adjusting the pause between flushes
+and the batch size after each one:
+
+	busy     rows are still waiting after a flush that sent something:
+	         halve the interval (down to `email_flush_min_interval`) and size
+	         the batch to the backlog, but no bigger than the measured send
+	         rate can clear in `email_flush_target_seconds`
+	idle     nothing waiting: double the interval (up to
+	         `email_flush_max_interval`) and shrink the batch
+	stalled  rows are waiting but nothing could be sent (provider down,
+	         every account throttled): double the interval
+
+An interval shorter than the tick is slept inside the job; a longer one
+makes the following ticks return straight away until it has passed (while
+idle, a tick that finds rows waiting flushes anyway). The
+controller's state lives in Redis, so every worker follows the same schedule,
+and the resident email worker reads its batch size from it.
+"""
+from __future__ import unicode_literals
+import time
+
+import frappe
+from frappe.utils import cint, flt, now_datetime
+
+
+STATE_KEY = "health_core:flush_schedule"
+LOCK_KEY = "health_core:flush_schedule:lock"
+
+DEFAULT_MIN_INTERVAL = 0.5
+DEFAULT_MAX_INTERVAL = 300
+DEFAULT_MIN_BATCH = 20
+DEFAULT_MAX_BATCH = 2000
+DEFAULT_TARGET_SECONDS = 10
+DEFAULT_TICK_SECONDS = 50
+# Weight of the latest flush in the smoothed send rate
+RATE_SMOOTHING = 0.3
+
+
+def get_bounds():
+	"""Controller limits from site config."""
+	min_interval = flt(frappe.conf.get("email_flush_min_interval")) or DEFAULT_MIN_INTERVAL
+	min_batch = cint(frappe.conf.get("email_flush_min_batch")) or DEFAULT_MIN_BATCH
+	return frappe._dict(
+		min_interval=min_interval,
+		max_interval=max(flt(frappe.conf.get("email_flush_max_interval")) or DEFAULT_MAX_INTERVAL, min_interval),
+		min_batch=min_batch,
+		max_batch=max(cint(frappe.conf.get("email_flush_max_batch")) or DEFAULT_MAX_BATCH, min_batch),
+		target_seconds=flt(frappe.conf.get("email_flush_target_seconds")) or DEFAULT_TARGET_SECONDS
+	)
+
+
+def initial_state(bounds):
+	return {"interval": bounds.min_interval, "batch_size": bounds.min_batch, "rate": 0.0, "next_run": 0.0, "idle": False}
+
+
+def get_state(bounds=None):
+	"""
+	The current schedule: `interval`, `batch_size`, smoothed send `rate`,
+	`next_run` (epoch seconds) and whether the queue was `idle` last time.
+	"""
+	bounds = bounds or get_bounds()
+	state = initial_state(bounds)
+	state.update(frappe.cache().get_value(STATE_KEY, expires=True) or {})
+	state["interval"] = min(max(state["interval"], bounds.min_interval), bounds.max_interval)
+	state["batch_size"] = min(max(state["batch_size"], bounds.min_batch), bounds.max_batch)
+	return state
+
+
+def save_state(state):
+	frappe.cache().set_value(STATE_KEY, state)
+
+
+def get_pending_depth(limit):
+	"""
+	Rows the regular flush could claim right now, counted up to `limit` so
+	that a huge backlog costs no more to sample than a batch.
+	"""
+	return cint(frappe.db.sql("""
+		select count(*) from (
+			select name
+			from `tabEmail Queue`
+			where status in ('Not Sent', 'Partially Sent')
+				and (send_after is null or send_after <= %(now)s)
+				and health_core_next_attempt is null
+			limit %(limit)s
+		) pending
+	""", {"now": now_datetime(), "limit": limit})[0][0])
+
+
+def adjust(state, depth, result, elapsed, bounds):
+	"""
+	Feedback step: returns the schedule for the next flush.
+
+	Args:
+		state (dict): Current schedule, see `get_state`
+		depth (int): Rows still waiting after the flush
+		result (dict): The flush summary (`claimed`, `sent`, ...)
+		elapsed (float): Seconds the flush took
+		bounds: Limits from `get_bounds`
+	"""
+	state = dict(state)
+
+	if result["sent"] and elapsed > 0:
+		rate = result["sent"] / elapsed
+		state["rate"] = rate if not state["rate"] else (1 - RATE_SMOOTHING) * state["rate"] + RATE_SMOOTHING * rate
+
+	if depth and result["sent"]:
+		state["interval"] = max(state["interval"] / 2, bounds.min_interval)
+		batch_size = depth
+		if state["rate"]:
+			batch_size = min(batch_size, int(state["rate"] * bounds.target_seconds))
+	else:
+		state["interval"] = min(state["interval"] * 2, bounds.max_interval)
+		batch_size = state["batch_size"] if depth else state["batch_size"] // 2
+
+	state["batch_size"] = min(max(batch_size, bounds.min_batch), bounds.max_batch)
+	state["idle"] = not depth
+	return state
+
+
+def record_flush(result, elapsed, state=None, bounds=None):
+	"""
+	Feeds one flush's outcome to the controller and stores the resulting schedule.
+
+	Returns:
+		dict: The new schedule
+	"""
+	bounds = bounds or get_bounds()
+	state = adjust(state or get_state(bounds), get_pending_depth(bounds.max_batch), result, elapsed, bounds)
+	state["next_run"] = time.time() + state["interval"]
+	save_state(state)
+	return state
+
+
+def acquire_lock(seconds):
+	"""Keeps overlapping ticks (or sites sharing a worker pool) from running the loop twice."""
+	cache = frappe.cache()
+	return bool(cache.set(cache.make_key(LOCK_KEY), 1, ex=int(seconds) + 10, nx=True))
+
+
+def release_lock():
+	cache = frappe.cache()
+	cache.delete(cache.make_key(LOCK_KEY))
+
+
+def adaptive_flush():
+	"""
+	Scheduled job (every tick): flushes the Email Queue for up to
+	`email_flush_tick_seconds`, as often and in batches as large as the
+	controller decides. Does nothing while a resident email worker is running,
+	or when disabled with `email_adaptive_flush: 0`.
+	"""
+	from health_core.utils.queue_flush import flush_queue
+	from health_core.utils.queue_worker import is_worker_running
+
+	if not cint(frappe.conf.get("email_adaptive_flush", 1)) or is_worker_running():
+		return
+
+	bounds = get_bounds()
+	state = get_state(bounds)
+	if state["next_run"] > time.time() and not (state["idle"] and get_pending_depth(1)):
+		return
+
+	tick = flt(frappe.conf.get("email_flush_tick_seconds")) or DEFAULT_TICK_SECONDS
+	if not acquire_lock(tick):
+		return
+
+	deadline = time.monotonic() + tick
+	try:
+		while True:
+			start = time.monotonic()
+			result = flush_queue(state["batch_size"])
+			state = record_flush(result, time.monotonic() - start, state, bounds)
+
+			if time.monotonic() + state["interval"] >= deadline:
+				break
+			time.sleep(state["interval"])
+			# Start a fresh transaction so rows committed meanwhile are visible
+			frappe.db.rollback()
+	finally:
+		release_lock()
+
+	return state
+
+
+def get_schedule_gauges():
+	"""Samples for the metrics endpoint: the controller's current interval, batch size and send rate."""
+	state = get_state()
+	return [
+		("health_core_flush_interval", {}, round(state["interval"], 3)),
+		("health_core_flush_batch", {}, state["batch_size"]),
+		("health_core_flush_rate", {}, round(state["rate"], 3)),
+	]
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+Priority lanes for the Email Queue.
+
+Every Email Queue row is tagged with a lane when it is inserted:
+
+	high    Patient-critical mail (OTPs, password resets, appointment confirmations)
+	normal  Everything else
+	bulk    Newsletters, campaigns and reminders sent to many recipients
+
+The sharded flush claims the high lane first, then splits the rest of each
+batch between normal and bulk by weight, with a cap on bulk rows per batch so
+a large campaign only ever holds up high-lane mail for one short batch.
+"""
+from __future__ import unicode_literals
+from contextlib import contextmanager
+
+import frappe
+from frappe.utils import cint, get_datetime, now_datetime
+
+from health_core.utils.metrics import inc, observe
+
+
+HIGH = "high"
+NORMAL = "normal"
+BULK = "bulk"
+LANES = (HIGH, NORMAL, BULK)
+
+# Share of the batch left after the high lane
+DEFAULT_WEIGHTS = {NORMAL: 3, BULK: 1}
+DEFAULT_MAX_BULK_BATCH = 100
+# Seconds from enqueue to sent before a row counts as an SLO miss
+DEFAULT_SLOS = {HIGH: 30, NORMAL: 300, BULK: 3600}
+DEFAULT_BULK_RECIPIENTS = 20
+
+# Lanes by the Email Queue row's reference doctype, unless overridden with
+# `email_lane_doctypes` in site config. Patient Appointment is left out: its
+# reminders are campaigns, so confirmations are tagged with `email_lane`.
+LANE_DOCTYPES = {
+	"User": HIGH,
+	"Newsletter": BULK,
+}
+
+LANE_INDEX = "health_core_lane_index"
+LANE_INDEX_FIELDS = ["health_core_lane", "status", "creation"]
+
+
+@contextmanager
+def email_lane(lane):
+	"""
+	Tags every Email Queue row inserted in the block with `lane`, e.g.
+
+		with email_lane("high"):
+			frappe.sendmail(recipients=[email], subject="Your login code", ...)
+	"""
+	previous = frappe.flags.health_core_email_lane
+	frappe.flags.health_core_email_lane = lane
+	try:
+		yield
+	finally:
+		frappe.flags.health_core_email_lane = previous
+
+
+def get_lane(doc):
+	"""
+	Picks the lane for an Email Queue row: an `email_lane` block wins, then
+	bulk markers (unsubscribe link, priority 0, more than
+	`email_lane_bulk_recipients` recipients), then the reference doctype. Bulk
+	markers go first so a campaign never lands in the high lane by doctype.
+	"""
+	if frappe.flags.health_core_email_lane in LANES:
+		return frappe.flags.health_core_email_lane
+
+	bulk_recipients = cint(frappe.conf.get("email_lane_bulk_recipients")) or DEFAULT_BULK_RECIPIENTS
+	if (
+		cint(doc.get("add_unsubscribe_link"))
+		or (doc.get("priority") is not None and cint(doc.get("priority")) <= 0)
+		or len(doc.get("recipients") or []) > bulk_recipients
+	):
+		return BULK
+
+	doctypes = dict(LANE_DOCTYPES, **(frappe.conf.get("email_lane_doctypes") or {}))
+	return doctypes.get(doc.get("reference_doctype")) or NORMAL
+
+
+def set_lane(doc, method=None):
+	"""doc_event handler for Email Queue `before_insert`."""
+	doc.health_core_lane = get_lane(doc)
+
+
+def get_weights():
+	weights = dict(DEFAULT_WEIGHTS, **(frappe.conf.get("email_lane_weights") or {}))
+	return max(cint(weights[NORMAL]), 0), max(cint(weights[BULK]), 0)
+
+
+def get_max_bulk_batch():
+	return cint(frappe.conf.get("email_lane_max_bulk_batch")) or DEFAULT_MAX_BULK_BATCH
+
+
+def get_slo(lane):
+	return (frappe.conf.get("email_lane_slos") or {}).get(lane) or DEFAULT_SLOS[lane]
+
+
+def split_remaining(remaining):
+	"""
+	Returns the normal lane's share of the batch space left after the high
+	lane; bulk gets the rest, up to `email_lane_max_bulk_batch`, plus anything
+	normal leaves unused.
+	"""
+	normal, bulk = get_weights()
+	if not normal + bulk:
+		return remaining
+	return -(-remaining * normal // (normal + bulk))
+
+
+def record_sent(lane, seconds):
+	"""Records one row's enqueue-to-sent latency for its lane, counting SLO misses."""
+	observe("health_core_lane_latency_seconds", seconds, lane=lane)
+	if seconds > get_slo(lane):
+		inc("health_core_lane_slo_missed_total", lane=lane)
+
+
+def get_lane_gauges():
+	"""Samples for the metrics endpoint: pending rows and the oldest pending row's age per lane."""
+	rows = frappe.db.sql("""
+		select health_core_lane as lane, count(*) as count, min(creation) as oldest
+		from `tabEmail Queue`
+		where status in ('Not Sent', 'Partially Sent')
+		group by health_core_lane
+	""", as_dict=True)
+
+	now = now_datetime()
+	depth = {}
+	oldest = {}
+	for row in rows:
+		# Rows queued before lanes existed count as normal
+		lane = row.lane or NORMAL
+		depth[lane] = depth.get(lane, 0) + cint(row.count)
+		age = max(int((now - get_datetime(row.oldest)).total_seconds()), 0)
+		oldest[lane] = max(oldest.get(lane, 0), age)
+
+	samples = []
+	for lane in sorted(depth):
+		samples.append(("health_core_lane_depth", {"lane": lane}, depth[lane]))
+		samples.append(("health_core_lane_oldest_seconds", {"lane": lane}, oldest[lane]))
+	return samples
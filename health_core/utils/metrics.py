@@ -0,0 +1,364 @@
+# -*- coding: utf-8 -*-
+"""
+In-process metrics for health_core, exposed in the Prometheus text format.
+
+Every worker process keeps its own counters and histograms (one registry per
+site) and periodically publishes a snapshot to the site's Redis cache. The
+metrics endpoint merges the snapshots of all live workers, labelled by worker,
+and adds Email Queue depth and send rate read from the database at scrape time.
+"""
+from __future__ import unicode_literals
+import bisect
+import functools
+import json
+import os
+import socket
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+import frappe
+from frappe.utils import add_to_date, cint, now_datetime
+
+
+METRICS_KEY = "health_core:metrics"
+
+# Histogram buckets in seconds, from a fast local NOOP to a slow provider DATA
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+DEFAULT_PUBLISH_INTERVAL = 10
+DEFAULT_STALE_AFTER = 300
+SEND_RATE_WINDOW = 300
+
+# name -> (type, help)
+METRICS = {
+	"health_core_smtp_phase_seconds": (
+		"histogram", "SMTP phase duration (dns, connect, tls, ehlo, auth, noop, build, send)"
+	),
+	"health_core_tls_handshake_cpu_seconds": ("histogram", "CPU time spent in client TLS handshakes"),
+	"health_core_tls_handshakes_total": ("counter", "Client TLS handshakes, by whether the session was resumed"),
+	"health_core_smtp_probe_seconds": ("histogram", "SMTP health probe duration"),
+	"health_core_smtp_up": ("gauge", "Last SMTP health probe result (1 up, 0 down, -1 unknown)"),
+	"health_core_smtp_circuit_open": ("gauge", "1 while the account's SMTP circuit breaker is open or half-open"),
+	"health_core_endpoint_seconds": ("histogram", "Whitelisted endpoint duration"),
+	"health_core_endpoint_errors_total": ("counter", "Whitelisted endpoint calls that raised or returned an error"),
+	"health_core_queue_send_seconds": (
+		"histogram", "Time to send one Email Queue row, including Frappe's database work around the send"
+	),
+	"health_core_queue_db_seconds": ("histogram", "Email Queue claim and release queries"),
+	"health_core_lane_latency_seconds": ("histogram", "Email Queue rows' time from enqueue to sent, by priority lane"),
+	"health_core_lane_slo_missed_total": ("counter", "Email Queue rows sent later than their priority lane's latency SLO"),
+	"health_core_lane_depth": ("gauge", "Pending Email Queue rows by priority lane"),
+	"health_core_lane_oldest_seconds": ("gauge", "Age of the oldest pending Email Queue row by priority lane"),
+	"health_core_rate_limited_total": ("counter", "Calls rejected by the rate limiter"),
+	"health_core_email_duplicates_total": ("counter", "Identical messages dropped or merged within the dedup window, by source"),
+	"health_core_email_retries_scheduled_total": ("counter", "Failed Email Queue rows scheduled for a retry with backoff"),
+	"health_core_email_retries_abandoned_total": ("counter", "Email Queue rows marked Error after running out of attempts"),
+	"health_core_flush_interval": ("gauge", "Seconds between flushes chosen by the adaptive flush schedule"),
+	"health_core_flush_batch": ("gauge", "Rows per flush chosen by the adaptive flush schedule"),
+	"health_core_flush_rate": ("gauge", "Smoothed Email Queue send rate (rows per second) the adaptive schedule measured"),
+	"health_core_smtp_round_trips_total": ("counter", "SMTP command round trips, by whether commands were pipelined"),
+	"health_core_outbox_appended_total": ("counter", "Messages appended to the local outbox journal"),
+	"health_core_outbox_ingested_total": ("counter", "Outbox journal records queued or sent by the ingester, by mode"),
+	"health_core_outbox_rejected_total": ("counter", "Outbox journal records that could not be queued"),
+	"health_core_outbox_skipped_bytes_total": ("counter", "Torn or corrupt outbox journal bytes skipped on ingest"),
+	"health_core_outbox_bytes": ("gauge", "Outbox journal bytes not yet ingested"),
+	"health_core_outbox_segments": ("gauge", "Sealed outbox journal segments waiting for the ingester"),
+	"health_core_emails_sent_total": ("counter", "Messages accepted by the SMTP server"),
+	"health_core_emails_failed_total": ("counter", "Messages that failed to send"),
+	"health_core_routed_total": ("counter", "Email Queue rows assigned to an Email Account by the multi-account router"),
+	"health_core_route_failovers_total": ("counter", "Sends moved to another Email Account after a throttling or connection error"),
+	"health_core_route_weight": ("gauge", "Current routing weight of each Email Account in the routing pool"),
+	"health_core_smtp_throttled_total": ("counter", "Times an Email Account was taken out of rotation as throttled or over quota"),
+	"health_core_smtp_quota_used": ("gauge", "Messages sent today through Email Accounts with a daily quota"),
+	"health_core_smtp_connections_total": ("counter", "SMTP connection pool events (opened, reused, evicted, retired, failed)"),
+	"health_core_email_queue": ("gauge", "Email Queue rows by status"),
+	"health_core_email_send_rate": ("gauge", "Email Queue rows sent per second over the last 5 minutes"),
+	"health_core_metrics_workers": ("gauge", "Worker processes with a live metrics snapshot")
+}
+
+
+class Registry(object):
+	"""Counters and histograms of one worker process for one site."""
+
+	def __init__(self, buckets=DEFAULT_BUCKETS):
+		self.buckets = buckets
+		self.counters = defaultdict(float)
+		self.histograms = {}
+		self.published_at = 0
+		self._lock = threading.Lock()
+
+	def inc(self, name, value=1, labels=""):
+		with self._lock:
+			self.counters[(name, labels)] += value
+
+	def observe(self, name, value, labels=""):
+		with self._lock:
+			histogram = self.histograms.get((name, labels))
+			if histogram is None:
+				histogram = self.histograms[(name, labels)] = {
+					"buckets": [0] * (len(self.buckets) + 1), "sum": 0.0, "count": 0
+				}
+			histogram["buckets"][bisect.bisect_left(self.buckets, value)] += 1
+			histogram["sum"] += value
+			histogram["count"] += 1
+
+	def snapshot(self):
+		with self._lock:
+			return {
+				"updated_at": time.time(),
+				"buckets": list(self.buckets),
+				"counters": [[name, labels, value] for (name, labels), value in self.counters.items()],
+				"histograms": [
+					[name, labels, list(h["buckets"]), h["sum"], h["count"]]
+					for (name, labels), h in self.histograms.items()
+				]
+			}
+
+
+_registries = {}
+_registries_pid = None
+_registries_lock = threading.Lock()
+
+
+def get_registry(site=None):
+	"""Returns this process's registry for the current site, starting fresh after a fork."""
+	global _registries, _registries_pid
+
+	site = site or getattr(frappe.local, "site", None)
+
+	if _registries_pid != os.getpid():
+		with _registries_lock:
+			if _registries_pid != os.getpid():
+				_registries = {}
+				_registries_pid = os.getpid()
+
+	registry = _registries.get(site)
+	if registry is None:
+		with _registries_lock:
+			registry = _registries.setdefault(site, Registry())
+
+	return registry
+
+
+def format_labels(labels):
+	return ",".join(
+		'{0}="{1}"'.format(key, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+		for key, value in sorted(labels.items())
+	)
+
+
+def inc(name, value=1, **labels):
+	registry = get_registry()
+	registry.inc(name, value, format_labels(labels))
+	maybe_publish(registry)
+
+
+def observe(name, value, **labels):
+	"""Records `value` (seconds) in the histogram `name`."""
+	registry = get_registry()
+	registry.observe(name, value, format_labels(labels))
+	maybe_publish(registry)
+
+
+@contextmanager
+def timer(name, **labels):
+	"""Records the time spent in the block in the histogram `name`."""
+	start = time.perf_counter()
+	try:
+		yield
+	finally:
+		observe(name, time.perf_counter() - start, **labels)
+
+
+def timed_endpoint(fn):
+	"""
+	Records the duration of a whitelisted method, and counts calls that raise
+	or return `{"status": "error"}`. Apply below `@frappe.whitelist()`.
+	"""
+	endpoint = "{0}.{1}".format(fn.__module__.rsplit(".", 1)[-1], fn.__name__)
+
+	@functools.wraps(fn)
+	def wrapper(*args, **kwargs):
+		start = time.perf_counter()
+		failed = True
+		try:
+			result = fn(*args, **kwargs)
+			failed = isinstance(result, dict) and result.get("status") == "error"
+			return result
+		finally:
+			observe("health_core_endpoint_seconds", time.perf_counter() - start, endpoint=endpoint)
+			if failed:
+				inc("health_core_endpoint_errors_total", endpoint=endpoint)
+
+	return wrapper
+
+
+def get_worker_id():
+	return "{0}:{1}".format(socket.gethostname(), os.getpid())
+
+
+def maybe_publish(registry):
+	if not getattr(frappe.local, "site", None):
+		return
+
+	interval = cint(frappe.conf.get("metrics_publish_interval")) or DEFAULT_PUBLISH_INTERVAL
+	if time.monotonic() - registry.published_at >= interval:
+		publish_metrics(registry)
+
+
+def publish_metrics(registry=None):
+	"""Writes this worker's snapshot for the current site to Redis. Never raises."""
+	if not getattr(frappe.local, "site", None):
+		return
+
+	registry = registry or get_registry()
+	registry.published_at = time.monotonic()
+
+	snapshot = registry.snapshot()
+	snapshot["pool"] = get_pool_stats()
+
+	try:
+		cache = frappe.cache()
+		key = cache.make_key(METRICS_KEY)
+		pipe = cache.pipeline()
+		pipe.hset(key, get_worker_id(), json.dumps(snapshot))
+		pipe.expire(key, get_stale_after())
+		pipe.execute()
+	except Exception:
+		pass
+
+
+def get_pool_stats():
+	from health_core.utils import smtp_pool
+
+	pool = smtp_pool._pool
+	return dict(pool.stats) if pool and pool.pid == os.getpid() else {}
+
+
+def get_stale_after():
+	return cint(frappe.conf.get("metrics_stale_after")) or DEFAULT_STALE_AFTER
+
+
+def load_snapshots():
+	"""
+	Returns the live snapshots of all workers for the current site, dropping
+	those that have not been refreshed within `metrics_stale_after` seconds.
+	"""
+	publish_metrics()
+
+	cache = frappe.cache()
+	key = cache.make_key(METRICS_KEY)
+	pipe = cache.pipeline()
+	pipe.hgetall(key)
+	items, = pipe.execute()
+
+	cutoff = time.time() - get_stale_after()
+	snapshots = {}
+	stale = []
+
+	for worker, value in items.items():
+		worker = frappe.safe_decode(worker)
+		snapshot = json.loads(frappe.safe_decode(value))
+		if snapshot["updated_at"] < cutoff:
+			stale.append(worker)
+		else:
+			snapshots[worker] = snapshot
+
+	if stale:
+		pipe = cache.pipeline()
+		pipe.hdel(key, *stale)
+		pipe.execute()
+
+	return snapshots
+
+
+def get_queue_gauges():
+	"""Email Queue depth by status and the recent send rate, read from the database."""
+	depth = frappe.db.sql("""
+		select status, count(*)
+		from `tabEmail Queue`
+		group by status
+	""")
+
+	sent = frappe.db.count("Email Queue", {
+		"status": "Sent",
+		"modified": (">=", add_to_date(now_datetime(), seconds=-SEND_RATE_WINDOW))
+	})
+
+	return depth, sent / float(SEND_RATE_WINDOW)
+
+
+def join_labels(*parts):
+	return ",".join(part for part in parts if part)
+
+
+def render(snapshots, queue_depth=(), send_rate=None, gauges=()):
+	"""
+	Renders worker snapshots and queue gauges in the Prometheus text exposition format.
+
+	Returns:
+		str: The exposition text
+	"""
+	samples = defaultdict(list)
+
+	for worker, snapshot in sorted(snapshots.items()):
+		worker_label = format_labels({"worker": worker})
+
+		for name, labels, value in snapshot["counters"]:
+			samples[name].append("{0}{{{1}}} {2}".format(name, join_labels(labels, worker_label), value))
+
+		for event, value in sorted(snapshot.get("pool", {}).items()):
+			samples["health_core_smtp_connections_total"].append(
+				'health_core_smtp_connections_total{{{0}}} {1}'.format(
+					join_labels(format_labels({"event": event}), worker_label), value
+				)
+			)
+
+		bounds = [str(bound) for bound in snapshot["buckets"]] + ["+Inf"]
+		for name, labels, buckets, total, count in snapshot["histograms"]:
+			labels = join_labels(labels, worker_label)
+			cumulative = 0
+			for bound, bucket in zip(bounds, buckets):
+				cumulative += bucket
+				samples[name].append('{0}_bucket{{{1}}} {2}'.format(name, join_labels(labels, 'le="{0}"'.format(bound)), cumulative))
+			samples[name].append("{0}_sum{{{1}}} {2}".format(name, labels, total))
+			samples[name].append("{0}_count{{{1}}} {2}".format(name, labels, count))
+
+	for status, count in queue_depth:
+		samples["health_core_email_queue"].append(
+			"health_core_email_queue{{{0}}} {1}".format(format_labels({"status": status}), count)
+		)
+
+	if send_rate is not None:
+		samples["health_core_email_send_rate"].append("health_core_email_send_rate {0}".format(round(send_rate, 4)))
+
+	for name, labels, value in gauges:
+		samples[name].append("{0}{{{1}}} {2}".format(name, format_labels(labels), value))
+
+	samples["health_core_metrics_workers"].append("health_core_metrics_workers {0}".format(len(snapshots)))
+
+	lines = []
+	for name in sorted(samples):
+		kind, help_text = METRICS.get(name, ("untyped", name))
+		lines.append("# HELP {0} {1}".format(name, help_text))
+		lines.append("# TYPE {0} {1}".format(name, kind))
+		lines.extend(samples[name])
+
+	return "\n".join(lines) + "\n"
+
+
+def get_metrics_text():
+	from health_core.utils.flush_scheduler import get_schedule_gauges
+	from health_core.utils.lanes import get_lane_gauges
+	from health_core.utils.outbox import get_outbox_gauges
+	from health_core.utils.routing import get_routing_gauges
+	from health_core.utils.smtp_health import get_health_gauges
+
+	depth, send_rate = get_queue_gauges()
+	return render(
+		load_snapshots(), depth, send_rate,
+		get_health_gauges() + get_routing_gauges() + get_lane_gauges() + get_schedule_gauges()
+		+ get_outbox_gauges()
+	)
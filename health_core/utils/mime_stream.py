@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+"""
+Memory-bounded MIME messages for large attachments.
+
+`build_message` serializes the whole message with `as_bytes()`, so a 20 MB
+PDF costs well over 20 MB per send in the original, its base64 form and the
+joined message. A `StreamingMessage` keeps only the (small) headers and text
+parts in memory and base64-encodes each attachment in fixed-size chunks as it
+is written, straight from disk through `mmap` where possible. Peak memory per
+message is therefore a few hundred KB however large the attachments are.
+
+Attachments that can only be read once (pipes, file-store and HTTP streams)
+are spooled into a `SpooledTemporaryFile` first, in memory up to
+`email_attachment_spool_size` bytes and on disk beyond, so that the message
+can be replayed when the pool retries on a fresh connection.
+"""
+from __future__ import unicode_literals
+import base64
+import io
+import mimetypes
+import mmap
+import os
+import re
+import shutil
+import uuid
+from email.message import EmailMessage
+from email.policy import SMTP as SMTP_POLICY
+from tempfile import SpooledTemporaryFile
+
+import frappe
+from frappe.utils import cint
+
+
+# Multiple of the 57 input bytes that make one 76 character base64 line
+CHUNK_SIZE = 57 * 1024
+LINE_LENGTH = 76
+DEFAULT_SPOOL_SIZE = 1024 * 1024
+
+CRLF = b"\r\n"
+DOT_LINE = re.compile(br"(?m)^\.")
+
+
+def get_spool_size():
+	"""Bytes of a read-once attachment held in memory before spooling to disk."""
+	return cint(frappe.conf.get("email_attachment_spool_size")) or DEFAULT_SPOOL_SIZE
+
+
+def fold_headers(msg):
+	"""Returns the headers of an `EmailMessage` as CRLF-terminated bytes."""
+	return b"".join(SMTP_POLICY.fold_binary(name, value) for name, value in msg.items())
+
+
+def encoded_length(size):
+	"""Length of `size` bytes once base64-encoded into CRLF-terminated lines."""
+	lines, rest = divmod(size, 57)
+	return lines * (LINE_LENGTH + 2) + (4 * -(-rest // 3) + 2 if rest else 0)
+
+
+def encode_chunk(chunk):
+	"""Base64-encodes a chunk (a multiple of 57 bytes unless it is the last) into CRLF-terminated lines."""
+	encoded = base64.b64encode(chunk)
+	return CRLF.join(encoded[i:i + LINE_LENGTH] for i in range(0, len(encoded), LINE_LENGTH)) + CRLF
+
+
+class Attachment(object):
+	"""
+	One attachment, read from a path, a binary file object or bytes.
+
+	Args:
+		filename (str): Name shown to the recipient
+		path (str): File on disk, mapped with `mmap` while encoding
+		fileobj: Binary file object; spooled first unless it is seekable
+		content (bytes): Content already in memory
+		content_type (str): Defaults to a guess from `filename`
+	"""
+
+	def __init__(self, filename, path=None, fileobj=None, content=None, content_type=None):
+		self.filename = filename
+		self.path = path
+		self.fileobj = fileobj
+		self.content = frappe.safe_encode(content) if content is not None else None
+		self.content_type = content_type or mimetypes.guess_type(filename)[0] or "application/octet-stream"
+		self._spooled = False
+
+		if fileobj is not None and not self._is_seekable(fileobj):
+			spool = SpooledTemporaryFile(max_size=get_spool_size())
+			shutil.copyfileobj(fileobj, spool, CHUNK_SIZE)
+			self.fileobj = spool
+			self._spooled = True
+
+	@classmethod
+	def from_source(cls, source):
+		"""
+		Accepts an `Attachment`, a path, or a dict in the format of
+		`frappe.sendmail(attachments=...)`: `{"fname", "fcontent"}` or `{"fid"}`
+		(a File document), optionally with `content_type`.
+		"""
+		if isinstance(source, cls):
+			return source
+
+		if isinstance(source, str):
+			return cls(os.path.basename(source), path=source)
+
+		if source.get("fid"):
+			file_doc = frappe.get_doc("File", source["fid"])
+			return cls(
+				source.get("fname") or file_doc.file_name,
+				path=file_doc.get_full_path(),
+				content_type=source.get("content_type")
+			)
+
+		if source.get("path"):
+			return cls(source.get("fname") or os.path.basename(source["path"]), path=source["path"],
+				content_type=source.get("content_type"))
+
+		if source.get("fileobj") is not None:
+			return cls(source["fname"], fileobj=source["fileobj"], content_type=source.get("content_type"))
+
+		return cls(source["fname"], content=source.get("fcontent") or b"", content_type=source.get("content_type"))
+
+	@staticmethod
+	def _is_seekable(fileobj):
+		try:
+			return fileobj.seekable()
+		except (AttributeError, ValueError):
+			return False
+
+	def headers(self):
+		part = EmailMessage()
+		part["Content-Type"] = self.content_type
+		part["Content-Transfer-Encoding"] = "base64"
+		part.add_header("Content-Disposition", "attachment", filename=self.filename)
+		return fold_headers(part) + CRLF
+
+	def size(self):
+		"""Size of the raw (unencoded) content in bytes."""
+		if self.path:
+			return os.path.getsize(self.path)
+		if self.fileobj is not None:
+			position = self.fileobj.tell()
+			size = self.fileobj.seek(0, io.SEEK_END)
+			self.fileobj.seek(position)
+			return size
+		return len(self.content)
+
+	def iter_encoded(self):
+		"""Yields the base64 body in chunks of about `CHUNK_SIZE` * 4/3 bytes."""
+		if self.content is not None:
+			for offset in range(0, len(self.content), CHUNK_SIZE):
+				yield encode_chunk(self.content[offset:offset + CHUNK_SIZE])
+			return
+
+		if self.path:
+			with open(self.path, "rb") as f:
+				for chunk in self._iter_file(f):
+					yield chunk
+			return
+
+		self.fileobj.seek(0)
+		for chunk in self._iter_file(self.fileobj):
+			yield chunk
+
+	def _iter_file(self, f):
+		mapped = None
+		# A spooled file still in memory has no descriptor, and asking for one would roll it to disk
+		if not self._spooled:
+			try:
+				if os.fstat(f.fileno()).st_size:
+					mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+			except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+				mapped = None
+
+		if mapped is None:
+			while True:
+				chunk = f.read(CHUNK_SIZE)
+				if not chunk:
+					break
+				yield encode_chunk(chunk)
+			return
+
+		try:
+			view = memoryview(mapped)
+			try:
+				for offset in range(0, len(mapped), CHUNK_SIZE):
+					yield encode_chunk(view[offset:offset + CHUNK_SIZE])
+			finally:
+				view.release()
+		finally:
+			mapped.close()
+
+	def close(self):
+		if self._spooled:
+			self.fileobj.close()
+
+
+class StreamingMessage(object):
+	"""
+	A multipart/mixed message whose attachments are encoded while it is sent.
+
+	Args:
+		headers (EmailMessage): Message holding only the top-level headers (From, To, Subject, ...)
+		body (EmailMessage): The text part, usually multipart/alternative
+		attachments (list): Attachment sources, see `Attachment.from_source`
+	"""
+
+	def __init__(self, headers, body, attachments):
+		self.attachments = [Attachment.from_source(attachment) for attachment in attachments]
+		self.boundary = "===============health-core-{0}==".format(uuid.uuid4().hex)
+
+		del headers["MIME-Version"]
+		del headers["Content-Type"]
+		headers["MIME-Version"] = "1.0"
+		headers["Content-Type"] = 'multipart/mixed; boundary="{0}"'.format(self.boundary)
+
+		del body["MIME-Version"]
+		self._prefix = fold_headers(headers) + CRLF + self.delimiter() + body.as_bytes(policy=SMTP_POLICY)
+		if not self._prefix.endswith(CRLF):
+			self._prefix += CRLF
+		self._stuffed_prefix = DOT_LINE.sub(b"..", self._prefix)
+
+	def delimiter(self, last=False):
+		return "--{0}{1}\r\n".format(self.boundary, "--" if last else "").encode("ascii")
+
+	def iter_chunks(self, stuffed=True):
+		"""
+		Yields the message, ending in CRLF: dot-stuffed for DATA, or as it is
+		for BDAT with `stuffed=False`. Base64 lines never start with a dot, so
+		attachment chunks are the same either way.
+		"""
+		yield self._stuffed_prefix if stuffed else self._prefix
+		for attachment in self.attachments:
+			yield self.delimiter() + attachment.headers()
+			for chunk in attachment.iter_encoded():
+				yield chunk
+		yield self.delimiter(last=True)
+
+	def size(self, stuffed=True):
+		"""Exact size of what `iter_chunks` yields, for the ESMTP SIZE parameter."""
+		prefix = self._stuffed_prefix if stuffed else self._prefix
+		return len(prefix) + len(self.delimiter(last=True)) + sum(
+			len(self.delimiter()) + len(attachment.headers()) + encoded_length(attachment.size())
+			for attachment in self.attachments
+		)
+
+	def as_bytes(self):
+		"""The whole message in memory, for callers that cannot stream."""
+		return b"".join(self.iter_chunks(stuffed=False))
+
+	def close(self):
+		for attachment in self.attachments:
+			attachment.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
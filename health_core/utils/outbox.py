@@ -0,0 +1,533 @@
+# -*- coding: utf-8 -*-
+"""
+Local outbox journal for absorbing send bursts.
+
+`frappe.sendmail` inserts the Email Queue row and its recipients in the
+caller's transaction, so a reminder burst turns into a burst of database
+writes on the request path. With `email_outbox` enabled, `sendmail` appends
+the call's arguments to an append-only journal under the site's private
+files instead and returns straight away; an ingester later loads the journal
+into the Email Queue in batches, one commit per batch, or sends simple
+messages straight from it.
+
+Journal layout (`email_outbox_dir`, default `private/health_core_outbox`):
+
+	active.log              segment all processes append to
+	segment-<ns>.log        sealed segments waiting for the ingester
+	segment-<ns>.log.ckpt   records of that segment already ingested
+
+Every record is framed as `MAGIC | length | crc32 | JSON payload`. Appends
+hold an `flock` on `.lock`, so processes never interleave, and are fsynced in
+batches: at most one fsync per `email_outbox_fsync_interval` seconds per
+process, the rest left to a background timer. A crash can therefore lose at
+most that interval's worth of acknowledged messages, and a torn record at the
+end of a segment is skipped by scanning for the next `MAGIC`.
+
+The active segment is sealed (renamed) once it reaches
+`email_outbox_segment_size` bytes, or by the ingester before each run. A
+sealed segment is only deleted once all its records are committed; after a
+crash the ingester resumes from the checkpoint. Delivery is at least once: a
+batch that was committed but not checkpointed is delivered again. Its queued
+copies are cancelled only if the replay lands inside `email_dedup_window`
+(see `health_core.utils.dedup`, 60 seconds by default); a later replay, or
+messages sent directly in `send` mode, go out twice.
+"""
+from __future__ import unicode_literals
+import datetime
+import decimal
+import fcntl
+import json
+import os
+import struct
+import threading
+import time
+import uuid
+import zlib
+
+import frappe
+from frappe.utils import cint, flt
+
+from health_core.utils.metrics import inc
+
+
+MAGIC = b"HCO1"
+HEADER = struct.Struct(">4sII")
+
+ACTIVE_SEGMENT = "active.log"
+SEGMENT_PREFIX = "segment-"
+SEGMENT_SUFFIX = ".log"
+CHECKPOINT_SUFFIX = ".ckpt"
+LOCK_FILE = ".lock"
+
+DEFAULT_SEGMENT_SIZE = 16 * 1024 * 1024
+DEFAULT_FSYNC_INTERVAL = 0.05
+DEFAULT_BATCH_SIZE = 200
+
+QUEUE = "queue"
+SEND = "send"
+
+# `frappe.sendmail` arguments `send_mail` handles itself; anything else goes through the Email Queue
+DIRECT_SEND_ARGS = {"recipients", "subject", "message", "reference_doctype", "reference_name", "delayed", "now"}
+
+# (directory, pid) -> OutboxWriter
+_writers = {}
+_writers_lock = threading.Lock()
+
+
+def is_enabled():
+	return bool(cint(frappe.conf.get("email_outbox")))
+
+
+def get_outbox_dir():
+	return os.path.abspath(frappe.conf.get("email_outbox_dir") or frappe.get_site_path("private", "health_core_outbox"))
+
+
+def get_ingest_mode():
+	"""`queue` loads records into the Email Queue; `send` sends simple messages straight away."""
+	return SEND if frappe.conf.get("email_outbox_ingest") == SEND else QUEUE
+
+
+def json_default(value):
+	if isinstance(value, (datetime.date, datetime.time, datetime.timedelta, decimal.Decimal)):
+		return str(value)
+	# Bytes (inline attachment content) and documents are not journaled
+	raise TypeError(type(value).__name__)
+
+
+def sendmail(**kwargs):
+	"""
+	Drop-in for `frappe.sendmail` that journals the message when the outbox is
+	enabled, e.g.
+
+		from health_core.utils.outbox import sendmail
+
+		sendmail(recipients=[email], subject="Appointment reminder", message=message)
+
+	Immediate sends (`now=True`) and arguments that cannot be stored as JSON
+	(such as inline attachment bytes) go to `frappe.sendmail` as usual.
+
+	Returns:
+		str: The journal record id, or whatever `frappe.sendmail` returned
+	"""
+	if not is_enabled() or kwargs.get("now"):
+		return frappe.sendmail(**kwargs)
+
+	record_id = uuid.uuid4().hex
+	try:
+		payload = json.dumps({
+			"id": record_id,
+			"ts": time.time(),
+			"user": frappe.session.user,
+			"lane": frappe.flags.health_core_email_lane,
+			"kwargs": kwargs,
+		}, default=json_default, separators=(",", ":"))
+	except (TypeError, ValueError):
+		return frappe.sendmail(**kwargs)
+
+	get_writer().append(payload.encode("utf-8"))
+	inc("health_core_outbox_appended_total")
+	return record_id
+
+
+def get_writer(directory=None):
+	"""This process's writer for the site's outbox, created again after a fork."""
+	directory = directory or get_outbox_dir()
+	key = (directory, os.getpid())
+	writer = _writers.get(key)
+	if writer is None:
+		with _writers_lock:
+			writer = _writers.get(key)
+			if writer is None:
+				writer = _writers[key] = OutboxWriter(
+					directory,
+					segment_size=cint(frappe.conf.get("email_outbox_segment_size")) or DEFAULT_SEGMENT_SIZE,
+					fsync_interval=flt(frappe.conf.get("email_outbox_fsync_interval", DEFAULT_FSYNC_INTERVAL))
+				)
+	return writer
+
+
+def frame(payload):
+	return HEADER.pack(MAGIC, len(payload), zlib.crc32(payload)) + payload
+
+
+def fsync_directory(directory):
+	fd = os.open(directory, os.O_RDONLY)
+	try:
+		os.fsync(fd)
+	finally:
+		os.close(fd)
+
+
+def new_segment_path(directory):
+	return os.path.join(directory, "{0}{1:020d}{2}".format(SEGMENT_PREFIX, time.time_ns(), SEGMENT_SUFFIX))
+
+
+class DirectoryLock(object):
+	"""Exclusive `flock` on the outbox's lock file, serializing appends and rotation across processes."""
+
+	def __init__(self, directory):
+		self.fd = os.open(os.path.join(directory, LOCK_FILE), os.O_RDWR | os.O_CREAT, 0o600)
+
+	def __enter__(self):
+		fcntl.flock(self.fd, fcntl.LOCK_EX)
+		return self
+
+	def __exit__(self, *args):
+		fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+	def close(self):
+		os.close(self.fd)
+
+
+class OutboxWriter(object):
+	"""
+	Appends framed records to the active segment.
+
+	Args:
+		directory (str): Outbox directory, created if missing
+		segment_size (int): Bytes after which the active segment is sealed
+		fsync_interval (float): Seconds between fsyncs; 0 fsyncs every append
+	"""
+
+	def __init__(self, directory, segment_size=DEFAULT_SEGMENT_SIZE, fsync_interval=DEFAULT_FSYNC_INTERVAL):
+		os.makedirs(directory, exist_ok=True)
+		self.directory = directory
+		self.path = os.path.join(directory, ACTIVE_SEGMENT)
+		self.segment_size = segment_size
+		self.fsync_interval = fsync_interval
+		self.fd = None
+		self.inode = None
+		self.dirty = False
+		self.last_sync = 0.0
+		self.timer = None
+		self.lock = threading.Lock()
+		self.directory_lock = DirectoryLock(directory)
+
+	def append(self, payload):
+		record = frame(payload)
+		with self.lock:
+			with self.directory_lock:
+				self._open()
+				os.write(self.fd, record)
+				self.dirty = True
+				if os.fstat(self.fd).st_size >= self.segment_size:
+					self._seal()
+			self._schedule_sync()
+
+	def _open(self):
+		"""(Re)opens the active segment, which another process may have sealed since the last append."""
+		try:
+			inode = os.stat(self.path).st_ino
+		except FileNotFoundError:
+			inode = None
+
+		if self.fd is not None and inode == self.inode:
+			return
+
+		self._close()
+		self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+		self.inode = os.fstat(self.fd).st_ino
+		if inode is None:
+			fsync_directory(self.directory)
+
+	def _seal(self):
+		os.fsync(self.fd)
+		self.dirty = False
+		os.rename(self.path, new_segment_path(self.directory))
+		fsync_directory(self.directory)
+		self._close()
+
+	def _close(self):
+		if self.fd is not None:
+			if self.dirty:
+				os.fsync(self.fd)
+				self.dirty = False
+			os.close(self.fd)
+			self.fd = None
+			self.inode = None
+
+	def _schedule_sync(self):
+		if not self.dirty:
+			return
+
+		wait = self.last_sync + self.fsync_interval - time.monotonic()
+		if wait <= 0:
+			self._sync()
+		elif self.timer is None:
+			self.timer = threading.Timer(wait, self.sync)
+			self.timer.daemon = True
+			self.timer.start()
+
+	def _sync(self):
+		if self.dirty and self.fd is not None:
+			os.fsync(self.fd)
+			self.dirty = False
+		self.last_sync = time.monotonic()
+
+	def sync(self):
+		"""Flushes pending appends to disk."""
+		with self.lock:
+			self.timer = None
+			self._sync()
+
+	def close(self):
+		with self.lock:
+			if self.timer is not None:
+				self.timer.cancel()
+				self.timer = None
+			self._close()
+		self.directory_lock.close()
+
+
+def seal_active_segment(directory):
+	"""
+	Renames a non-empty active segment to a sealed one so the ingester can
+	take it; writers reopen a fresh active segment on their next append.
+
+	Returns:
+		str: The sealed segment's path, or None
+	"""
+	path = os.path.join(directory, ACTIVE_SEGMENT)
+	lock = DirectoryLock(directory)
+	try:
+		with lock:
+			try:
+				if not os.path.getsize(path):
+					return None
+			except FileNotFoundError:
+				return None
+
+			sealed = new_segment_path(directory)
+			fd = os.open(path, os.O_RDONLY)
+			try:
+				os.fsync(fd)
+			finally:
+				os.close(fd)
+			os.rename(path, sealed)
+			fsync_directory(directory)
+			return sealed
+	finally:
+		lock.close()
+
+
+def list_segments(directory):
+	"""Sealed segments, oldest first."""
+	try:
+		names = os.listdir(directory)
+	except FileNotFoundError:
+		return []
+	return [
+		os.path.join(directory, name) for name in sorted(names)
+		if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX)
+	]
+
+
+def read_records(data):
+	"""
+	Decodes the framed records in a segment's bytes.
+
+	Returns:
+		tuple: (list of payloads in order, bytes skipped as torn or corrupt)
+	"""
+	records = []
+	skipped = 0
+	offset = 0
+	end = len(data)
+
+	while offset < end:
+		if offset + HEADER.size <= end:
+			magic, length, crc = HEADER.unpack_from(data, offset)
+			start = offset + HEADER.size
+			if magic == MAGIC and start + length <= end:
+				payload = bytes(data[start:start + length])
+				if zlib.crc32(payload) == crc:
+					records.append(payload)
+					offset = start + length
+					continue
+
+		# Resynchronise on the next record
+		following = data.find(MAGIC, offset + 1)
+		following = end if following < 0 else following
+		skipped += following - offset
+		offset = following
+
+	return records, skipped
+
+
+def read_checkpoint(path):
+	try:
+		with open(path + CHECKPOINT_SUFFIX) as f:
+			return cint(f.read().strip())
+	except FileNotFoundError:
+		return 0
+
+
+def write_checkpoint(path, count):
+	"""Atomically records that the first `count` records of a segment are committed."""
+	checkpoint = path + CHECKPOINT_SUFFIX
+	temporary = checkpoint + ".tmp"
+	with open(temporary, "w") as f:
+		f.write(str(count))
+		f.flush()
+		os.fsync(f.fileno())
+	os.replace(temporary, checkpoint)
+
+
+def remove_segment(path):
+	for name in (path + CHECKPOINT_SUFFIX, path):
+		try:
+			os.unlink(name)
+		except FileNotFoundError:
+			pass
+	fsync_directory(os.path.dirname(path))
+
+
+def deliver(record, mode=QUEUE):
+	"""Loads one journal record into the Email Queue, or sends it straight away in `send` mode."""
+	from health_core.utils.lanes import email_lane
+
+	kwargs = record["kwargs"]
+	previous_user = frappe.session.user
+	if record.get("user") and record["user"] != previous_user:
+		frappe.set_user(record["user"])
+
+	try:
+		with email_lane(record.get("lane")):
+			if mode == SEND and set(kwargs) <= DIRECT_SEND_ARGS and kwargs.get("recipients"):
+				from health_core.utils.bulk_email import parse_recipients
+				from health_core.utils.smtp_pool import send_mail
+
+				try:
+					send_mail(parse_recipients(kwargs["recipients"]), kwargs.get("subject") or "", kwargs.get("message") or "",
+						reference_doctype=kwargs.get("reference_doctype"), reference_name=kwargs.get("reference_name"))
+					inc("health_core_outbox_ingested_total", mode=SEND)
+					return
+				except Exception:
+					# The Email Queue retries it
+					frappe.log_error(title="Health Core: outbox direct send failed, queueing")
+
+			frappe.sendmail(**kwargs)
+			inc("health_core_outbox_ingested_total", mode=QUEUE)
+	finally:
+		if frappe.session.user != previous_user:
+			frappe.set_user(previous_user)
+
+
+def ingest_segment(path, batch_size=DEFAULT_BATCH_SIZE, mode=QUEUE):
+	"""
+	Delivers a sealed segment's records from its checkpoint on, committing and
+	checkpointing every `batch_size` records, then deletes the segment. A
+	segment another ingester holds is skipped.
+
+	Returns:
+		int: Records delivered
+	"""
+	try:
+		fd = os.open(path, os.O_RDONLY)
+	except FileNotFoundError:
+		return 0
+
+	try:
+		try:
+			fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+		except BlockingIOError:
+			return 0
+
+		try:
+			if os.stat(path).st_ino != os.fstat(fd).st_ino:
+				return 0
+		except FileNotFoundError:
+			# Finished by the ingester that held the lock
+			return 0
+
+		with os.fdopen(os.dup(fd), "rb") as f:
+			records, skipped = read_records(f.read())
+		if skipped:
+			inc("health_core_outbox_skipped_bytes_total", skipped)
+			frappe.logger().warning(f"Health Core outbox: skipped {skipped} torn or corrupt bytes in {path}")
+
+		delivered = 0
+		done = read_checkpoint(path)
+		for start in range(done, len(records), batch_size):
+			batch = records[start:start + batch_size]
+			for payload in batch:
+				frappe.db.savepoint("health_core_outbox")
+				try:
+					deliver(json.loads(payload), mode)
+				except Exception:
+					frappe.db.rollback(save_point="health_core_outbox")
+					inc("health_core_outbox_rejected_total")
+					frappe.log_error(title="Health Core: outbox record could not be queued")
+			frappe.db.commit()
+			write_checkpoint(path, start + len(batch))
+			delivered += len(batch)
+
+		remove_segment(path)
+		return delivered
+	finally:
+		os.close(fd)
+
+
+def ingest_outbox():
+	"""
+	Scheduled job (every minute), also run by the resident email worker: seals
+	the active segment and ingests every sealed one, oldest first. Keeps
+	draining a journal left behind after `email_outbox` is switched off.
+
+	Returns:
+		int: Records delivered
+	"""
+	directory = get_outbox_dir()
+	if not os.path.isdir(directory):
+		return 0
+
+	seal_active_segment(directory)
+	batch_size = cint(frappe.conf.get("email_outbox_batch_size")) or DEFAULT_BATCH_SIZE
+	mode = get_ingest_mode()
+	return sum(ingest_segment(path, batch_size, mode) for path in list_segments(directory))
+
+
+def recover_outbox():
+	"""
+	Startup recovery: removes checkpoints and temporary files whose segment is
+	gone (a crash between deleting the two), then ingests whatever a crashed
+	process left behind.
+
+	Returns:
+		int: Records delivered
+	"""
+	directory = get_outbox_dir()
+	if not os.path.isdir(directory):
+		return 0
+
+	for name in os.listdir(directory):
+		if CHECKPOINT_SUFFIX not in name:
+			continue
+		segment = os.path.join(directory, name.split(CHECKPOINT_SUFFIX)[0])
+		if not os.path.exists(segment):
+			try:
+				os.unlink(os.path.join(directory, name))
+			except FileNotFoundError:
+				pass
+
+	return ingest_outbox()
+
+
+def get_outbox_gauges():
+	"""Samples for the metrics endpoint: journal bytes and segments not yet ingested."""
+	directory = get_outbox_dir()
+	if not os.path.isdir(directory):
+		return []
+
+	paths = list_segments(directory) + [os.path.join(directory, ACTIVE_SEGMENT)]
+	size = 0
+	for path in paths:
+		try:
+			size += os.path.getsize(path)
+		except FileNotFoundError:
+			pass
+
+	return [
+		("health_core_outbox_bytes", {}, size),
+		("health_core_outbox_segments", {}, len(paths) - 1),
+	]
@@ -0,0 +1,411 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import frappe
+from frappe.utils import add_to_date, cint, get_datetime, now_datetime
+
+from health_core.utils import lanes
+from health_core.utils.metrics import inc, observe, publish_metrics, timer
+from health_core.utils.retry import schedule_retries
+from health_core.utils.routing import get_domain, get_router, get_throttled_accounts
+from health_core.utils.smtp_health import allow_request, get_open_circuits, record_failure, record_success
+from health_core.utils.smtp_pool import PooledSMTPServer, get_default_outgoing_account
+
+
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_WORKERS = 8
+DEFAULT_LEASE_SECONDS = 300
+DEFAULT_ACCOUNT_CONCURRENCY = 4
+
+# Concurrent SMTP sessions allowed per Email Account service, unless overridden
+# per account with `email_account_concurrency` in site config
+SERVICE_CONCURRENCY = {
+	"GMail": 3,
+}
+
+# Per-process semaphores capping concurrent sessions per (site, Email Account)
+_account_slots = {}
+_account_slots_lock = threading.Lock()
+
+
+def get_account_concurrency(email_account):
+	"""
+	Returns the maximum number of concurrent SMTP sessions for an Email Account.
+
+	Looks at `email_account_concurrency` (a dict keyed by account name) in site
+	config first, then the account's service, then `email_account_default_concurrency`.
+	"""
+	overrides = frappe.conf.get("email_account_concurrency") or {}
+	if cint(overrides.get(email_account)):
+		return cint(overrides.get(email_account))
+
+	service = frappe.db.get_value("Email Account", email_account, "service")
+	if service in SERVICE_CONCURRENCY:
+		return SERVICE_CONCURRENCY[service]
+
+	return cint(frappe.conf.get("email_account_default_concurrency")) or DEFAULT_ACCOUNT_CONCURRENCY
+
+
+def get_account_slots(site, email_account, limit):
+	key = (site, email_account)
+	with _account_slots_lock:
+		if key not in _account_slots:
+			_account_slots[key] = threading.BoundedSemaphore(limit)
+		return _account_slots[key]
+
+
+def claim_batch(limit, lease_seconds=DEFAULT_LEASE_SECONDS, exclude_accounts=None, default_account=None,
+		lane=None, token=None, retries=False):
+	"""
+	Claims up to `limit` due Email Queue rows for this flush.
+
+	Rows are selected with `FOR UPDATE SKIP LOCKED` and stamped with a claim
+	token in the same transaction, so concurrent flushes (threads, processes or
+	hosts) always get disjoint batches. A claim expires after `lease_seconds`
+	so rows held by a crashed flush are picked up again.
+
+	Rows waiting for a retry (see `health_core.utils.retry`) are only claimed
+	with `retries`, once their next attempt is due, in the order they became due.
+
+	Args:
+		exclude_accounts (list): Email Accounts whose rows are left alone (open circuits)
+		default_account (str): Account that rows without an Email Account are sent from
+		lane (str): Only claim rows of this priority lane
+		token (str): Claim token to stamp, to add rows to an existing claim
+		retries (bool): Claim due retries instead of rows that have not failed yet
+
+	Returns:
+		tuple: (claim token, list of rows with `name`, `email_account`, `sender`, `health_core_lane` and `creation`)
+	"""
+	token = token or frappe.generate_hash(length=16)
+	now = now_datetime()
+
+	exclude_condition = ""
+	if exclude_accounts:
+		exclude_condition = "and (email_account is null or email_account = '' or email_account not in %(exclude)s)"
+		if default_account in exclude_accounts:
+			exclude_condition = "and email_account is not null and email_account != '' and email_account not in %(exclude)s"
+
+	lane_condition = ""
+	if lane == lanes.NORMAL:
+		# Rows queued before lanes existed count as normal
+		lane_condition = "and (health_core_lane = %(lane)s or health_core_lane is null or health_core_lane = '')"
+	elif lane:
+		lane_condition = "and health_core_lane = %(lane)s"
+
+	retry_condition = "and health_core_next_attempt is null"
+	order_by = "priority desc, creation asc"
+	if retries:
+		retry_condition = "and health_core_next_attempt <= %(now)s"
+		order_by = "health_core_next_attempt asc"
+
+	rows = frappe.db.sql("""
+		select name, email_account, sender, health_core_lane, creation
+		from `tabEmail Queue`
+		where status in ('Not Sent', 'Partially Sent')
+			and (send_after is null or send_after <= %(now)s)
+			and (health_core_claim is null or health_core_claim = ''
+				or health_core_claimed_at < %(expired)s)
+			{retry_condition}
+			{exclude_condition}
+			{lane_condition}
+		order by {order_by}
+		limit %(limit)s
+		for update skip locked
+	""".format(
+		retry_condition=retry_condition,
+		exclude_condition=exclude_condition,
+		lane_condition=lane_condition,
+		order_by=order_by
+	), {
+		"now": now,
+		"expired": add_to_date(now, seconds=-lease_seconds),
+		"exclude": tuple(exclude_accounts or ()),
+		"lane": lane,
+		"limit": limit
+	}, as_dict=True)
+
+	if rows:
+		frappe.db.sql("""
+			update `tabEmail Queue`
+			set health_core_claim = %(token)s, health_core_claimed_at = %(now)s
+			where name in %(names)s
+		""", {"token": token, "now": now, "names": tuple(row.name for row in rows)})
+
+	frappe.db.commit()
+
+	return token, rows
+
+
+def claim_lanes(batch_size, lease_seconds=DEFAULT_LEASE_SECONDS, exclude_accounts=None, default_account=None):
+	"""
+	Claims one batch across the priority lanes with weighted fair queuing.
+
+	The high lane is claimed first and may fill the whole batch. The space
+	left is split between normal and bulk by `email_lane_weights`, bulk is
+	capped at `email_lane_max_bulk_batch` rows, and either lane can use what
+	the other leaves unused.
+
+	Returns:
+		tuple: (claim token, rows ordered high, normal, bulk, True if any lane
+			filled its share, i.e. more rows are probably waiting)
+	"""
+	token, rows = claim_batch(batch_size, lease_seconds, exclude_accounts, default_account, lanes.HIGH)
+	remaining = batch_size - len(rows)
+	if not remaining:
+		return token, rows, True
+
+	normal = []
+	normal_share = lanes.split_remaining(remaining)
+	if normal_share:
+		normal = claim_batch(normal_share, lease_seconds, exclude_accounts, default_account, lanes.NORMAL, token)[1]
+
+	bulk = []
+	bulk_limit = min(remaining - len(normal), lanes.get_max_bulk_batch())
+	if bulk_limit > 0:
+		bulk = claim_batch(bulk_limit, lease_seconds, exclude_accounts, default_account, lanes.BULK, token)[1]
+
+	more = bool(bulk) and len(bulk) == bulk_limit
+	extra = remaining - len(normal) - len(bulk)
+	if extra and len(normal) == normal_share:
+		more_normal = claim_batch(extra, lease_seconds, exclude_accounts, default_account, lanes.NORMAL, token)[1]
+		normal = normal + more_normal
+		more = more or len(more_normal) == extra
+	elif len(normal) == normal_share:
+		more = True
+
+	return token, rows + normal + bulk, more
+
+
+def release_claim(token, names):
+	"""Clears the claim on rows that are done (or given up on) by this flush."""
+	if not names:
+		return
+
+	frappe.db.sql("""
+		update `tabEmail Queue`
+		set health_core_claim = null, health_core_claimed_at = null
+		where name in %(names)s and health_core_claim = %(token)s
+	""", {"token": token, "names": tuple(names)})
+	frappe.db.commit()
+
+
+def send_queued_email(name, smtp_server):
+	"""
+	Sends one Email Queue row through Frappe's own send logic over a pooled session.
+
+	Returns:
+		bool: True if the row was sent to all recipients
+	"""
+	from frappe.email.doctype.email_queue.email_queue import send_mail
+
+	start = time.perf_counter()
+	try:
+		send_mail(name, smtp_server_instance=smtp_server)
+	except Exception as e:
+		smtp_server.release(discard=True)
+		frappe.log_error(title="Health Core: failed to send Email Queue {0}".format(name))
+		observe("health_core_queue_send_seconds", time.perf_counter() - start, outcome="error")
+		inc("health_core_emails_failed_total", path="queue", error=type(e).__name__)
+		return False
+
+	status = frappe.db.get_value("Email Queue", name, "status")
+	smtp_server.release(discard=status not in ("Sent", "Partially Sent"))
+
+	observe("health_core_queue_send_seconds", time.perf_counter() - start, outcome="sent" if status == "Sent" else "failed")
+	if status == "Sent":
+		inc("health_core_emails_sent_total", path="queue")
+	else:
+		inc("health_core_emails_failed_total", path="queue", error=status or "Unknown")
+
+	return status == "Sent"
+
+
+def shard_rows(rows, default_account, router=None):
+	"""
+	Groups claimed rows by sending Email Account.
+
+	With a `router`, rows without an account, or from the default account or
+	a routing pool member, are spread over the available pool accounts whose
+	address is in the same domain as the row's sender. Frappe built the
+	message's From header when the row was queued, so sending it from another
+	domain's account would break SPF/DMARC alignment; rows with no such
+	account keep their own.
+
+	Returns:
+		dict: Email Account name -> list of Email Queue names
+	"""
+	shards = defaultdict(list)
+	for row in rows:
+		account = row.email_account or default_account
+		if router and (not account or account == default_account or account in router):
+			domain = get_domain(row.sender) or router.domains.get(account)
+			if domain:
+				account = router.choose(domain=domain) or account
+		if account:
+			shards[account].append(row.name)
+
+	return shards
+
+
+def split_shard(names, parts):
+	"""Splits one account's rows into `parts` interleaved, roughly equal chunks."""
+	parts = max(1, min(parts, len(names)))
+	return [names[i::parts] for i in range(parts)]
+
+
+def send_shard(site, token, email_account, names, slots, row_lanes=None):
+	"""
+	Sends a chunk of rows for one Email Account on its own thread and site connection.
+
+	Args:
+		row_lanes (dict): Email Queue name -> (lane, creation), to record
+			each lane's enqueue-to-sent latency
+
+	If the account's circuit breaker is open, the server cannot be reached or
+	it starts throttling, the (remaining) rows are released untouched for a
+	later flush, which routes them to another account where possible. Rows
+	that fail are scheduled for a retry with backoff.
+
+	Returns:
+		dict: Counts of `sent`, `failed` and `deferred` rows
+	"""
+	result = {"sent": 0, "failed": 0, "deferred": 0}
+	failed = []
+
+	with slots:
+		frappe.init(site=site)
+		frappe.connect()
+		try:
+			if not allow_request(email_account):
+				result["deferred"] = len(names)
+			else:
+				smtp_server = PooledSMTPServer(email_account)
+				for i, name in enumerate(names):
+					if send_queued_email(name, smtp_server):
+						result["sent"] += 1
+						if row_lanes and name in row_lanes:
+							lane, creation = row_lanes[name]
+							lanes.record_sent(lane, (now_datetime() - get_datetime(creation)).total_seconds())
+					else:
+						result["failed"] += 1
+						failed.append(name)
+					if smtp_server.connect_error or smtp_server.throttled:
+						result["deferred"] = len(names) - i - 1
+						break
+
+				if smtp_server.connect_error:
+					record_failure(email_account)
+				elif result["sent"]:
+					record_success(email_account)
+
+			schedule_retries(failed)
+
+			with timer("health_core_queue_db_seconds", operation="release"):
+				release_claim(token, names)
+		finally:
+			frappe.destroy()
+
+	return result
+
+
+def flush_queue(batch_size=None, workers=None, retries=False):
+	"""
+	Sends one claimed batch of the Email Queue in parallel, sharded by Email Account.
+
+	Each account's rows are split across at most its concurrency limit of
+	threads, so a slow or throttled provider only holds up its own messages.
+	The batch is claimed lane by lane (see `claim_lanes`) and high-lane rows
+	are sent first on every thread.
+
+	Args:
+		batch_size (int): Maximum rows to claim. Defaults to `email_flush_batch_size` or 500.
+		workers (int): Thread pool size. Defaults to `email_flush_workers` or 8.
+		retries (bool): Send due retries, oldest first, instead of new rows
+
+	Accounts whose circuit breaker is open, or that are throttled, are skipped;
+	their rows stay queued unless a routing pool can take them.
+
+	Returns:
+		dict: Counts of `claimed`, `sent`, `failed` and `deferred` rows, and
+			`more` if lane limits cut the batch short while rows are waiting
+	"""
+	batch_size = batch_size or cint(frappe.conf.get("email_flush_batch_size")) or DEFAULT_BATCH_SIZE
+	workers = workers or cint(frappe.conf.get("email_flush_workers")) or DEFAULT_WORKERS
+	lease = cint(frappe.conf.get("email_flush_lease")) or DEFAULT_LEASE_SECONDS
+
+	summary = {"claimed": 0, "sent": 0, "failed": 0, "deferred": 0, "more": False}
+
+	if frappe.are_emails_muted() or cint(frappe.db.get_default("hold_queue")):
+		return summary
+
+	default_account = get_default_outgoing_account()
+	router = get_router()
+	blocked = get_open_circuits() + get_throttled_accounts()
+	if router and router.available:
+		# Their rows are routed to another pool account instead
+		blocked = [account for account in blocked if account not in router and account != default_account]
+	else:
+		router = None
+
+	with timer("health_core_queue_db_seconds", operation="claim"):
+		if retries:
+			token, rows = claim_batch(batch_size, lease, blocked, default_account, retries=True)
+			more = len(rows) == batch_size
+		else:
+			token, rows, more = claim_lanes(batch_size, lease, blocked, default_account)
+	if not rows:
+		return summary
+
+	summary.update({"claimed": len(rows), "more": more})
+	site = frappe.local.site
+	shards = shard_rows(rows, default_account, router)
+	row_lanes = {row.name: (row.health_core_lane or lanes.NORMAL, row.creation) for row in rows}
+
+	with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="health-core-flush") as executor:
+		futures = []
+		for email_account, names in shards.items():
+			if router and email_account in router:
+				inc("health_core_routed_total", len(names), email_account=email_account)
+			limit = get_account_concurrency(email_account)
+			slots = get_account_slots(site, email_account, limit)
+			for chunk in split_shard(names, limit):
+				futures.append(executor.submit(send_shard, site, token, email_account, chunk, slots, row_lanes))
+
+		for future in futures:
+			try:
+				result = future.result()
+			except Exception:
+				frappe.log_error(title="Health Core: Email Queue shard failed")
+				continue
+			summary["sent"] += result["sent"]
+			summary["failed"] += result["failed"]
+			summary["deferred"] += result["deferred"]
+
+	publish_metrics()
+
+	return summary
+
+
+def flush():
+	"""
+	Drains the Email Queue completely, one claimed batch at a time.
+
+	Drop-in replacement for `frappe.email.queue.flush` in cron/`bench execute`.
+	"""
+	total = {"claimed": 0, "sent": 0, "failed": 0, "deferred": 0}
+	batch_size = cint(frappe.conf.get("email_flush_batch_size")) or DEFAULT_BATCH_SIZE
+
+	while True:
+		result = flush_queue(batch_size)
+		for key in total:
+			total[key] += result[key]
+		# Stop when the queue is drained, or when nothing could be sent (e.g. the server is down)
+		if (result["claimed"] < batch_size and not result["more"]) or not result["sent"]:
+			break
+
+	return total
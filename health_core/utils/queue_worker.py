@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import signal
+import threading
+import time
+
+import frappe
+from frappe.utils import cint, flt
+
+from health_core.utils.flush_scheduler import get_state, record_flush
+from health_core.utils.outbox import ingest_outbox, recover_outbox
+from health_core.utils.queue_flush import flush_queue
+from health_core.utils.smtp_pool import get_pool, prewarm_connections
+
+
+# Redis channel the Email Queue doc_event publishes on; messages carry the site name
+QUEUE_CHANNEL = "health_core:email_queue"
+HEARTBEAT_KEY = "health_core:queue_worker:heartbeat"
+
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_POLL_INTERVAL = 5
+
+# Wakes a worker running in this process when a row is inserted locally
+_local_wakeup = threading.Event()
+
+
+def notify_email_queued(doc, method=None):
+	"""
+	doc_event handler for Email Queue `after_insert`.
+
+	Wakes the resident queue worker once the inserting transaction commits, so
+	that the row is sent right away instead of on the next cron tick.
+	"""
+	site = frappe.local.site
+
+	def publish():
+		_local_wakeup.set()
+		try:
+			frappe.cache().publish(QUEUE_CHANNEL, site)
+		except Exception:
+			# The worker falls back to polling; enqueueing must never fail because of Redis
+			pass
+
+	frappe.db.after_commit.add(publish)
+
+
+def drain_queue(batch_size=DEFAULT_BATCH_SIZE, adaptive=False):
+	"""
+	Sends one batch of pending Email Queue rows through the sharded flush.
+
+	Args:
+		adaptive (bool): Feed the outcome to the adaptive flush schedule, whose
+			batch size the worker then uses (see `health_core.utils.flush_scheduler`)
+
+	Returns:
+		bool: True if more rows are probably waiting: the batch was full (not
+			counting rows deferred by an open circuit breaker), or priority
+			lane limits cut it short
+	"""
+	start = time.monotonic()
+	result = flush_queue(batch_size=batch_size)
+	if adaptive:
+		record_flush(result, time.monotonic() - start)
+	picked = result["claimed"] - result["deferred"]
+	return picked >= batch_size or bool(picked and result["more"])
+
+
+class EmailQueueWorker(object):
+	"""
+	Long-lived Email Queue drain loop for a single site.
+
+	The site is initialised once. The loop drains in batches while there is
+	work, then sleeps until an Email Queue insert is published on Redis (or
+	signalled in-process), falling back to a short poll if nothing arrives.
+
+	Without a fixed batch size (`--batch-size` or `email_worker_batch_size`)
+	each batch is sized by the adaptive flush schedule, which the worker keeps
+	up to date in place of the scheduled flush job.
+	"""
+
+	def __init__(self, site, batch_size=None, poll_interval=None):
+		self.site = site
+		self.batch_size = batch_size
+		self.poll_interval = poll_interval
+		self.running = False
+		self._pubsub = None
+
+	def run(self):
+		frappe.init(site=self.site)
+		frappe.connect()
+
+		self.batch_size = self.batch_size or cint(frappe.conf.get("email_worker_batch_size"))
+		adaptive = not self.batch_size and cint(frappe.conf.get("email_adaptive_flush", 1))
+		self.batch_size = self.batch_size or DEFAULT_BATCH_SIZE
+		self.poll_interval = self.poll_interval or flt(frappe.conf.get("email_worker_poll_interval")) or DEFAULT_POLL_INTERVAL
+		self.running = True
+
+		signal.signal(signal.SIGTERM, self.stop)
+		signal.signal(signal.SIGINT, self.stop)
+
+		self._subscribe()
+		self.ingest(recover_outbox)
+		prewarm_connections()
+		frappe.logger().info(f"Health Core email worker started for {self.site}")
+
+		try:
+			while self.running:
+				self.heartbeat()
+
+				# End the previous transaction so newly committed rows are visible
+				frappe.db.rollback()
+
+				self.ingest(ingest_outbox)
+
+				try:
+					if adaptive:
+						self.batch_size = get_state()["batch_size"]
+					more = drain_queue(self.batch_size, adaptive)
+				except Exception:
+					frappe.log_error(title="Health Core: email worker drain failed")
+					more = False
+
+				if not more:
+					get_pool().evict_idle()
+					# Replace evicted sessions so the next burst starts on warm ones
+					prewarm_connections()
+					self.wait()
+		finally:
+			self._unsubscribe()
+			get_pool().close_all()
+			frappe.destroy()
+
+	def stop(self, *args):
+		self.running = False
+		_local_wakeup.set()
+
+	def wait(self):
+		"""Blocks until an enqueue notification for this site arrives or the poll interval passes."""
+		if _local_wakeup.is_set():
+			_local_wakeup.clear()
+			return
+
+		if not self._pubsub:
+			_local_wakeup.wait(self.poll_interval)
+			_local_wakeup.clear()
+			return
+
+		deadline = time.monotonic() + self.poll_interval
+		while self.running:
+			remaining = deadline - time.monotonic()
+			if remaining <= 0:
+				return
+
+			try:
+				message = self._pubsub.get_message(ignore_subscribe_messages=True, timeout=min(remaining, 1))
+			except Exception:
+				frappe.logger().warning("Health Core email worker lost its Redis subscription, polling instead")
+				self._pubsub = None
+				return
+
+			if message and frappe.safe_decode(message.get("data")) == self.site:
+				return
+
+			if _local_wakeup.is_set():
+				_local_wakeup.clear()
+				return
+
+	def ingest(self, ingester):
+		"""Loads the outbox journal, if any, into the Email Queue ahead of the next batch."""
+		try:
+			ingester()
+		except Exception:
+			frappe.db.rollback()
+			frappe.log_error(title="Health Core: outbox ingest failed")
+
+	def heartbeat(self):
+		try:
+			frappe.cache().set_value(HEARTBEAT_KEY, time.time(), expires_in_sec=int(self.poll_interval * 3) + 5)
+		except Exception:
+			pass
+
+	def _subscribe(self):
+		try:
+			self._pubsub = frappe.cache().pubsub()
+			self._pubsub.subscribe(QUEUE_CHANNEL)
+		except Exception:
+			frappe.logger().warning("Health Core email worker could not subscribe to Redis, polling instead")
+			self._pubsub = None
+
+	def _unsubscribe(self):
+		if self._pubsub:
+			try:
+				self._pubsub.close()
+			except Exception:
+				pass
+			self._pubsub = None
+
+
+def is_worker_running():
+	"""Returns True if a resident email worker has reported in recently for this site."""
+	return bool(frappe.cache().get_value(HEARTBEAT_KEY, expires=True))
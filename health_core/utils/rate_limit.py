@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+Token-bucket rate limiting for health_core whitelisted methods.
+
+Buckets live in Redis and are checked and charged atomically by a Lua script,
+so limits hold across all web workers and hosts of a site. If Redis is
+unreachable each worker falls back to its own in-process buckets.
+"""
+from __future__ import unicode_literals
+import functools
+import json
+import math
+import threading
+import time
+from collections import namedtuple
+
+import frappe
+
+from health_core.utils.metrics import inc
+
+
+# `limit` requests per `period` seconds, with bursts of up to `limit`
+Limit = namedtuple("Limit", ["scope", "limit", "period"])
+
+RATE_LIMIT_KEY = "health_core:rate_limit:{0}:{1}:{2}"
+LOCAL_BUCKET_LIMIT = 10000
+
+# Checks every bucket first and only charges them if all have a token, so a
+# rejected request never consumes quota. Time comes from Redis, not the caller.
+TOKEN_BUCKET_SCRIPT = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local wait = 0
+local tokens = {}
+
+for i, key in ipairs(KEYS) do
+	local capacity = tonumber(ARGV[i * 2 - 1])
+	local rate = tonumber(ARGV[i * 2])
+	local bucket = redis.call('HMGET', key, 'tokens', 'ts')
+	local available = tonumber(bucket[1]) or capacity
+	local last = tonumber(bucket[2]) or now
+	available = math.min(capacity, available + math.max(0, now - last) * rate)
+	tokens[i] = available
+	if available < 1 then
+		wait = math.max(wait, (1 - available) / rate)
+	end
+end
+
+if wait > 0 then
+	return tostring(wait)
+end
+
+for i, key in ipairs(KEYS) do
+	local capacity = tonumber(ARGV[i * 2 - 1])
+	local rate = tonumber(ARGV[i * 2])
+	redis.call('HSET', key, 'tokens', tokens[i] - 1, 'ts', now)
+	redis.call('PEXPIRE', key, math.ceil(capacity / rate * 1000) + 1000)
+end
+
+return '0'
+"""
+
+_local_buckets = {}
+_local_buckets_lock = threading.Lock()
+
+
+def get_limits(endpoint, defaults):
+	"""
+	Returns the limits for an endpoint: the decorator defaults, overridden per
+	scope by `rate_limits` in site config, e.g.
+	`{"api.send_test_email": {"ip": [5, 60], "global": [200, 60]}}`.
+	A scope set to `null` is disabled.
+	"""
+	overrides = (frappe.conf.get("rate_limits") or {}).get(endpoint) or {}
+	limits = []
+
+	for limit in defaults:
+		if limit.scope in overrides:
+			override = overrides[limit.scope]
+			if not override:
+				continue
+			limit = Limit(limit.scope, override[0], override[1])
+		limits.append(limit)
+
+	return limits
+
+
+def get_scope_value(scope, kwargs):
+	if scope == "global":
+		return "*"
+	if scope == "ip":
+		return getattr(frappe.local, "request_ip", None) or "unknown"
+	if scope == "user":
+		return frappe.session.user
+	# Any other scope names an argument of the method, e.g. the recipient
+	value = kwargs.get(scope)
+	return str(value).strip().lower() if value else None
+
+
+def check_buckets(buckets):
+	"""
+	Takes one token from every bucket, or none if any bucket is empty.
+
+	Args:
+		buckets (list): (key, capacity, refill rate per second) tuples
+
+	Returns:
+		float: 0 if admitted, otherwise seconds until a token is available
+	"""
+	try:
+		cache = frappe.cache()
+		script = cache.register_script(TOKEN_BUCKET_SCRIPT)
+		args = []
+		for key, capacity, rate in buckets:
+			args.extend((capacity, rate))
+		return float(script(keys=[cache.make_key(key) for key, _, _ in buckets], args=args))
+	except Exception:
+		return check_local_buckets(buckets)
+
+
+def check_local_buckets(buckets, now=None):
+	"""In-process stand-in for `check_buckets`, used while Redis is unavailable."""
+	now = now or time.monotonic()
+	site = getattr(frappe.local, "site", None)
+
+	with _local_buckets_lock:
+		if len(_local_buckets) > LOCAL_BUCKET_LIMIT:
+			_local_buckets.clear()
+
+		state = []
+		wait = 0
+		for key, capacity, rate in buckets:
+			available, last = _local_buckets.get((site, key), (capacity, now))
+			available = min(capacity, available + max(0, now - last) * rate)
+			state.append(available)
+			if available < 1:
+				wait = max(wait, (1 - available) / rate)
+
+		if wait:
+			return wait
+
+		for (key, capacity, rate), available in zip(buckets, state):
+			_local_buckets[(site, key)] = (available - 1, now)
+
+	return 0
+
+
+def too_many_requests(retry_after):
+	"""
+	Builds the rejection: a bare 429 response with Retry-After for HTTP
+	requests, or TooManyRequestsError when called from Python.
+	"""
+	retry_after = max(1, int(math.ceil(retry_after)))
+	message = "Too many requests, please retry in {0} seconds".format(retry_after)
+
+	if not getattr(frappe.local, "request", None):
+		frappe.throw(message, frappe.TooManyRequestsError)
+
+	from werkzeug.wrappers import Response
+
+	response = Response(
+		json.dumps({"message": {"status": "error", "message": message, "retry_after": retry_after}}),
+		status=429,
+		mimetype="application/json"
+	)
+	response.headers["Retry-After"] = str(retry_after)
+	return response
+
+
+def rate_limit(*limits):
+	"""
+	Rejects calls to a whitelisted method once any of its token buckets is empty.
+	Apply directly below `@frappe.whitelist()`, so floods are shed before the
+	method touches the database or SMTP.
+
+	Args:
+		limits (Limit): Buckets to charge per call. The scope is `ip`, `user`,
+			`global` or the name of a method argument (one bucket per value).
+	"""
+	def decorator(fn):
+		endpoint = "{0}.{1}".format(fn.__module__.rsplit(".", 1)[-1], fn.__name__)
+
+		@functools.wraps(fn)
+		def wrapper(*args, **kwargs):
+			buckets = []
+			for limit in get_limits(endpoint, limits):
+				value = get_scope_value(limit.scope, kwargs)
+				if value:
+					buckets.append((
+						RATE_LIMIT_KEY.format(endpoint, limit.scope, value),
+						limit.limit,
+						limit.limit / float(limit.period)
+					))
+
+			retry_after = check_buckets(buckets) if buckets else 0
+			if retry_after:
+				inc("health_core_rate_limited_total", endpoint=endpoint)
+				return too_many_requests(retry_after)
+
+			return fn(*args, **kwargs)
+
+		return wrapper
+
+	return decorator
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+Backoff for failed Email Queue sends.
+
+Frappe leaves a failed row `Not Sent` (or `Partially Sent`) and retries it on
+the next flush, so every failure from a struggling provider is retried at the
+same moment. health_core instead stamps the row with its own next attempt
+time, `base * 2 ** (attempt - 1)` seconds away (capped, with jitter), and the
+regular flush leaves it alone. A scheduled job sends rows whose time has
+come, oldest first, and gives up on a row after `email_retry_max_attempts`
+attempts.
+
+Failed attempts are counted in the row's own `health_core_attempts`: Frappe's
+`retry` is not incremented for connection and refused-recipient errors,
+which are the ones worth backing off from.
+"""
+from __future__ import unicode_literals
+import random
+
+import frappe
+from frappe.utils import add_to_date, cint, now_datetime
+
+from health_core.utils.metrics import inc
+
+
+DEFAULT_BASE_DELAY = 60
+DEFAULT_MAX_DELAY = 3600
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_BATCH_SIZE = 100
+
+RETRY_INDEX = "health_core_next_attempt_index"
+RETRY_INDEX_FIELDS = ["status", "health_core_next_attempt"]
+
+
+def get_max_attempts():
+	"""
+	Attempts before a row is given up on: `email_retry_max_attempts`, else
+	Frappe's own Email Retry Limit system setting.
+	"""
+	return (
+		cint(frappe.conf.get("email_retry_max_attempts"))
+		or cint(frappe.db.get_single_value("System Settings", "email_retry_limit"))
+		or DEFAULT_MAX_ATTEMPTS
+	)
+
+
+def get_backoff(attempt, rng=random):
+	"""
+	Seconds to wait before retrying after `attempt` failed attempts.
+
+	The exponential delay is capped at `email_retry_max_delay`, then half of
+	it is randomised so rows that failed together are retried apart.
+	"""
+	base = cint(frappe.conf.get("email_retry_base_delay")) or DEFAULT_BASE_DELAY
+	cap = cint(frappe.conf.get("email_retry_max_delay")) or DEFAULT_MAX_DELAY
+	delay = min(cap, base * 2 ** max(attempt - 1, 0))
+	return delay / 2 + rng.uniform(0, delay / 2)
+
+
+def schedule_retries(names, now=None, rng=random):
+	"""
+	Schedules the next attempt for rows a flush failed to send, or marks them
+	`Error` once they are out of attempts. Rows Frappe already finished with
+	(sent, or errored permanently) are left alone.
+
+	Returns:
+		dict: Counts of `scheduled` and `abandoned` rows
+	"""
+	result = {"scheduled": 0, "abandoned": 0}
+	if not names:
+		return result
+
+	rows = frappe.db.sql("""
+		select name, health_core_attempts
+		from `tabEmail Queue`
+		where name in %(names)s and status in ('Not Sent', 'Partially Sent')
+	""", {"names": tuple(names)}, as_dict=True)
+
+	now = now or now_datetime()
+	max_attempts = get_max_attempts()
+
+	for row in rows:
+		attempts = cint(row.health_core_attempts) + 1
+		if attempts >= max_attempts:
+			frappe.db.sql("""
+				update `tabEmail Queue`
+				set status = 'Error', health_core_next_attempt = null, health_core_attempts = %(attempts)s
+				where name = %(name)s
+			""", {"name": row.name, "attempts": attempts})
+			result["abandoned"] += 1
+		else:
+			frappe.db.sql("""
+				update `tabEmail Queue`
+				set health_core_next_attempt = %(next_attempt)s, health_core_attempts = %(attempts)s
+				where name = %(name)s
+			""", {"name": row.name, "attempts": attempts, "next_attempt": add_to_date(now, seconds=get_backoff(attempts, rng))})
+			result["scheduled"] += 1
+
+	frappe.db.commit()
+
+	if result["scheduled"]:
+		inc("health_core_email_retries_scheduled_total", result["scheduled"])
+	if result["abandoned"]:
+		inc("health_core_email_retries_abandoned_total", result["abandoned"])
+
+	return result
+
+
+def flush_retries():
+	"""
+	Scheduled job: sends Email Queue rows whose next attempt is due, in the
+	order they became due, in batches of `email_retry_batch_size`.
+	"""
+	from health_core.utils.queue_flush import flush_queue
+
+	batch_size = cint(frappe.conf.get("email_retry_batch_size")) or DEFAULT_BATCH_SIZE
+	total = {"claimed": 0, "sent": 0, "failed": 0, "deferred": 0}
+
+	while True:
+		result = flush_queue(batch_size, retries=True)
+		for key in total:
+			total[key] += result[key]
+		if result["claimed"] < batch_size or not result["sent"]:
+			break
+
+	return total
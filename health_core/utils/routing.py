@@ -0,0 +1,333 @@
+# -*- coding: utf-8 -*-
+"""
+Multi-account routing for outgoing mail.
+
+Email Accounts with "Use for Health Core Routing" checked form a routing pool.
+Messages without a dedicated account (or sent from the default outgoing
+account or a pool member) are spread over the pool in proportion to each
+account's weight (queued rows only move to an account whose address shares
+the domain of their From header, so SPF and DMARC still align):
+
+	weight = (1 - error rate)^2 / send latency * share of daily quota left
+
+Latency and error rate are exponentially weighted averages kept by each worker
+from its own sends. Throttling responses (421, 45x "try later", 5xx "quota
+exceeded") and exhausted daily quotas take an account out of the pool for all
+workers through Redis, as does an open circuit breaker, so traffic fails over
+to the remaining accounts automatically.
+"""
+from __future__ import unicode_literals
+import random
+import re
+import smtplib
+import threading
+import time
+from collections import OrderedDict
+from email.utils import parseaddr
+
+import frappe
+from frappe.utils import add_days, cint, get_datetime, now_datetime, nowdate
+
+from health_core.utils.cache import DEFAULT_LISTING_TTL, get_versioned_value
+from health_core.utils.metrics import inc
+from health_core.utils.smtp_health import is_open
+
+
+ROUTING_ACCOUNTS_KEY = "health_core:routing_accounts"
+THROTTLED_KEY = "health_core:smtp_throttled:{0}"
+QUOTA_KEY = "health_core:smtp_quota:{0}:{1}"
+
+# Latency assumed for accounts this worker has not sent through yet
+DEFAULT_LATENCY = 0.5
+MIN_LATENCY = 0.01
+EWMA_ALPHA = 0.2
+DEFAULT_THROTTLE_COOLDOWN = 300
+
+THROTTLED = "throttled"
+QUOTA = "quota"
+
+TEMPORARY_CODES = (450, 451, 452, 454)
+THROTTLE_PATTERN = re.compile(r"rate|limit|quota|too many|throttl|try again later", re.I)
+QUOTA_PATTERN = re.compile(r"quota|limit exceeded|too many", re.I)
+
+# (site, Email Account) -> (latency EWMA in seconds or None, error rate EWMA)
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def get_routing_accounts():
+	"""
+	Returns the routing pool: enabled outgoing Email Accounts with routing
+	checked, each with its `email_id` and `daily_quota` (0 = unlimited).
+	Cached until any Email Account changes.
+	"""
+	def generate():
+		return frappe.get_all(
+			"Email Account",
+			filters={"enable_outgoing": 1, "health_core_routing": 1},
+			fields=["name", "email_id", "health_core_daily_quota as daily_quota"],
+			order_by="name asc"
+		)
+
+	return get_versioned_value(ROUTING_ACCOUNTS_KEY, generate, DEFAULT_LISTING_TTL)
+
+
+def get_stats(email_account):
+	return _stats.get((frappe.local.site, email_account), (None, 0.0))
+
+
+def get_throttle_reason(error):
+	"""
+	Classifies an SMTP error.
+
+	Returns:
+		str: `throttled` for temporary rate limiting, `quota` for an exhausted
+			sending quota, None for anything else
+	"""
+	if isinstance(error, smtplib.SMTPRecipientsRefused):
+		codes = [code for code, _ in error.recipients.values()]
+		if codes and all(code == 421 or code in TEMPORARY_CODES for code in codes):
+			return THROTTLED
+		return None
+
+	code = getattr(error, "smtp_code", None)
+	if not code:
+		return None
+
+	message = frappe.safe_decode(getattr(error, "smtp_error", b"") or b"")
+	if code == 421 or (code in TEMPORARY_CODES and THROTTLE_PATTERN.search(message)):
+		return THROTTLED
+	if code >= 500 and QUOTA_PATTERN.search(message):
+		return QUOTA
+
+	return None
+
+
+def is_failover_error(error):
+	"""Returns True if a send failed because of the account, so another account may succeed."""
+	from health_core.utils.smtp_pool import CONNECTION_ERRORS
+
+	if get_throttle_reason(error):
+		return True
+
+	return isinstance(error, CONNECTION_ERRORS + (
+		smtplib.SMTPConnectError,
+		smtplib.SMTPAuthenticationError,
+		smtplib.SMTPHeloError,
+		ConnectionError
+	))
+
+
+def record_send(email_account, seconds=None, error=None):
+	"""
+	Feeds one send's outcome into this worker's averages for the account.
+	Successful sends count against the account's daily quota; throttling
+	errors take it out of the pool for `smtp_throttle_cooldown` seconds (quota
+	errors until tomorrow).
+
+	Returns:
+		str: The throttle reason, if the error was a throttling response
+	"""
+	key = (frappe.local.site, email_account)
+	with _stats_lock:
+		latency, error_rate = _stats.get(key, (None, 0.0))
+		if error is None and seconds is not None:
+			latency = seconds if latency is None else latency + EWMA_ALPHA * (seconds - latency)
+		error_rate += EWMA_ALPHA * ((1.0 if error is not None else 0.0) - error_rate)
+		_stats[key] = (latency, error_rate)
+
+	if error is None:
+		count_quota(email_account)
+		return None
+
+	reason = get_throttle_reason(error)
+	if reason:
+		throttle(email_account, reason, str(error))
+	return reason
+
+
+def count_quota(email_account):
+	quotas = {account.name: cint(account.daily_quota) for account in get_routing_accounts()}
+	if not quotas.get(email_account):
+		return
+
+	cache = frappe.cache()
+	key = cache.make_key(QUOTA_KEY.format(email_account, nowdate()))
+	pipe = cache.pipeline()
+	pipe.incr(key)
+	pipe.expire(key, 2 * 24 * 3600)
+	pipe.execute()
+
+
+def get_quota_used(email_accounts):
+	"""Returns messages sent today per account, for accounts with a daily quota."""
+	if not email_accounts:
+		return {}
+
+	cache = frappe.cache()
+	pipe = cache.pipeline()
+	for email_account in email_accounts:
+		pipe.get(cache.make_key(QUOTA_KEY.format(email_account, nowdate())))
+
+	return {email_account: cint(used) for email_account, used in zip(email_accounts, pipe.execute())}
+
+
+def throttle(email_account, reason, error=None):
+	"""Takes an account out of the routing pool (and out of queue flushes) for all workers."""
+	if reason == QUOTA:
+		tomorrow = get_datetime(add_days(nowdate(), 1))
+		seconds = max(int((tomorrow - now_datetime()).total_seconds()), 60)
+	else:
+		seconds = cint(frappe.conf.get("smtp_throttle_cooldown")) or DEFAULT_THROTTLE_COOLDOWN
+
+	frappe.cache().set_value(
+		THROTTLED_KEY.format(email_account),
+		{"reason": reason, "error": error, "until": time.time() + seconds},
+		expires_in_sec=seconds
+	)
+	inc("health_core_smtp_throttled_total", email_account=email_account, reason=reason)
+	frappe.logger().warning(f"Health Core: {email_account} {reason} for {seconds}s, routing around it: {error}")
+
+
+def is_throttled(email_account):
+	# Set by other processes; skip frappe.local.cache so long-lived workers see it
+	return bool(frappe.cache().get_value(THROTTLED_KEY.format(email_account), expires=True))
+
+
+def get_throttled_accounts():
+	"""Returns the outgoing Email Accounts that are currently throttled or over quota."""
+	return [
+		email_account
+		for email_account in frappe.get_all("Email Account", filters={"enable_outgoing": 1}, pluck="name")
+		if is_throttled(email_account)
+	]
+
+
+def get_weight(latency, error_rate, remaining=1.0):
+	"""Relative share of traffic for an account (0 takes it out of rotation)."""
+	return (1.0 - min(error_rate, 1.0)) ** 2 / max(latency, MIN_LATENCY) * max(remaining, 0.0)
+
+
+def get_domain(address):
+	"""Lower-cased domain of an address or `Name <address>` header value, or None."""
+	domain = parseaddr(address or "")[1].rpartition("@")[2]
+	return domain.lower() or None
+
+
+class Router(object):
+	"""
+	Picks Email Accounts from the routing pool at random, in proportion to their weights.
+
+	Args:
+		weights (list): (Email Account, weight) pairs
+		domains (dict): Email Account -> domain of its address, for `choose(domain=...)`
+	"""
+
+	def __init__(self, weights, rng=None, domains=None):
+		self.weights = OrderedDict(weights)
+		self.rng = rng or random
+		self.domains = domains or {}
+
+	def __contains__(self, email_account):
+		return email_account in self.weights
+
+	@property
+	def available(self):
+		return [email_account for email_account, weight in self.weights.items() if weight > 0]
+
+	def choose(self, exclude=(), domain=None):
+		"""
+		Args:
+			domain (str): Only pick accounts whose address is in this domain
+
+		Returns:
+			str: An available account not in `exclude`, or None
+		"""
+		candidates = [
+			(a, w) for a, w in self.weights.items()
+			if w > 0 and a not in exclude and (not domain or self.domains.get(a) == domain)
+		]
+		if not candidates:
+			return None
+
+		point = self.rng.random() * sum(weight for _, weight in candidates)
+		for email_account, weight in candidates:
+			point -= weight
+			if point < 0:
+				return email_account
+
+		return candidates[-1][0]
+
+	def ranked(self, exclude=()):
+		"""Returns all available accounts in a weighted random order: first choice, then failovers."""
+		order = []
+		exclude = list(exclude)
+		while True:
+			email_account = self.choose(exclude)
+			if not email_account:
+				return order
+			order.append(email_account)
+			exclude.append(email_account)
+
+
+def get_router():
+	"""
+	Returns a Router over the routing pool weighted by this worker's latency
+	and error averages and today's quota usage, or None if no pool is configured.
+	"""
+	accounts = get_routing_accounts()
+	if not accounts:
+		return None
+
+	used = get_quota_used([account.name for account in accounts if cint(account.daily_quota)])
+	known = [get_stats(account.name)[0] for account in accounts]
+	known = [latency for latency in known if latency is not None]
+	# Accounts this worker has not used yet get the average, so they still receive traffic
+	default_latency = sum(known) / len(known) if known else DEFAULT_LATENCY
+
+	weights = []
+	for account in accounts:
+		if is_open(account.name) or is_throttled(account.name):
+			weights.append((account.name, 0))
+			continue
+
+		latency, error_rate = get_stats(account.name)
+		quota = cint(account.daily_quota)
+		remaining = (quota - used.get(account.name, 0)) / float(quota) if quota else 1.0
+		weights.append((account.name, get_weight(latency or default_latency, error_rate, remaining)))
+
+	return Router(weights, domains={account.name: get_domain(account.email_id) for account in accounts})
+
+
+def route_accounts(default_account=None):
+	"""
+	Returns the accounts to try for a message without a dedicated Email Account:
+	the available pool in weighted random order, or just the default outgoing
+	account when no pool is configured (or every pool member is unavailable).
+	"""
+	router = get_router()
+	accounts = router.ranked() if router else []
+	if accounts:
+		return accounts
+
+	from health_core.utils.smtp_pool import get_default_outgoing_account
+
+	default_account = default_account or get_default_outgoing_account()
+	return [default_account] if default_account else []
+
+
+def get_routing_gauges():
+	"""Samples for the metrics endpoint: current weight and quota usage per pool account."""
+	router = get_router()
+	if not router:
+		return []
+
+	accounts = get_routing_accounts()
+	used = get_quota_used([account.name for account in accounts if cint(account.daily_quota)])
+
+	samples = []
+	for email_account, weight in router.weights.items():
+		samples.append(("health_core_route_weight", {"email_account": email_account}, round(weight, 4)))
+		if email_account in used:
+			samples.append(("health_core_smtp_quota_used", {"email_account": email_account}, used[email_account]))
+	return samples
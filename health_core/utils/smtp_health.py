@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+"""
+SMTP health probing and a per-account circuit breaker.
+
+A scheduled prober connects to every outgoing Email Account's server (EHLO,
+STARTTLS and optionally AUTH) and caches the result in Redis, so status
+endpoints can report live health without network I/O.
+
+The circuit breaker is shared by all workers through Redis:
+
+	closed     Sends go through; consecutive connection failures are counted.
+	open       After `smtp_circuit_failure_threshold` failures flushes skip the
+	           account, leaving its rows queued, for `smtp_circuit_cooldown` seconds.
+	half_open  After the cooldown a limited number of trial sends (or the next
+	           probe) decide whether the circuit closes again or reopens.
+"""
+from __future__ import unicode_literals
+import time
+
+import frappe
+from frappe.utils import cint, now
+
+from health_core.utils.metrics import observe
+
+
+HEALTH_KEY = "health_core:smtp_health:{0}"
+CIRCUIT_KEY = "health_core:smtp_circuit:{0}"
+TRIALS_KEY = "health_core:smtp_circuit_trials:{0}"
+LAST_PROBE_KEY = "health_core:smtp_last_probe"
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+DEFAULT_PROBE_INTERVAL = 60
+DEFAULT_PROBE_TIMEOUT = 10
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_COOLDOWN = 60
+DEFAULT_HALF_OPEN_TRIALS = 1
+
+
+def get_probe_interval():
+	return cint(frappe.conf.get("smtp_probe_interval")) or DEFAULT_PROBE_INTERVAL
+
+
+def probe_smtp_servers():
+	"""
+	Scheduled job: probes every enabled outgoing Email Account and caches the results.
+
+	Runs every minute from `scheduler_events`; `smtp_probe_interval` can space
+	probes further apart.
+	"""
+	cache = frappe.cache()
+	if cache.get_value(LAST_PROBE_KEY, expires=True):
+		return
+
+	interval = get_probe_interval()
+	cache.set_value(LAST_PROBE_KEY, now(), expires_in_sec=max(interval - 5, 1))
+
+	for email_account in frappe.get_all("Email Account", filters={"enable_outgoing": 1}, pluck="name"):
+		probe_account(email_account)
+
+
+def probe_account(email_account):
+	"""
+	Connects to an account's SMTP server, runs EHLO (and STARTTLS), optionally
+	AUTH (`smtp_probe_auth`), and records the outcome and per-phase latency.
+
+	Returns:
+		dict: The stored health record
+	"""
+	from health_core.utils.smtp_pool import get_account_settings, open_session
+
+	timings = {}
+	start = time.perf_counter()
+	health = {"email_account": email_account, "checked_at": now()}
+
+	try:
+		settings = get_account_settings(email_account)
+		settings = settings._replace(timeout=cint(frappe.conf.get("smtp_probe_timeout")) or DEFAULT_PROBE_TIMEOUT)
+		if not cint(frappe.conf.get("smtp_probe_auth")):
+			settings = settings._replace(login=None, password=None)
+
+		session = open_session(settings, timings)
+		try:
+			session.quit()
+		except Exception:
+			session.close()
+	except Exception as e:
+		health.update({"status": "down", "error": str(e) or type(e).__name__})
+		record_failure(email_account)
+	else:
+		health.update({"status": "up", "error": None})
+		record_success(email_account)
+
+	elapsed = time.perf_counter() - start
+	observe("health_core_smtp_probe_seconds", elapsed, email_account=email_account, status=health["status"])
+
+	health.update({
+		"latency_ms": round(elapsed * 1000, 2),
+		"timings": {phase: round(ms, 2) for phase, ms in timings.items()},
+		"circuit": get_circuit(email_account)["state"]
+	})
+	# Expires after a few missed probes so a stopped scheduler shows up as "unknown"
+	frappe.cache().set_value(HEALTH_KEY.format(email_account), health, expires_in_sec=get_probe_interval() * 3 + 30)
+
+	return health
+
+
+def get_health(email_account):
+	"""
+	Returns the last probe result for an account from Redis (no network I/O to the SMTP server).
+
+	Returns:
+		dict: `status` is `up`, `down` or `unknown` (not probed recently)
+	"""
+	health = frappe.cache().get_value(HEALTH_KEY.format(email_account), expires=True)
+	if not health:
+		health = {"email_account": email_account, "status": "unknown"}
+
+	health["circuit"] = get_circuit(email_account)["state"]
+	return health
+
+
+def add_health(status):
+	"""Adds the cached live health of the status's Email Account to a configuration status dict."""
+	account = (status.get("account_details") or {}).get("name")
+	if account:
+		status["health"] = get_health(account)
+	return status
+
+
+def get_circuit(email_account):
+	# expires=True skips frappe.local.cache, which would pin the first value read for the life of a worker
+	return frappe.cache().get_value(CIRCUIT_KEY.format(email_account), expires=True) or {"state": CLOSED, "failures": 0}
+
+
+def set_circuit(email_account, circuit):
+	frappe.cache().set_value(CIRCUIT_KEY.format(email_account), circuit)
+
+
+def allow_request(email_account):
+	"""
+	Returns True if sends through this account may proceed.
+
+	An open circuit whose cooldown has passed turns half-open and admits up to
+	`smtp_circuit_half_open_trials` callers across all workers.
+	"""
+	circuit = get_circuit(email_account)
+
+	if circuit["state"] == CLOSED:
+		return True
+
+	if circuit["state"] == OPEN:
+		cooldown = cint(frappe.conf.get("smtp_circuit_cooldown")) or DEFAULT_COOLDOWN
+		if time.time() - circuit.get("opened_at", 0) < cooldown:
+			return False
+		circuit["state"] = HALF_OPEN
+		set_circuit(email_account, circuit)
+
+	trials = cint(frappe.conf.get("smtp_circuit_half_open_trials")) or DEFAULT_HALF_OPEN_TRIALS
+	cache = frappe.cache()
+	key = cache.make_key(TRIALS_KEY.format(email_account))
+	pipe = cache.pipeline()
+	pipe.incr(key)
+	pipe.expire(key, cint(frappe.conf.get("smtp_circuit_cooldown")) or DEFAULT_COOLDOWN)
+	taken, _ = pipe.execute()
+
+	return taken <= trials
+
+
+def is_open(email_account):
+	"""Returns True while the account's circuit is open and cooling down (takes no trial)."""
+	circuit = get_circuit(email_account)
+	cooldown = cint(frappe.conf.get("smtp_circuit_cooldown")) or DEFAULT_COOLDOWN
+	return circuit["state"] == OPEN and time.time() - circuit.get("opened_at", 0) < cooldown
+
+
+def get_open_circuits():
+	"""Returns the outgoing Email Accounts whose circuits are open."""
+	return [
+		email_account
+		for email_account in frappe.get_all("Email Account", filters={"enable_outgoing": 1}, pluck="name")
+		if is_open(email_account)
+	]
+
+
+def record_success(email_account):
+	"""Closes the circuit (no write if it is already closed with no failures)."""
+	circuit = get_circuit(email_account)
+	if circuit["state"] == CLOSED and not circuit.get("failures"):
+		return
+
+	if circuit["state"] != CLOSED:
+		frappe.logger().info(f"Health Core: SMTP circuit for {email_account} closed")
+
+	set_circuit(email_account, {"state": CLOSED, "failures": 0})
+	frappe.cache().delete_value(TRIALS_KEY.format(email_account))
+
+
+def record_failure(email_account):
+	"""
+	Counts a connection-level failure, opening the circuit at the threshold
+	or straight away if a half-open trial failed.
+	"""
+	circuit = get_circuit(email_account)
+	circuit["failures"] = circuit.get("failures", 0) + 1
+	threshold = cint(frappe.conf.get("smtp_circuit_failure_threshold")) or DEFAULT_FAILURE_THRESHOLD
+
+	if circuit["state"] != CLOSED or circuit["failures"] >= threshold:
+		if circuit["state"] != OPEN:
+			frappe.logger().warning(f"Health Core: SMTP circuit for {email_account} opened after {circuit['failures']} failures")
+		# Failures while open (e.g. from the prober) restart the cooldown
+		circuit.update({"state": OPEN, "opened_at": time.time()})
+		frappe.cache().delete_value(TRIALS_KEY.format(email_account))
+
+	set_circuit(email_account, circuit)
+	return circuit
+
+
+def get_health_gauges():
+	"""Samples for the metrics endpoint: probe status and circuit state per outgoing account."""
+	samples = []
+	for email_account in frappe.get_all("Email Account", filters={"enable_outgoing": 1}, pluck="name"):
+		health = get_health(email_account)
+		samples.append(("health_core_smtp_up", {"email_account": email_account}, {"up": 1, "down": 0}.get(health["status"], -1)))
+		samples.append(("health_core_smtp_circuit_open", {"email_account": email_account}, int(health["circuit"] != CLOSED)))
+	return samples
@@ -1,22 +1,31 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
+import json
 import frappe
 from frappe import _
+from frappe.utils import cint
+from health_core.utils.email_jobs import enqueue_email_job, get_job_status
+from health_core.utils.metrics import get_metrics_text, timed_endpoint
+from health_core.utils.rate_limit import Limit, rate_limit
+from health_core.utils.templates import render_template
 
 
 @frappe.whitelist()
+@timed_endpoint
 def get_smtp_configuration_status():
 	"""
 	API endpoint to get the current SMTP configuration status.
 	This can be used by the frontend to display configuration information.
+	The status is cached and refreshed whenever an Email Account changes.
 	
 	Returns:
 		dict: Current SMTP configuration status and details
 	"""
-	from health_core.setup.install import validate_smtp_configuration
+	from health_core.utils.cache import get_cached_smtp_status
+	from health_core.utils.smtp_health import add_health
 	
 	try:
-		return validate_smtp_configuration()
+		return add_health(get_cached_smtp_status())
 	except Exception as e:
 		frappe.logger().error(f"Error getting SMTP configuration status: {str(e)}")
 		return {
@@ -27,6 +36,7 @@ def get_smtp_configuration_status():
 
 
 @frappe.whitelist(methods=["POST"])
+@timed_endpoint
 def reset_to_default_smtp():
 	"""
 	API endpoint to reset email configuration back to 4Geeks default SMTP.
@@ -75,16 +85,20 @@ def reset_to_default_smtp():
 
 
 @frappe.whitelist(methods=["POST"])
+@rate_limit(Limit("user", 10, 60), Limit("recipient_email", 10, 3600))
+@timed_endpoint
 def send_test_email_api(recipient_email=None):
 	"""
 	API endpoint to send a test email using the current SMTP configuration.
+	The email is sent by a background job; poll `get_test_email_status` with
+	the returned job id for the outcome.
 	
 	Args:
 		recipient_email (str): Email address to send test email to. 
 		                      If not provided, sends to current user.
 	
 	Returns:
-		dict: Status of the test email operation
+		dict: Status of the test email operation and its job id
 	"""
 	from health_core.setup.install import create_audit_log
 	
@@ -120,44 +134,28 @@ def send_test_email_api(recipient_email=None):
 		
 		# Prepare test email content
 		subject = "Health Core SMTP Test Email"
-		message = f"""
-		<p>Hello,</p>
+		message = render_template("smtp_test_email", {
+			"email_account_name": default_account.email_account_name,
+			"sent_at": frappe.utils.now(),
+			"sent_by": frappe.session.user
+		})
 		
-		<p>This is a test email sent from your 4Geeks Health system to verify that email sending is working correctly.</p>
-		
-		<p><strong>Configuration Details:</strong></p>
-		<ul>
-			<li>Email Account: {default_account.email_account_name}</li>
-			<li>Sent at: {frappe.utils.now()}</li>
-			<li>Sent by: {frappe.session.user}</li>
-		</ul>
-		
-		<p>If you received this email, your SMTP configuration is working properly.</p>
-		
-		<p>Best regards,<br>
-		4Geeks Health System</p>
-		"""
-		
-		# Send the test email
-		frappe.sendmail(
-			recipients=[recipient_email],
+		# Queue the test email; the background job sends it and writes the audit log
+		job_id = enqueue_email_job(
+			recipient_email=recipient_email,
 			subject=subject,
 			message=message,
-			reference_doctype="Email Account",
-			reference_name=default_account.name,
-			now=True
-		)
-		
-		# Log the successful test for audit purposes
-		create_audit_log(
-			action="Manual SMTP Test Email Sent",
-			details=f"Test email sent to {recipient_email} by user {frappe.session.user}",
-			status="Success"
+			email_account=default_account.name,
+			audit_action="Manual SMTP Test Email",
+			sent_by=frappe.session.user,
+			# The body embeds the send time; repeated clicks are still the same test email
+			dedup_content="smtp_test_email:" + frappe.session.user
 		)
 		
 		return {
-			"status": "success",
-			"message": f"Test email sent successfully to {recipient_email}"
+			"status": "queued",
+			"message": f"Test email to {recipient_email} has been queued",
+			"job_id": job_id
 		}
 		
 	except Exception as e:
@@ -176,7 +174,131 @@ def send_test_email_api(recipient_email=None):
 		}
 
 
+@frappe.whitelist(methods=["POST"])
+@rate_limit(Limit("user", 20, 3600))
+@timed_endpoint
+def send_bulk_email(recipients, subject, message, email_account=None, stream=0):
+	"""
+	API endpoint to send the same email to many recipients (e.g. a clinic-wide notice).
+	
+	Addresses are validated and de-duplicated in one pass, the message is built
+	once and sent over a single pooled SMTP session, grouping recipients into
+	as few SMTP transactions as the server allows.
+	
+	Args:
+		recipients: List, JSON list or comma/newline separated string of addresses
+		subject (str): Email subject
+		message (str): HTML body
+		email_account (str): Email Account to send from. Defaults to the default outgoing account.
+		stream (int): If 1, per-recipient outcomes are streamed as newline-delimited JSON
+	
+	Returns:
+		dict: Counts and a per-recipient outcome list (`sent`, `failed` or `invalid`)
+	"""
+	from health_core.utils.bulk_email import iter_bulk_send
+	
+	try:
+		if not frappe.has_permission("Communication", "create"):
+			frappe.throw(_("You don't have permission to send emails"))
+		
+		if not subject or not message:
+			return {
+				"status": "error",
+				"message": "Subject and message are required"
+			}
+		
+		summary, outcomes = iter_bulk_send(recipients, subject, message, email_account)
+		user = frappe.session.user
+		
+		if cint(stream) and getattr(frappe.local, "request", None):
+			from werkzeug.wrappers import Response
+			
+			site = frappe.local.site
+			
+			def generate():
+				# The body is streamed after Frappe has torn the request down, but
+				# recording send outcomes and the audit log need the site
+				initialized = bool(getattr(frappe.local, "site", None))
+				if not initialized:
+					frappe.init(site=site)
+				counts = {"sent": 0, "failed": 0, "invalid": 0}
+				try:
+					for outcome in outcomes:
+						counts[outcome["status"]] += 1
+						yield json.dumps(outcome) + "\n"
+				finally:
+					try:
+						log_bulk_email(subject, summary, counts, user)
+					finally:
+						if not initialized:
+							frappe.destroy()
+			
+			return Response(generate(), mimetype="application/x-ndjson")
+		
+		results = list(outcomes)
+		counts = {"sent": 0, "failed": 0, "invalid": 0}
+		for outcome in results:
+			counts[outcome["status"]] += 1
+		log_bulk_email(subject, summary, counts, user)
+		
+		return {
+			"status": "success" if not counts["failed"] else "partial",
+			"message": f"Sent to {counts['sent']} of {len(results)} recipients",
+			"counts": counts,
+			"results": results
+		}
+		
+	except Exception as e:
+		frappe.logger().error(f"Failed to send bulk email: {str(e)}")
+		return {
+			"status": "error",
+			"message": f"Failed to send bulk email: {str(e)}"
+		}
+
+
+def log_bulk_email(subject, summary, counts, user):
+	"""Audits a bulk send once its outcomes are known."""
+	from health_core.setup.install import create_audit_log
+	
+	if not counts["failed"] and not counts["invalid"]:
+		status = "Success"
+	elif counts["sent"]:
+		status = "Partial"
+	else:
+		status = "Failed"
+	
+	create_audit_log(
+		action="Bulk Email Sent",
+		details=f"Bulk email '{subject}' from {summary['email_account']} by user {user}: "
+			f"{counts['sent']} sent, {counts['failed']} failed, {counts['invalid']} invalid",
+		status=status
+	)
+
+
 @frappe.whitelist()
+@timed_endpoint
+def get_test_email_status(job_id):
+	"""
+	API endpoint to check on a test email queued by `send_test_email_api`.
+	
+	Args:
+		job_id (str): Job id returned by `send_test_email_api`
+	
+	Returns:
+		dict: Job status (queued, sending, sent or failed), SMTP phase timings in ms and error
+	"""
+	try:
+		return get_job_status(job_id)
+	except Exception as e:
+		frappe.logger().error(f"Error getting test email status: {str(e)}")
+		return {
+			"status": "error",
+			"message": f"Failed to retrieve test email status: {str(e)}"
+		}
+
+
+@frappe.whitelist()
+@timed_endpoint
 def get_email_account_settings():
 	"""
 	API endpoint to get current email account settings for display in UI.
@@ -186,23 +308,18 @@ def get_email_account_settings():
 		dict: Email account configuration details (without password)
 	"""
 	try:
+		from health_core.utils.cache import get_conditional_response, get_email_account_listing
+		
 		# Get all email accounts for the user to see
 		if frappe.has_permission("Email Account", "read"):
-			accounts = frappe.get_all(
-				"Email Account",
-				fields=[
-					"name", "email_account_name", "email_id", "smtp_server", 
-					"smtp_port", "use_tls", "use_ssl", "enable_outgoing", 
-					"default_outgoing", "service"
-				],
-				order_by="default_outgoing desc, creation desc"
-			)
+			can_write = cint(frappe.has_permission("Email Account", "write"))
 			
-			return {
+			# Served with a version-based ETag, so unchanged listings get a 304
+			return get_conditional_response(f"settings-{can_write}", lambda version: {
 				"status": "success",
-				"accounts": accounts,
-				"has_permission_to_modify": frappe.has_permission("Email Account", "write")
-			}
+				"accounts": get_email_account_listing(version),
+				"has_permission_to_modify": bool(can_write)
+			})
 		else:
 			return {
 				"status": "error",
@@ -214,4 +331,52 @@ def get_email_account_settings():
 		return {
 			"status": "error",
 			"message": f"Failed to retrieve email account settings: {str(e)}"
-		}
\ No newline at end of file
+		}
+
+
+@frappe.whitelist()
+@timed_endpoint
+def get_queue_backlog():
+	"""
+	API endpoint for Email Queue backlog analytics: counts by status, pending
+	emails by account and by age bucket, the oldest pending email's age and
+	the retry distribution. Computed with indexed GROUP BY queries and cached
+	for a few seconds, so it is cheap to poll.
+	
+	Returns:
+		dict: Backlog aggregates (see `health_core.utils.backlog.compute_backlog`)
+	"""
+	from health_core.utils.backlog import get_backlog
+	
+	frappe.only_for("System Manager")
+	
+	try:
+		return {
+			"status": "success",
+			"backlog": get_backlog()
+		}
+	except Exception as e:
+		frappe.logger().error(f"Error getting Email Queue backlog: {str(e)}")
+		return {
+			"status": "error",
+			"message": f"Failed to retrieve Email Queue backlog: {str(e)}"
+		}
+
+
+@frappe.whitelist()
+def get_metrics():
+	"""
+	Prometheus scrape endpoint: SMTP phase and endpoint latency histograms of
+	every worker, send and error counters, Email Queue depth and send rate.
+	
+	Only System Managers may read it; scrape with an API key and secret
+	(`Authorization: token <api_key>:<api_secret>`).
+	
+	Returns:
+		Response: Metrics in the Prometheus text exposition format
+	"""
+	from werkzeug.wrappers import Response
+	
+	frappe.only_for("System Manager")
+	
+	return Response(get_metrics_text(), content_type="text/plain; version=0.0.4; charset=utf-8")
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+"""
+SMTP transactions with ESMTP PIPELINING (RFC 2920) and CHUNKING (RFC 3030).
+
+`smtplib.SMTP.sendmail` waits for a reply to every command: MAIL, each RCPT,
+DATA, then the message, i.e. 3 + N round trips for N recipients. When the
+server advertises PIPELINING, `send_message` writes MAIL, all RCPTs and DATA
+(or, with CHUNKING, a single `BDAT ... LAST` after the RCPT replies) in one
+go, so a transaction costs two round trips whatever the number of recipients.
+
+A message shared by many recipients is sent once per transaction with many
+RCPTs. If the server refuses recipients with 452 (too many recipients), the
+limit is remembered for the session (or read from `LIMITS RCPTMAX=`) and the
+refused recipients follow in the next transaction on the same session.
+"""
+from __future__ import unicode_literals
+import re
+import smtplib
+
+from health_core.utils.metrics import inc
+from health_core.utils.mime_stream import DOT_LINE, StreamingMessage
+
+
+CRLF = b"\r\n"
+LINE_ENDINGS = re.compile(br"\r\n|\r|\n")
+
+TOO_MANY_RECIPIENTS = 452
+ACCEPTED_RECIPIENT = (250, 251)
+
+
+def get_recipient_limit(session, max_recipients=None):
+	"""
+	RCPTs per transaction for the session: what the server has taught us,
+	then its `LIMITS RCPTMAX=` (RFC 9422), capped at `max_recipients`.
+	"""
+	limit = getattr(session, "health_core_rcpt_limit", None)
+	if not limit:
+		match = re.search(r"RCPTMAX=(\d+)", session.esmtp_features.get("limits", ""), re.IGNORECASE)
+		limit = int(match.group(1)) if match else None
+
+	if max_recipients:
+		limit = min(limit, max_recipients) if limit else max_recipients
+	return limit
+
+
+def exchange(session, commands, pipelining):
+	"""
+	Sends commands and reads their replies: all at once when pipelining,
+	otherwise one by one, stopping after a refused MAIL.
+
+	Returns:
+		list: (code, response) per command sent
+	"""
+	if pipelining:
+		session.send("".join(command + "\r\n" for command in commands))
+		replies = [session.getreply() for command in commands]
+		inc("health_core_smtp_round_trips_total", pipelined=1)
+		return replies
+
+	replies = []
+	for i, command in enumerate(commands):
+		session.putcmd(command)
+		replies.append(session.getreply())
+		if i == 0 and replies[0][0] != 250:
+			break
+	inc("health_core_smtp_round_trips_total", len(replies), pipelined=0)
+	return replies
+
+
+def send_message(session, from_addr, to_addrs, msg, max_recipients=None):
+	"""
+	Sends one message to all recipients over an `smtplib.SMTP` session, in as
+	few transactions and round trips as the server allows. Drop-in for
+	`session.sendmail`, with the same exceptions and return value.
+
+	Args:
+		msg: Message bytes, or a `StreamingMessage`
+		max_recipients (int): Optional cap on RCPTs per transaction
+
+	Returns:
+		dict: Recipients refused by the server, keyed by address
+	"""
+	if isinstance(to_addrs, str):
+		to_addrs = [to_addrs]
+	if not isinstance(msg, StreamingMessage):
+		msg = LINE_ENDINGS.sub(CRLF, msg if isinstance(msg, bytes) else msg.encode("utf-8"))
+
+	session.ehlo_or_helo_if_needed()
+
+	pending = list(to_addrs)
+	refused = {}
+	while pending:
+		limit = get_recipient_limit(session, max_recipients) or len(pending)
+		group, pending = pending[:limit], pending[limit:]
+		group_refused = send_transaction(session, from_addr, group, msg)
+
+		over_limit = [
+			address for address in group
+			if group_refused.get(address, (None,))[0] == TOO_MANY_RECIPIENTS
+		]
+		accepted = len(group) - len(group_refused)
+		if over_limit and accepted:
+			# The server takes `accepted` recipients at a time; the rest go in the next transaction
+			session.health_core_rcpt_limit = accepted
+			pending = over_limit + pending
+			for address in over_limit:
+				del group_refused[address]
+
+		refused.update(group_refused)
+
+	if len(refused) == len(to_addrs):
+		raise smtplib.SMTPRecipientsRefused(refused)
+
+	return refused
+
+
+def send_transaction(session, from_addr, to_addrs, msg):
+	"""
+	One MAIL/RCPT/DATA (or BDAT) transaction. Plain messages to servers
+	without PIPELINING or CHUNKING go through `session.sendmail`.
+
+	Returns:
+		dict: Refused recipients; all of them if none was accepted (nothing is sent then)
+	"""
+	pipelining = session.has_extn("pipelining")
+	chunking = session.has_extn("chunking")
+	streaming = isinstance(msg, StreamingMessage)
+
+	if not (pipelining or chunking or streaming):
+		# Nothing to gain over smtplib's own exchange
+		try:
+			return session.sendmail(from_addr, to_addrs, msg)
+		except smtplib.SMTPRecipientsRefused as e:
+			return e.recipients
+
+	mail = "mail FROM:{0}".format(smtplib.quoteaddr(from_addr))
+	if session.has_extn("size"):
+		mail += " SIZE={0}".format(msg.size(stuffed=not chunking) if streaming else len(msg))
+
+	commands = [mail] + ["rcpt TO:{0}".format(smtplib.quoteaddr(address)) for address in to_addrs]
+	if pipelining and not chunking:
+		commands.append("data")
+
+	replies = exchange(session, commands, pipelining)
+
+	code, response = replies[0]
+	if code != 250:
+		abort(session, code)
+		raise smtplib.SMTPSenderRefused(code, response, from_addr)
+
+	refused = {}
+	for address, (code, response) in zip(to_addrs, replies[1:]):
+		if code not in ACCEPTED_RECIPIENT:
+			refused[address] = (code, response)
+		if code == 421:
+			session.close()
+			raise smtplib.SMTPRecipientsRefused(refused)
+
+	if len(refused) == len(to_addrs):
+		# A pipelined DATA has been answered with an error already
+		abort(session, 0)
+		return refused
+
+	if chunking:
+		write_bdat(session, msg, pipelining)
+	else:
+		if pipelining:
+			code, response = replies[-1]
+		else:
+			code, response = exchange(session, ["data"], False)[0]
+		if code != 354:
+			abort(session, code)
+			raise smtplib.SMTPDataError(code, response)
+		write_data(session, msg)
+
+	code, response = session.getreply()
+	inc("health_core_smtp_round_trips_total", pipelined=int(pipelining))
+	if code != 250:
+		abort(session, code)
+		raise smtplib.SMTPDataError(code, response)
+
+	return refused
+
+
+def write_data(session, msg):
+	"""Writes a dot-stuffed DATA body and the terminating dot, leaving the reply unread."""
+	if isinstance(msg, StreamingMessage):
+		for chunk in msg.iter_chunks():
+			session.sock.sendall(chunk)
+	else:
+		msg = DOT_LINE.sub(b"..", msg)
+		session.sock.sendall(msg if msg.endswith(CRLF) else msg + CRLF)
+	session.sock.sendall(b".\r\n")
+
+
+def write_bdat(session, msg, pipelining):
+	"""
+	Writes the message as BDAT chunks, leaving the reply to the last one
+	unread. Without pipelining each intermediate chunk's reply is awaited.
+	"""
+	if not isinstance(msg, StreamingMessage):
+		session.sock.sendall("BDAT {0} LAST\r\n".format(len(msg)).encode("ascii") + msg)
+		return
+
+	unread = 0
+	for chunk in msg.iter_chunks(stuffed=False):
+		session.sock.sendall("BDAT {0}\r\n".format(len(chunk)).encode("ascii"))
+		session.sock.sendall(chunk)
+		unread += 1
+		if not pipelining:
+			check_chunk_replies(session, unread)
+			unread = 0
+
+	session.sock.sendall(b"BDAT 0 LAST\r\n")
+	check_chunk_replies(session, unread)
+
+
+def check_chunk_replies(session, count):
+	"""Reads `count` BDAT replies, all of them even after a failure so the session stays in step."""
+	failure = None
+	for i in range(count):
+		code, response = session.getreply()
+		if code != 250 and not failure:
+			failure = (code, response)
+
+	if failure:
+		abort(session, failure[0])
+		raise smtplib.SMTPDataError(*failure)
+
+
+def abort(session, code):
+	"""Resets the transaction after a failed command, or drops the connection after a 421."""
+	if code == 421:
+		session.close()
+		return
+
+	try:
+		session.rset()
+	except smtplib.SMTPServerDisconnected:
+		pass
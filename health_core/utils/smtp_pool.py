@@ -0,0 +1,702 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import os
+import smtplib
+import socket
+import ssl
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+from email.message import EmailMessage
+from email.utils import formataddr, formatdate, make_msgid
+
+import frappe
+from frappe.utils import cint, strip_html
+
+from health_core.utils.metrics import inc, observe
+from health_core.utils.mime_stream import Attachment, StreamingMessage
+from health_core.utils.smtp_pipeline import send_message
+
+
+# Connection settings resolved from an Email Account document
+SMTPSettings = namedtuple(
+	"SMTPSettings",
+	["host", "port", "use_tls", "use_ssl", "login", "password", "email_id", "sender_name", "timeout", "modified"]
+)
+
+# Errors that mean the connection itself went away, not that the message was rejected
+CONNECTION_ERRORS = (
+	smtplib.SMTPServerDisconnected,
+	ConnectionResetError,
+	BrokenPipeError,
+	socket.timeout,
+)
+
+DEFAULT_IDLE_TIMEOUT = 60
+DEFAULT_NOOP_INTERVAL = 15
+DEFAULT_MAX_MESSAGES = 100
+DEFAULT_MAX_IDLE = 4
+DEFAULT_SMTP_TIMEOUT = 30
+
+
+@contextmanager
+def timed_phase(timings, phase):
+	"""
+	Records the time spent in the block in the SMTP phase histogram and, if
+	given, adds it in milliseconds to `timings[phase]`.
+	"""
+	start = time.perf_counter()
+	try:
+		yield
+	finally:
+		elapsed = time.perf_counter() - start
+		observe("health_core_smtp_phase_seconds", elapsed, phase=phase)
+		if timings is not None:
+			timings[phase] = timings.get(phase, 0) + elapsed * 1000
+
+
+class ResumingSSLContext(ssl.SSLContext):
+	"""
+	Client SSLContext that offers the last TLS session it saw for the same
+	server, so reconnects resume the session (an abbreviated handshake)
+	instead of paying for a full one. Records handshake CPU time and whether
+	each handshake was resumed.
+	"""
+
+	def __init__(self, protocol=ssl.PROTOCOL_TLS_CLIENT):
+		self._sessions = {}
+		self._sessions_lock = threading.Lock()
+
+	def wrap_socket(self, sock, *args, **kwargs):
+		key = (kwargs.get("server_hostname"), sock.getpeername()[1])
+		if kwargs.get("session") is None:
+			kwargs["session"] = self.get_session(key)
+
+		start = time.thread_time()
+		tls_sock = super(ResumingSSLContext, self).wrap_socket(sock, *args, **kwargs)
+		observe("health_core_tls_handshake_cpu_seconds", time.thread_time() - start)
+		inc("health_core_tls_handshakes_total", resumed=int(tls_sock.session_reused))
+
+		return tls_sock
+
+	def get_session(self, key):
+		with self._sessions_lock:
+			session = self._sessions.get(key)
+			if session and session.time + session.timeout <= time.time():
+				del self._sessions[key]
+				session = None
+		return session
+
+	def remember_session(self, tls_sock):
+		"""
+		Stores the socket's session for the next connection to the same server.
+		Call after the first reply has been read: TLS 1.3 servers send session
+		tickets after the handshake.
+		"""
+		session = getattr(tls_sock, "session", None)
+		if session is None or not (session.has_ticket or session.id):
+			return
+
+		with self._sessions_lock:
+			self._sessions[(tls_sock.server_hostname, tls_sock.getpeername()[1])] = session
+
+
+def make_ssl_context(cafile=None):
+	"""
+	Returns a new session-resuming client context. Without `cafile`, certificates
+	are not verified, matching smtplib's (and Frappe's) default STARTTLS context.
+	"""
+	context = ResumingSSLContext(ssl.PROTOCOL_TLS_CLIENT)
+	if cafile:
+		context.load_verify_locations(cafile)
+	else:
+		context.check_hostname = False
+		context.verify_mode = ssl.CERT_NONE
+	return context
+
+
+_ssl_context = None
+_ssl_context_pid = None
+
+
+def get_ssl_context():
+	"""Returns this worker's SSL context, shared by all its SMTP connections."""
+	global _ssl_context, _ssl_context_pid
+
+	if _ssl_context is None or _ssl_context_pid != os.getpid():
+		with _pool_lock:
+			if _ssl_context is None or _ssl_context_pid != os.getpid():
+				site = getattr(frappe.local, "site", None)
+				_ssl_context = make_ssl_context(frappe.conf.get("smtp_ca_file") if site else None)
+				_ssl_context_pid = os.getpid()
+
+	return _ssl_context
+
+
+def open_session(settings, timings=None, context=None):
+	"""
+	Opens a new authenticated SMTP session for the given settings.
+
+	Args:
+		settings (SMTPSettings): Connection settings
+		timings (dict): Optional dict that receives per-phase durations in milliseconds
+			(`dns`, `connect`, `tls`, `ehlo`, `auth`)
+		context (ssl.SSLContext): Context for TLS. Defaults to the worker's
+			session-resuming context.
+
+	Returns:
+		smtplib.SMTP: A connected, authenticated session
+	"""
+	context = context or get_ssl_context()
+
+	with timed_phase(timings, "dns"):
+		addresses = socket.getaddrinfo(settings.host, settings.port, type=socket.SOCK_STREAM)
+
+	# Like socket.create_connection, try each resolved address in turn, so a
+	# broken IPv6 route on a dual-stack host falls through to IPv4
+	error = None
+	for address in addresses:
+		if settings.use_ssl:
+			session = smtplib.SMTP_SSL(timeout=settings.timeout, context=context)
+		else:
+			session = smtplib.SMTP(timeout=settings.timeout)
+		# Connect to the resolved address but keep the hostname for TLS verification
+		session._host = settings.host
+
+		try:
+			with timed_phase(timings, "tls" if settings.use_ssl else "connect"):
+				session.connect(address[4][0], settings.port)
+			break
+		except OSError as e:
+			error = e
+			session.close()
+	else:
+		raise error or OSError("getaddrinfo returned no addresses for {0}".format(settings.host))
+
+	if settings.use_tls and not settings.use_ssl:
+		with timed_phase(timings, "ehlo"):
+			session.ehlo()
+		with timed_phase(timings, "tls"):
+			session.starttls(context=context)
+
+	with timed_phase(timings, "ehlo"):
+		session.ehlo()
+
+	if isinstance(session.sock, ssl.SSLSocket) and hasattr(context, "remember_session"):
+		context.remember_session(session.sock)
+
+	if settings.login and settings.password:
+		with timed_phase(timings, "auth"):
+			session.login(settings.login, settings.password)
+
+	return session
+
+
+class PooledConnection(object):
+	"""An SMTP session checked out of (or idle in) the pool."""
+
+	def __init__(self, key, session):
+		self.key = key
+		self.session = session
+		self.created_at = time.monotonic()
+		self.last_used = self.created_at
+		self.messages_sent = 0
+		self.reused = False
+
+	def idle_for(self, now=None):
+		return (now or time.monotonic()) - self.last_used
+
+	def close(self):
+		try:
+			self.session.quit()
+		except Exception:
+			try:
+				self.session.close()
+			except Exception:
+				pass
+
+
+class SMTPConnectionPool(object):
+	"""
+	Per-worker pool of persistent SMTP sessions, keyed by (site, Email Account).
+
+	Idle sessions are checked with NOOP before reuse, evicted after `idle_timeout`
+	seconds and retired after `max_messages` messages. Sends that fail because a
+	reused session was dropped by the server are retried once on a fresh session.
+	"""
+
+	def __init__(self, idle_timeout=DEFAULT_IDLE_TIMEOUT, noop_interval=DEFAULT_NOOP_INTERVAL,
+			max_messages=DEFAULT_MAX_MESSAGES, max_idle=DEFAULT_MAX_IDLE):
+		self.idle_timeout = idle_timeout
+		self.noop_interval = noop_interval
+		self.max_messages = max_messages
+		self.max_idle = max_idle
+		self.pid = os.getpid()
+		self._lock = threading.Lock()
+		self._idle = {}
+		self._settings = {}
+		self.stats = {"opened": 0, "reused": 0, "evicted": 0, "retired": 0, "failed": 0}
+
+	def get_settings(self, key):
+		return self._settings.get(key)
+
+	def set_settings(self, key, settings):
+		"""Stores settings for `key`, dropping idle sessions if they changed."""
+		with self._lock:
+			previous = self._settings.get(key)
+			self._settings[key] = settings
+			stale = self._idle.pop(key, []) if previous and previous != settings else []
+
+		for conn in stale:
+			conn.close()
+
+	def acquire(self, key, settings, timings=None):
+		"""
+		Checks out a live session for `key`, reusing an idle one when possible.
+
+		Args:
+			timings (dict): Optional dict that receives connection phase durations
+
+		Returns:
+			PooledConnection: A session reserved for the caller until `release`
+		"""
+		self.evict_idle()
+
+		while True:
+			with self._lock:
+				idle = self._idle.get(key)
+				conn = idle.pop() if idle else None
+
+			if not conn:
+				break
+
+			if conn.idle_for() >= self.noop_interval:
+				with timed_phase(timings, "noop"):
+					alive = self._is_alive(conn)
+				if not alive:
+					self.stats["evicted"] += 1
+					conn.close()
+					continue
+
+			conn.reused = True
+			self.stats["reused"] += 1
+			return conn
+
+		session = open_session(settings, timings)
+		self.stats["opened"] += 1
+		return PooledConnection(key, session)
+
+	def release(self, conn, discard=False):
+		"""Returns a session to the pool, or closes it if it is spent or broken."""
+		conn.last_used = time.monotonic()
+
+		if not discard and conn.messages_sent >= self.max_messages:
+			self.stats["retired"] += 1
+			discard = True
+
+		if not discard:
+			with self._lock:
+				idle = self._idle.setdefault(conn.key, [])
+				if len(idle) < self.max_idle:
+					idle.append(conn)
+					return
+
+		conn.close()
+
+	@contextmanager
+	def connection(self, key, settings):
+		conn = self.acquire(key, settings)
+		try:
+			yield conn
+		except Exception:
+			self.release(conn, discard=True)
+			raise
+		else:
+			self.release(conn)
+
+	def send(self, key, settings, from_addr, to_addrs, msg, timings=None, max_recipients=None):
+		"""
+		Sends a message over a pooled session, reconnecting once if a reused
+		session turns out to be dead. Commands are pipelined where the server
+		supports it (see `health_core.utils.smtp_pipeline`).
+
+		Args:
+			msg: The message as bytes, or a `StreamingMessage` written to the socket as it is encoded
+			max_recipients (int): RCPTs per transaction; more recipients are sent in several
+				transactions on the same session
+			timings (dict): Optional dict that receives per-phase durations in
+				milliseconds, including `send` for the MAIL/RCPT/DATA exchange
+
+		Returns:
+			dict: Recipients refused by the server, as returned by smtplib
+		"""
+		for attempt in (1, 2):
+			conn = self.acquire(key, settings, timings)
+			try:
+				with timed_phase(timings, "send"):
+					refused = send_message(conn.session, from_addr, to_addrs, msg, max_recipients)
+			except CONNECTION_ERRORS as e:
+				self.stats["failed"] += 1
+				self.release(conn, discard=True)
+				if attempt == 1 and conn.reused:
+					continue
+				inc("health_core_emails_failed_total", path="direct", error=type(e).__name__)
+				raise
+			except Exception as e:
+				self.stats["failed"] += 1
+				self.release(conn, discard=True)
+				inc("health_core_emails_failed_total", path="direct", error=type(e).__name__)
+				raise
+
+			conn.messages_sent += 1
+			self.release(conn)
+			inc("health_core_emails_sent_total", path="direct")
+			return refused
+
+	def prewarm(self, key, settings, count):
+		"""
+		Opens sessions until `count` (at most `max_idle`) are idle for `key`.
+
+		Returns:
+			int: Number of sessions opened
+		"""
+		with self._lock:
+			needed = min(count, self.max_idle) - len(self._idle.get(key, []))
+
+		conns = []
+		for _ in range(max(needed, 0)):
+			conns.append(PooledConnection(key, open_session(settings)))
+			self.stats["opened"] += 1
+
+		for conn in conns:
+			self.release(conn)
+
+		return len(conns)
+
+	def evict_idle(self):
+		"""Closes sessions that have been idle longer than `idle_timeout`."""
+		now = time.monotonic()
+		expired = []
+
+		with self._lock:
+			for key, idle in self._idle.items():
+				keep = []
+				for conn in idle:
+					(expired if conn.idle_for(now) >= self.idle_timeout else keep).append(conn)
+				self._idle[key] = keep
+
+		for conn in expired:
+			self.stats["evicted"] += 1
+			conn.close()
+
+	def close_all(self):
+		with self._lock:
+			idle, self._idle = self._idle, {}
+
+		for conns in idle.values():
+			for conn in conns:
+				conn.close()
+
+	def _is_alive(self, conn):
+		try:
+			return conn.session.noop()[0] == 250
+		except Exception:
+			return False
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+	"""
+	Returns this worker's connection pool, creating a fresh one after a fork
+	so that child processes never share sockets with their parent.
+	"""
+	global _pool
+
+	if _pool is None or _pool.pid != os.getpid():
+		with _pool_lock:
+			if _pool is None or _pool.pid != os.getpid():
+				_pool = SMTPConnectionPool(
+					idle_timeout=cint(frappe.conf.get("smtp_pool_idle_timeout")) or DEFAULT_IDLE_TIMEOUT,
+					noop_interval=cint(frappe.conf.get("smtp_pool_noop_interval")) or DEFAULT_NOOP_INTERVAL,
+					max_messages=cint(frappe.conf.get("smtp_pool_max_messages")) or DEFAULT_MAX_MESSAGES,
+					max_idle=cint(frappe.conf.get("smtp_pool_max_idle")) or DEFAULT_MAX_IDLE
+				)
+
+	return _pool
+
+
+class PooledSMTPServer(object):
+	"""
+	Stands in for `frappe.email.smtp.SMTPServer` so that Email Queue rows are
+	sent over a pooled session. The session is checked out lazily on first use
+	and must be handed back with `release` once the row has been sent.
+	"""
+
+	def __init__(self, email_account, pool=None):
+		self.email_account = email_account
+		self.pool = pool or get_pool()
+		self.connect_error = None
+		self.throttled = None
+		self._conn = None
+		self._session = None
+
+	@property
+	def session(self):
+		if not self._conn:
+			settings = get_account_settings(self.email_account)
+			try:
+				self._conn = self.pool.acquire(get_pool_key(self.email_account), settings)
+			except Exception as e:
+				# Could not connect or authenticate; the caller stops using this account
+				self.connect_error = e
+				raise
+			self._session = TrackedSession(self, self._conn.session)
+		return self._session
+
+	def is_session_active(self):
+		return bool(self._conn) and self.pool._is_alive(self._conn)
+
+	def release(self, discard=False):
+		if not self._conn:
+			return
+
+		conn, self._conn = self._conn, None
+		self._session = None
+		if not discard:
+			conn.messages_sent += 1
+		self.pool.release(conn, discard=discard)
+
+	def quit(self):
+		# Frappe may quit the server after a send; the caller releases the session instead
+		pass
+
+
+class TrackedSession(object):
+	"""
+	Wraps a pooled session handed to Frappe so every `sendmail` is pipelined
+	where the server allows, timed and its outcome fed to the account router. A throttling response marks the
+	server as `throttled`, telling the caller to stop using the account.
+	"""
+
+	def __init__(self, server, session):
+		self._server = server
+		self._session = session
+
+	def __getattr__(self, name):
+		return getattr(self._session, name)
+
+	def sendmail(self, from_addr, to_addrs, msg, mail_options=(), rcpt_options=()):
+		from health_core.utils.routing import record_send
+
+		start = time.perf_counter()
+		try:
+			if mail_options or rcpt_options:
+				refused = self._session.sendmail(from_addr, to_addrs, msg, mail_options, rcpt_options)
+			else:
+				refused = send_message(self._session, from_addr, to_addrs, msg)
+		except Exception as e:
+			self._server.throttled = record_send(self._server.email_account, error=e)
+			raise
+
+		record_send(self._server.email_account, time.perf_counter() - start)
+		return refused
+
+
+def get_default_outgoing_account():
+	"""Returns the name of the default outgoing Email Account, if any."""
+	return frappe.db.get_value("Email Account", {"default_outgoing": 1, "enable_outgoing": 1}, "name")
+
+
+def prewarm_connections(email_account=None, count=None):
+	"""
+	Opens authenticated sessions ahead of a burst of sends, so the first
+	messages do not wait for connect, TLS and AUTH. Called by the resident
+	email worker; scheduled batch jobs can call it before they start sending.
+
+	Args:
+		email_account (str): Defaults to the default outgoing account
+		count (int): Sessions to keep ready. Defaults to `smtp_prewarm_connections` (0 disables).
+
+	Returns:
+		int: Number of sessions opened
+	"""
+	count = cint(frappe.conf.get("smtp_prewarm_connections")) if count is None else count
+	if not count:
+		return 0
+
+	email_account = email_account or get_default_outgoing_account()
+	if not email_account:
+		return 0
+
+	try:
+		return get_pool().prewarm(get_pool_key(email_account), get_account_settings(email_account), count)
+	except Exception:
+		frappe.log_error(title="Health Core: failed to pre-warm SMTP connections")
+		return 0
+
+
+def get_pool_key(email_account):
+	return (frappe.local.site, email_account)
+
+
+def get_account_settings(email_account):
+	"""
+	Resolves SMTP settings for an Email Account.
+
+	The password is only read from the database when the account has been
+	modified since the pool last saw it; otherwise the cached settings are used.
+
+	Args:
+		email_account (str): Name of the Email Account
+
+	Returns:
+		SMTPSettings: Connection settings for the account
+	"""
+	pool = get_pool()
+	key = get_pool_key(email_account)
+	account = frappe.get_cached_doc("Email Account", email_account)
+
+	cached = pool.get_settings(key)
+	if cached and cached.modified == str(account.modified):
+		return cached
+
+	login = None
+	password = None
+	if not cint(account.get("no_smtp_authentication")):
+		login = account.login_id if cint(account.get("login_id_is_different")) else account.email_id
+		password = account.get_password(raise_exception=False)
+
+	settings = SMTPSettings(
+		host=account.smtp_server,
+		port=cint(account.smtp_port) or (465 if cint(account.get("use_ssl_for_outgoing")) else 587),
+		use_tls=cint(account.use_tls),
+		use_ssl=cint(account.get("use_ssl_for_outgoing")),
+		login=login,
+		password=password,
+		email_id=account.email_id,
+		sender_name=account.email_account_name,
+		timeout=cint(frappe.conf.get("smtp_timeout")) or DEFAULT_SMTP_TIMEOUT,
+		modified=str(account.modified)
+	)
+	pool.set_settings(key, settings)
+
+	return settings
+
+
+def build_message(settings, recipients, subject, message, reference_doctype=None, reference_name=None,
+		attachments=None):
+	"""
+	Builds a multipart (plain text + HTML) MIME message from the account's address.
+
+	Args:
+		attachments (list): Optional attachments (paths, file objects or
+			`frappe.sendmail`-style dicts), see `health_core.utils.mime_stream`
+
+	Returns:
+		EmailMessage: The message, ready for `as_bytes()`, or a `StreamingMessage`
+			if there are attachments
+	"""
+	msg = EmailMessage()
+	msg["From"] = formataddr((settings.sender_name, settings.email_id))
+	msg["To"] = ", ".join(recipients)
+	msg["Subject"] = subject
+	msg["Date"] = formatdate(localtime=True)
+	msg["Message-Id"] = make_msgid(domain=settings.email_id.rsplit("@", 1)[-1])
+
+	if reference_doctype and reference_name:
+		msg["X-Frappe-Reference"] = "{0}/{1}".format(reference_doctype, reference_name)
+
+	body = EmailMessage() if attachments else msg
+	body.set_content(strip_html(message).strip())
+	body.add_alternative(message, subtype="html")
+
+	if attachments:
+		return StreamingMessage(msg, body, attachments)
+
+	return msg
+
+
+def send_mail(recipients, subject, message, email_account=None, reference_doctype=None, reference_name=None,
+		timings=None, attachments=None):
+	"""
+	Sends an email immediately over this worker's pooled SMTP session for the account.
+
+	This is the send path for all messages health_core delivers itself; it
+	replaces `frappe.sendmail(..., now=True)`, which opens and authenticates a
+	new SMTP connection for every message.
+
+	Without an `email_account` the message is routed through the routing pool
+	(see `health_core.utils.routing`), failing over to the next account if one
+	is throttled or unreachable.
+
+	Args:
+		recipients (list): Recipient email addresses
+		subject (str): Email subject
+		message (str): HTML body
+		email_account (str): Email Account to send from. Defaults to a routed or the default outgoing account.
+		reference_doctype (str): Optional reference doctype, recorded in a header
+		reference_name (str): Optional reference document name
+		timings (dict): Optional dict that receives SMTP phase durations in milliseconds
+		attachments (list): Paths, binary file objects or `frappe.sendmail`-style dicts
+			(`{"fname", "fcontent"}` or `{"fid"}`), streamed from disk while sending
+
+	Returns:
+		dict: Recipients refused by the server, keyed by address
+	"""
+	from health_core.utils.routing import is_failover_error, route_accounts
+
+	if isinstance(recipients, str):
+		recipients = [recipients]
+
+	accounts = [email_account] if email_account else route_accounts()
+	if not accounts:
+		frappe.throw("No default outgoing email account configured")
+
+	# Resolved once so that read-once streams are spooled once and survive a failover
+	attachments = [Attachment.from_source(attachment) for attachment in attachments or []]
+
+	try:
+		for i, account in enumerate(accounts):
+			try:
+				return send_from_account(account, recipients, subject, message, reference_doctype, reference_name,
+					timings, attachments)
+			except Exception as e:
+				if i == len(accounts) - 1 or not is_failover_error(e):
+					raise
+				inc("health_core_route_failovers_total", email_account=account, error=type(e).__name__)
+	finally:
+		for attachment in attachments:
+			attachment.close()
+
+
+def send_from_account(email_account, recipients, subject, message, reference_doctype=None, reference_name=None,
+		timings=None, attachments=None):
+	"""Builds and sends a message from one Email Account, recording the outcome for routing."""
+	from health_core.utils.routing import record_send
+
+	settings = get_account_settings(email_account)
+	with timed_phase(timings, "build"):
+		msg = build_message(settings, recipients, subject, message, reference_doctype, reference_name, attachments)
+		if not isinstance(msg, StreamingMessage):
+			msg = msg.as_bytes()
+
+	start = time.perf_counter()
+	try:
+		refused = get_pool().send(
+			get_pool_key(email_account),
+			settings,
+			settings.email_id,
+			recipients,
+			msg,
+			timings=timings
+		)
+	except Exception as e:
+		record_send(email_account, error=e)
+		raise
+
+	record_send(email_account, time.perf_counter() - start)
+	return refused
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+Email template registry.
+
+Templates are looked up by name, first as a file in
+`health_core/templates/emails/<name>.html`, then as an Email Template document.
+Each worker compiles a template once and keeps the compiled Jinja template in
+an LRU cache keyed by (name, modification time), so editing the file or the
+document picks up the new version without a restart.
+"""
+from __future__ import unicode_literals
+import os
+from functools import lru_cache
+
+import frappe
+
+
+TEMPLATE_CACHE_SIZE = 128
+
+
+def get_template_path(name):
+	return frappe.get_app_path("health_core", "templates", "emails", name + ".html")
+
+
+@lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def compile_file_template(name, mtime):
+	with open(get_template_path(name)) as f:
+		return frappe.get_jenv().from_string(f.read())
+
+
+@lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def compile_email_template(name, modified):
+	template = frappe.db.get_value(
+		"Email Template", name, ["use_html", "response", "response_html"], as_dict=True
+	)
+	return frappe.get_jenv().from_string((template.response_html if template.use_html else template.response) or "")
+
+
+def get_template(name):
+	"""
+	Returns the compiled template for `name`, compiling it only if this worker
+	has not seen its current version yet.
+	"""
+	try:
+		mtime = os.stat(get_template_path(name)).st_mtime_ns
+	except OSError:
+		modified = frappe.db.get_value("Email Template", name, "modified")
+		if not modified:
+			frappe.throw(f"Email template {name} not found", frappe.DoesNotExistError)
+		return compile_email_template(name, str(modified))
+
+	return compile_file_template(name, mtime)
+
+
+def render_template(name, context=None):
+	"""
+	Renders one email template.
+
+	Args:
+		name (str): Template file name (without `.html`) or Email Template name
+		context (dict): Template variables
+
+	Returns:
+		str: Rendered HTML
+	"""
+	return get_template(name).render(context or {})
+
+
+def render_many(name, contexts):
+	"""
+	Renders the same template for many contexts (e.g. one per recipient of a
+	bulk notification), looking the template up and compiling it at most once.
+
+	Returns:
+		list: Rendered HTML, in the order of `contexts`
+	"""
+	template = get_template(name)
+	return [template.render(context or {}) for context in contexts]
+
+
+def clear_template_cache():
+	compile_file_template.cache_clear()
+	compile_email_template.cache_clear()
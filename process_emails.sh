@@ -1,16 +1,16 @@
 #!/bin/bash
 
 # Script para procesar emails automáticamente
-# Se ejecuta cada 2 minutos
+# Inicia el worker residente de health_core, que envía cada email
+# en cuanto se inserta en el Email Queue (sin reiniciar bench cada ciclo)
 
 cd /home/frappe/frappe-bench
 
 while true; do
-    echo "$(date): Processing email queue..."
-    
-    # Procesar emails pendientes
-    bench --site 4geeks execute "frappe.email.queue.flush"
-    
-    # Esperar 2 minutos (120 segundos)
-    sleep 120
-done
\ No newline at end of file
+    echo "$(date): Starting health_core email worker..."
+
+    # El worker solo termina si falla o recibe una señal; reiniciarlo en ese caso
+    bench --site 4geeks health-core-email-worker
+
+    sleep 5
+done